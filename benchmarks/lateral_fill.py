@@ -0,0 +1,62 @@
+"""Compare the iterations and wall-clock time of the lateral_fill methods.
+
+Usage: python benchmarks/lateral_fill.py [grid_name] [tol]
+
+Fills a smooth field over all land points (so that the solvers have to
+fill under the continents) and reports, for each method, the number of
+iterations on the full grid and the time per fill, each also as a
+fraction of those of 'jacobi', and the largest difference from the
+converged solution (computed with a much smaller tolerance).
+"""
+
+import sys
+import time
+
+import numpy as np
+
+import pop_tools
+from pop_tools.fill import fill_methods, lateral_fill_np_array
+
+
+def main(grid_name='POP_gx1v7', tol=1.0e-4):
+    ds = pop_tools.get_grid(grid_name, variables=['TLAT', 'TLONG', 'KMT'])
+    lat, lon = np.deg2rad(ds.TLAT.values), np.deg2rad(ds.TLONG.values)
+    field = 10.0 + np.cos(lat) * np.sin(2 * lon) + np.sin(lat) ** 2
+    field = np.where(ds.KMT.values > 0, field, np.nan)
+    isvalid_mask = np.ones(field.shape, dtype=bool)
+
+    print(f'{grid_name}, tol={tol}: {np.isnan(field).sum()} points to fill')
+    print(
+        f'{"method":>10} {"iterations":>10} {"vs jacobi":>9} '
+        f'{"seconds":>8} {"vs jacobi":>9} {"max error":>10}'
+    )
+
+    reference = lateral_fill_np_array(field, isvalid_mask, tol=tol * 1e-4, method='multigrid')
+
+    # fill_methods starts with 'jacobi'
+    jacobi = None
+    for method in fill_methods:
+        # compile outside of the timing
+        lateral_fill_np_array(
+            field[:40, :40], isvalid_mask[:40, :40], tol=tol, method=method, diagnostics=True
+        )
+
+        start = time.perf_counter()
+        filled, diagnostics = lateral_fill_np_array(
+            field, isvalid_mask, tol=tol, method=method, diagnostics=True
+        )
+        elapsed = time.perf_counter() - start
+
+        assert (np.isnan(filled) == np.isnan(reference)).all()
+        diff = np.nanmax(np.abs(filled - reference))
+        niter = int(diagnostics.iterations)
+        if jacobi is None:
+            jacobi = niter, elapsed
+        print(
+            f'{method:>10} {niter:>10d} {niter / jacobi[0]:>9.3f} '
+            f'{elapsed:>8.2f} {elapsed / jacobi[1]:>9.3f} {diff:>10.2e}'
+        )
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2], *[float(arg) for arg in sys.argv[2:3]])
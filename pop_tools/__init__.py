@@ -1,12 +1,17 @@
 """Top-level module for pop_tools"""
 
-
 from pkg_resources import DistributionNotFound, get_distribution
 
-from .config import grid_defs
+from .basin import basin_reduce
+from .cache import clear_grid_memo, grid_memo_info, purge_grid_cache, set_grid_memo_limits
+from .config import grid_defs, register_grids
 from .eos import compute_pressure, eos
-from .fill import lateral_fill, lateral_fill_np_array
-from .grid import get_grid
+from .fill import FillPlan, lateral_fill, lateral_fill_np_array, lateral_fill_to_zarr
+from .grid import cache_grid, get_grid
+from .pack import OceanIndex
+from .remap import apply_weights, get_remap_weights, remap_weights
+from .spatial import SpatialIndex
+from .vertical import VerticalInterpolator, depth_to_level
 
 try:
     __version__ = get_distribution(__name__).version
@@ -0,0 +1,197 @@
+"""Reductions over the regions of a POP region mask."""
+
+import dask.array
+import numpy as np
+import xarray as xr
+from numba import jit, prange
+
+
+def basin_reduce(field, region_mask, weights=None, how='mean', regions=None):
+    """Compute weighted sums or means of a field over all regions at once.
+
+    Every region is reduced in a single parallel pass over the field.
+    Points where `field` is NaN are skipped, so land masked with NaN does
+    not contribute to the sums or to the weights of the means.
+
+    Parameters
+    ----------
+
+    field : numpy.ndarray, dask.array.Array or xarray.DataArray
+      Field to reduce. The reduction is over its trailing dimensions
+      corresponding to those of `weights` (or of `region_mask`, if `weights`
+      is `None`); any leading dimensions (e.g. `time`) are kept. Dask
+      arrays are reduced block by block and the partial sums combined.
+
+    region_mask : numpy.ndarray or xarray.DataArray
+      Integer region index of each lateral point, e.g. `REGION_MASK` from
+      `get_grid`, with dimensions (`nlat`, `nlon`).
+
+    weights : numpy.ndarray or xarray.DataArray, optional
+      Weights, e.g. `TAREA` for area weighting or cell volumes with
+      dimensions (`z_t`, `nlat`, `nlon`) for volume weighting. Default is
+      a weight of one at every point.
+
+    how : {'mean', 'sum'}, optional [default='mean']
+      Return weighted means or weighted sums (integrals).
+
+    regions : list of int, optional
+      Region indices to reduce over, in order; default is all nonzero
+      values of `region_mask`. Must not be empty.
+
+    Returns
+    -------
+
+    reduced : same type as `field`
+      Reduced field with a trailing `region` dimension. DataArrays get a
+      `region` coordinate with the region indices.
+    """
+
+    if how not in ['mean', 'sum']:
+        raise ValueError(f"how must be 'mean' or 'sum', got {how!r}")
+
+    if isinstance(field, xr.DataArray):
+        return _basin_reduce_xarray(field, region_mask, weights, how, regions)
+
+    region_mask = np.asarray(region_mask)
+    if weights is None:
+        weights = np.ones(region_mask.shape)
+    weights = np.asarray(weights)
+    if weights.ndim < 2 or weights.shape[-2:] != region_mask.shape:
+        raise ValueError(
+            f'weights must end with the dimensions of region_mask {region_mask.shape}, '
+            f'got {weights.shape}'
+        )
+    nred = weights.ndim
+    if field.shape[-nred:] != weights.shape:
+        raise ValueError(
+            f'trailing dimensions of field {field.shape} do not match weights {weights.shape}'
+        )
+
+    if regions is None:
+        regions = np.unique(region_mask)
+        regions = regions[regions != 0]
+    if len(regions) == 0:
+        raise ValueError('no regions to reduce over')
+    codes = _region_codes(region_mask, regions)
+
+    if isinstance(field, dask.array.Array):
+        nlead = field.ndim - nred
+        weights = dask.array.from_array(weights, chunks=field.chunks[-nred:])
+        codes = dask.array.from_array(codes, chunks=field.chunks[-2:])
+        # partial sums of each block, combined by summing over the reduced axes
+        sums = dask.array.map_blocks(
+            _block_sums,
+            field,
+            weights,
+            codes,
+            len(regions),
+            nred,
+            new_axis=[field.ndim, field.ndim + 1],
+            chunks=field.chunks[:nlead]
+            + tuple((1,) * len(c) for c in field.chunks[nlead:])
+            + ((2,), (len(regions),)),
+            dtype=np.float64,
+        )
+        sums = sums.sum(axis=tuple(range(nlead, field.ndim)))
+        return sums.map_blocks(_finalize, how, drop_axis=nlead, dtype=np.float64)
+
+    sums = _block_sums(np.asarray(field), weights, codes, len(regions), nred)
+    return _finalize(sums.reshape(sums.shape[: -nred - 2] + sums.shape[-2:]), how)
+
+
+def _basin_reduce_xarray(field, region_mask, weights, how, regions):
+    if not isinstance(region_mask, xr.DataArray):
+        raise ValueError('region_mask must be a DataArray if field is a DataArray')
+    if weights is None:
+        reduce_dims = region_mask.dims
+        weights_data = None
+    else:
+        if not isinstance(weights, xr.DataArray):
+            raise ValueError('weights must be a DataArray if field is a DataArray')
+        reduce_dims = tuple(d for d in weights.dims if d not in region_mask.dims)
+        reduce_dims += region_mask.dims
+        weights_data = weights.transpose(*reduce_dims).data
+
+    lead_dims = tuple(d for d in field.dims if d not in reduce_dims)
+    field = field.transpose(*(lead_dims + reduce_dims))
+
+    if regions is None:
+        regions = np.unique(region_mask)
+        regions = regions[regions != 0]
+
+    reduced = basin_reduce(field.data, region_mask.data, weights_data, how, regions)
+    return xr.DataArray(
+        reduced,
+        dims=lead_dims + ('region',),
+        coords=dict(
+            {k: v for k, v in field.coords.items() if set(v.dims) <= set(lead_dims)},
+            region=np.asarray(regions),
+        ),
+        attrs=field.attrs if how == 'mean' else {},
+        name=field.name,
+    )
+
+
+def _region_codes(region_mask, regions):
+    """Return the position of each point's region in `regions`, or -1."""
+    regions = np.asarray(regions)
+    order = np.argsort(regions)
+    sorted_regions = regions[order]
+    pos = np.clip(np.searchsorted(sorted_regions, region_mask), 0, len(regions) - 1)
+    return np.where(sorted_regions[pos] == region_mask, order[pos], -1).astype(np.int32)
+
+
+def _block_sums(field, weights, codes, nregion, nred):
+    """Weighted sums and sums of weights of a block, per region.
+
+    Returns an array with the reduced axes of `field` kept with length 1
+    and two trailing axes: (sum of weights * field, sum of weights) and
+    region.
+    """
+    lead_shape = field.shape[:-nred]
+    weights = weights.reshape((-1,) + codes.shape)
+    sums = _basin_sums(field.reshape((-1,) + weights.shape), weights, codes, nregion).sum(axis=1)
+    return sums.reshape(lead_shape + (1,) * nred + (2, nregion))
+
+
+def _finalize(sums, how):
+    """Return sums or means from the output of `_block_sums`, reduced."""
+    if how == 'sum':
+        return sums[..., 0, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(sums[..., 1, :] > 0, sums[..., 0, :] / sums[..., 1, :], np.nan)
+
+
+@jit(nopython=True, parallel=True)
+def _basin_sums(field, weights, codes, nregion):
+    """Per-region sums of weights * field and of weights, skipping NaN.
+
+    `field` has shape (n, nz, nlat, nlon) and `weights` (nz, nlat, nlon);
+    `codes` gives the region of each lateral point (< 0 to skip it). Rows
+    are split into bands summed in parallel; returns partial sums of shape
+    (n, nband, 2, nregion).
+    """
+
+    n, nz, nlat, nlon = field.shape
+    nband = min(nlat, 64)
+    partial = np.zeros((n, nband, 2, nregion))
+
+    for b in prange(0, n * nband):
+        s = b // nband
+        band = b % nband
+        j0 = band * nlat // nband
+        j1 = (band + 1) * nlat // nband
+        for k in range(0, nz):
+            for j in range(j0, j1):
+                for i in range(0, nlon):
+                    r = codes[j, i]
+                    if r < 0:
+                        continue
+                    x = field[s, k, j, i]
+                    if np.isnan(x):
+                        continue
+                    w = weights[k, j, i]
+                    partial[s, band, 0, r] += w * x
+                    partial[s, band, 1, r] += w
+
+    return partial
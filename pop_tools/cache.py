@@ -0,0 +1,398 @@
+"""In-memory and on-disk caches for datasets generated by `pop_tools.get_grid`."""
+
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import xarray as xr
+
+from . import config
+
+# increment when the content or layout of cached grid datasets changes
+CACHE_FORMAT_VERSION = 1
+
+grid_input_keys = ['horiz_grid_fname', 'topography_fname', 'region_mask_fname', 'vert_grid_file']
+
+_digest_index_fname = 'file_digests.json'
+
+# in-process LRU memo of grid datasets
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+_memo_limits = {'maxsize': 16, 'max_bytes': 2 * 1024 ** 3}
+_memo_stats = {'hits': 0, 'misses': 0}
+
+
+def _cache_dir(cache_dir=None):
+    if cache_dir is None:
+        cache_dir = config.GRID_CACHE_DIR
+    return os.path.expanduser(cache_dir)
+
+
+def _read_digest_index(cache_dir):
+    """Read the table of known input file digests."""
+    try:
+        with open(os.path.join(cache_dir, _digest_index_fname)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_digest_index(cache_dir, index):
+    """Atomically replace the table of known input file digests."""
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, os.path.join(cache_dir, _digest_index_fname))
+
+
+def file_digest(path, index=None):
+    """Return the sha256 digest of a file.
+
+    If `index` is provided, the digest is reused when the size and mtime
+    of `path` match the recorded entry; otherwise the file is hashed and
+    the entry updated in place.
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    if index is not None:
+        entry = index.get(path)
+        if (
+            entry is not None
+            and entry['size'] == stat.st_size
+            and entry['mtime_ns'] == stat.st_mtime_ns
+        ):
+            return entry['sha256']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if index is not None:
+        index[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+    return digest
+
+
+def grid_cache_path(
+    grid_name, grid_attrs, cache_dir=None, suffix='.zarr', input_files=(), **options
+):
+    """Return the path of the cache entry for a grid.
+
+    The entry name combines a hash of the dataset options (e.g., `scrip`)
+    with a hash of the contents of each input file in `grid_attrs`, so that
+    modified input files map to a new entry.
+
+    Parameters
+    ----------
+
+    grid_name : str
+      Name of grid.
+
+    grid_attrs : dict
+      Grid definition (an entry of `pop_tools.grid_defs`).
+
+    cache_dir : str, optional
+      Cache directory; defaults to `pop_tools.config.GRID_CACHE_DIR`.
+
+    suffix : str, optional
+      Extension of the entry, according to its format.
+
+    input_files : list of str, optional
+      Additional files the entry is generated from (e.g., those of another
+      grid), hashed along with the input files of the grid.
+
+    **options
+      Keyword arguments that affect the content of the dataset.
+
+    Returns
+    -------
+
+    path : str
+    """
+    cache_dir = _cache_dir(cache_dir)
+
+    options = dict(options, grid_name=grid_name, version=CACHE_FORMAT_VERSION)
+    options_key = hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+    index = _read_digest_index(cache_dir)
+    index_before = dict(index)
+
+    content = hashlib.sha256(options_key.encode())
+    for key in grid_input_keys:
+        content.update(f'{key}:{file_digest(grid_attrs[key], index)}'.encode())
+    for path in input_files:
+        content.update(f'input:{file_digest(path, index)}'.encode())
+
+    if index != index_before:
+        _write_digest_index(cache_dir, index)
+
+    entry = f'{options_key[:12]}-{content.hexdigest()[:24]}{suffix}'
+    return os.path.join(cache_dir, grid_name, entry)
+
+
+def _require_zarr():
+    try:
+        import zarr  # noqa: F401
+    except ImportError:
+        raise ImportError('the on-disk grid cache requires zarr')
+
+
+def open_cached_grid(path):
+    """Open a cached grid dataset lazily; return `None` on a cache miss."""
+    _require_zarr()
+    if not os.path.isdir(path):
+        return None
+    try:
+        return xr.open_zarr(path, decode_coords=False)
+    except (KeyError, ValueError):
+        # corrupt entry (e.g., no .zmetadata after an interrupted write by an older version)
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    except Exception:
+        # possibly transient, or a library version mismatch: keep the entry
+        return None
+
+
+def write_cached_grid(dso, path):
+    """Write a grid dataset to the cache, replacing stale entries.
+
+    The dataset is written to a temporary directory and moved into place,
+    so concurrent readers never see a partial entry. Entries for the same
+    grid and options built from different input files are removed.
+    """
+    _require_zarr()
+    grid_dir = os.path.dirname(path)
+    os.makedirs(grid_dir, exist_ok=True)
+
+    if dso.chunks:
+        # zarr requires uniform chunks, except for the last one
+        dso = dso.chunk({dim: max(chunks) for dim, chunks in dso.chunks.items()})
+
+    tmp_path = tempfile.mkdtemp(dir=grid_dir, suffix='.tmp')
+    try:
+        dso.to_zarr(tmp_path, mode='w')
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process populated the entry first
+        if not os.path.isdir(path):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    _remove_stale_entries(path)
+
+
+def open_cached_object(path):
+    """Load a pickled cache entry; return `None` on a cache miss."""
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (pickle.UnpicklingError, EOFError):
+        # corrupt entry (e.g., from an interrupted write by an older version)
+        try:
+            os.remove(path)
+        except OSError:
+            # already removed by another process
+            pass
+        return None
+    except Exception:
+        # possibly transient, or a library version mismatch: keep the entry
+        return None
+
+
+def write_cached_object(obj, path):
+    """Pickle an object to the cache atomically, replacing stale entries."""
+    grid_dir = os.path.dirname(path)
+    os.makedirs(grid_dir, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=grid_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _remove_stale_entries(path)
+
+
+def _remove_stale_entries(path):
+    """Remove entries with the same options as `path` but other input files."""
+    grid_dir, entry = os.path.split(path)
+    options_prefix = entry.split('-')[0]
+    suffix = os.path.splitext(entry)[1]
+    for other in os.listdir(grid_dir):
+        if other != entry and other.startswith(f'{options_prefix}-') and other.endswith(suffix):
+            other = os.path.join(grid_dir, other)
+            if os.path.isdir(other):
+                shutil.rmtree(other, ignore_errors=True)
+            else:
+                os.remove(other)
+
+
+def purge_grid_cache(grid_name=None, cache_dir=None):
+    """Remove cached grid datasets.
+
+    Only files created by the cache are removed; other files in
+    `cache_dir`, and the directory itself, are left alone.
+
+    Parameters
+    ----------
+
+    grid_name : str or list of str, optional
+      Grid(s) to remove from the cache. If `None`, the whole cache is removed.
+
+    cache_dir : str, optional
+      Cache directory; defaults to `pop_tools.config.GRID_CACHE_DIR`.
+    """
+    cache_dir = _cache_dir(cache_dir)
+    if not os.path.isdir(cache_dir):
+        return
+
+    if grid_name is None:
+        grid_name = [
+            name
+            for name in os.listdir(cache_dir)
+            if name != 'grid_defs' and os.path.isdir(os.path.join(cache_dir, name))
+        ]
+        shutil.rmtree(os.path.join(cache_dir, 'grid_defs'), ignore_errors=True)
+        try:
+            os.remove(os.path.join(cache_dir, _digest_index_fname))
+        except OSError:
+            pass
+    elif isinstance(grid_name, str):
+        grid_name = [grid_name]
+
+    for name in grid_name:
+        _purge_grid_dir(os.path.join(cache_dir, name))
+
+
+# names of cache entries, and of temporary files of interrupted writes
+_entry_name = re.compile(r'^([0-9a-f]{12}-[0-9a-f]{24}(\.\w+)?|tmp\w+\.tmp)$')
+
+
+def _purge_grid_dir(grid_dir):
+    """Remove the cache entries of a grid, and its directory if then empty."""
+    if not os.path.isdir(grid_dir):
+        return
+    for name in os.listdir(grid_dir):
+        if not _entry_name.match(name):
+            continue
+        path = os.path.join(grid_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    try:
+        os.rmdir(grid_dir)
+    except OSError:
+        # not empty
+        pass
+
+
+def _in_memory_nbytes(dso):
+    """Bytes held by numpy-backed variables (lazy variables are not counted)."""
+    return sum(v.data.nbytes for v in dso.variables.values() if isinstance(v.data, np.ndarray))
+
+
+def _memo_evict():
+    """Drop least recently used entries until within limits; call with lock held."""
+    nbytes = sum(entry[1] for entry in _memo.values())
+    while _memo and (len(_memo) > _memo_limits['maxsize'] or nbytes > _memo_limits['max_bytes']):
+        _, (_, entry_nbytes) = _memo.popitem(last=False)
+        nbytes -= entry_nbytes
+
+
+def memo_get(key):
+    """Return a shallow copy of a memoized dataset, or `None`."""
+    with _memo_lock:
+        entry = _memo.get(key)
+        if entry is None:
+            _memo_stats['misses'] += 1
+            return None
+        _memo.move_to_end(key)
+        _memo_stats['hits'] += 1
+    return entry[0].copy(deep=False)
+
+
+def memo_put(key, dso):
+    """Memoize a dataset, marking its numpy arrays read-only.
+
+    Returns a shallow copy of the memoized dataset; arrays are shared,
+    `attrs` and `encoding` are not.
+    """
+    for v in dso.variables.values():
+        if isinstance(v.data, np.ndarray):
+            v.data.flags.writeable = False
+
+    nbytes = _in_memory_nbytes(dso)
+    with _memo_lock:
+        if nbytes <= _memo_limits['max_bytes']:
+            _memo[key] = (dso, nbytes)
+            _memo.move_to_end(key)
+            _memo_evict()
+    return dso.copy(deep=False)
+
+
+def set_grid_memo_limits(maxsize=None, max_bytes=None):
+    """Set bounds on the in-process memo of grid datasets.
+
+    Parameters
+    ----------
+
+    maxsize : int, optional
+      Maximum number of memoized datasets.
+
+    max_bytes : int, optional
+      Maximum total size in bytes of in-memory arrays held by memoized
+      datasets. Datasets larger than this are not memoized.
+    """
+    with _memo_lock:
+        if maxsize is not None:
+            _memo_limits['maxsize'] = int(maxsize)
+        if max_bytes is not None:
+            _memo_limits['max_bytes'] = int(max_bytes)
+        _memo_evict()
+
+
+def clear_grid_memo(grid_name=None):
+    """Evict grid datasets from the in-process memo.
+
+    Parameters
+    ----------
+
+    grid_name : str, optional
+      Evict only datasets for this grid. If `None`, evict all.
+    """
+    with _memo_lock:
+        for key in list(_memo):
+            if grid_name is None or key[0] == grid_name:
+                del _memo[key]
+
+
+def grid_memo_info():
+    """Return statistics on the in-process memo of grid datasets."""
+    with _memo_lock:
+        return {
+            'entries': list(_memo),
+            'nbytes': sum(entry[1] for entry in _memo.values()),
+            'maxsize': _memo_limits['maxsize'],
+            'max_bytes': _memo_limits['max_bytes'],
+            'hits': _memo_stats['hits'],
+            'misses': _memo_stats['misses'],
+        }
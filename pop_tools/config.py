@@ -1,11 +1,14 @@
 """Configuration for pop-tools"""
 
+import hashlib
+import json
 import os
+import re
+import tempfile
+import threading
+from collections.abc import Mapping
 from subprocess import PIPE, Popen
 
-import jinja2
-import yaml
-
 package_dir = os.path.dirname(__file__)
 
 inputdata_repo = 'https://svn-ccsm-inputdata.cgd.ucar.edu/trunk/inputdata'
@@ -20,9 +23,37 @@ else:
 INPUT_TEMPLATES = os.path.join(package_dir, 'input_templates')
 grid_def_file = os.path.join(package_dir, 'pop_grid_definitions.yaml')
 
+GRID_CACHE_DIR = os.environ.get(
+    'POP_TOOLS_GRID_CACHE', os.path.join(os.path.expanduser('~'), '.pop_tools', 'grid_cache')
+)
+
+
+_placeholder = re.compile(r'{{\s*(\w+)\s*}}')
+
+
+def render_template(template, **context):
+    """Render a jinja2 template string.
+
+    Templates consisting only of plain `{{ NAME }}` placeholders are
+    rendered without importing jinja2.
+    """
+    remainder = _placeholder.sub('', template)
+    if '{{' in remainder or '{%' in remainder or '{#' in remainder:
+        import jinja2
+
+        return jinja2.Template(template).render(**context)
+
+    rendered = _placeholder.sub(lambda m: str(context.get(m.group(1), '')), template)
+    # as jinja2, drop a single trailing newline
+    if rendered.endswith('\n'):
+        rendered = rendered[:-1]
+    return rendered
+
 
 def gen_grid_defs(grid_def_file):
     """Read grid pop_grid_definitions file."""
+    import yaml
+
     with open(grid_def_file) as f:
         grid_defs = yaml.safe_load(f)
 
@@ -31,14 +62,60 @@ def gen_grid_defs(grid_def_file):
         for k, v in grid_attrs.items():
             if not isinstance(v, str):
                 continue
-            template = jinja2.Template(v)
-            grid_attrs[k] = template.render(INPUTDATA=INPUTDATA, INPUT_TEMPLATES=INPUT_TEMPLATES)
+            grid_attrs[k] = render_template(v, INPUTDATA=INPUTDATA, INPUT_TEMPLATES=INPUT_TEMPLATES)
+    return grid_defs
+
+
+def _compiled_grid_defs_path(grid_def_file):
+    """Path of the compiled form of a grid definitions file.
+
+    The name is keyed on the file's path, size and mtime and on the values
+    of `INPUTDATA` and `INPUT_TEMPLATES`.
+    """
+    stat = os.stat(grid_def_file)
+    key = json.dumps(
+        [os.path.abspath(grid_def_file), stat.st_size, stat.st_mtime_ns, INPUTDATA, INPUT_TEMPLATES]
+    )
+    digest = hashlib.sha256(key.encode()).hexdigest()[:24]
+    return os.path.join(os.path.expanduser(GRID_CACHE_DIR), 'grid_defs', f'{digest}.json')
+
+
+def compile_grid_defs(grid_def_file):
+    """Return rendered grid definitions, using a compiled copy when current.
+
+    The first call for a given definitions file and `INPUTDATA` and
+    `INPUT_TEMPLATES` values parses and renders the YAML file with
+    `gen_grid_defs` and stores the result as JSON under `GRID_CACHE_DIR`;
+    later calls (in any process) read the JSON.
+    """
+    compiled_path = _compiled_grid_defs_path(grid_def_file)
+    try:
+        with open(compiled_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    grid_defs = gen_grid_defs(grid_def_file)
+    try:
+        os.makedirs(os.path.dirname(compiled_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(compiled_path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(grid_defs, f)
+        os.replace(tmp_path, compiled_path)
+    except OSError:
+        # the compiled copy is an optimization only
+        pass
     return grid_defs
 
 
 def inputdata_relpath(file_fullpath):
-    """Return part of path following /path/to/inputdata/"""
+    """Return part of path following /path/to/inputdata/
+
+    `None` if the path is not in an inputdata tree.
+    """
     fullpath_list = file_fullpath.split('/')
+    if 'inputdata' not in fullpath_list:
+        return None
     ndx = fullpath_list.index('inputdata')
     return '/'.join(fullpath_list[ndx + 1 :])
 
@@ -63,25 +140,162 @@ def svn_export(repo_path, local_path):
         raise Exception('svn error')
 
 
-def ensure_inputdata():
-    """Checkout necessary files from inputdata."""
+indat_grid_file_keys = ['horiz_grid_fname', 'topography_fname', 'region_mask_fname']
 
-    if not os.path.exists(INPUTDATA):
-        if not os.path.isdir(INPUTDATA):
-            os.makedirs(INPUTDATA)
+# source used by `ensure_inputdata`; an object with a `fetch(relpath, dest)`
+# method (see `pop_tools.fetch`). If `None`, files are fetched with `svn export`.
+inputdata_source = None
 
-    indat_grid_file_keys = ['horiz_grid_fname', 'topography_fname', 'region_mask_fname']
+# grids for which inputdata files have been checked in this process
+_inputdata_checked = set()
+
+
+def _in_shared_inputdata(path):
+    """Return `True` if `path` is in the shared `inputdata_local` tree."""
+    path = os.path.abspath(path)
+    return os.path.commonpath([path, inputdata_local]) == inputdata_local
+
+
+def ensure_inputdata(grid_name=None):
+    """Checkout necessary files from inputdata.
+
+    Files that are missing, or whose size does not match the grid
+    dimensions, are fetched from `inputdata_source`. Only sizes are
+    checked; to also verify sha256 digests, use
+    `pop_tools.fetch.fetch_inputdata` with a `manifest`. Files in the
+    shared, read-only `inputdata_local` tree are never fetched; an error
+    is raised if they are missing or have the wrong size.
+
+    Parameters
+    ----------
+
+    grid_name : str or list of str, optional
+      Grid(s) for which to checkout files. If `None`, all grids in
+      `grid_defs`.
+    """
+    from .fetch import check_file, fetch_files, inputdata_files
+
+    if grid_name is None:
+        grid_name = list(grid_defs.keys())
+    elif isinstance(grid_name, str):
+        grid_name = [grid_name]
+
+    pending = [grid for grid in grid_name if grid not in _inputdata_checked]
+    if pending:
+        files = inputdata_files(pending)
+        shared = [
+            f['dest']
+            for f in files
+            if _in_shared_inputdata(f['dest']) and not check_file(f['dest'], f.get('size'))
+        ]
+        if shared:
+            msg = '\n'.join(f'  {dest}' for dest in shared)
+            raise RuntimeError(
+                f'inputdata files in the shared tree {inputdata_local} are missing or have '
+                f'the wrong size, and cannot be fetched there:\n{msg}'
+            )
+        fetch_files(files, source=inputdata_source)
+        _inputdata_checked.update(pending)
+
+
+class GridRegistry(Mapping):
+    """Grid definitions, compiled from YAML files on first access.
+
+    The definitions are recompiled if `INPUTDATA` or `INPUT_TEMPLATES`
+    change; see `compile_grid_defs`. Memoized datasets and inputdata checks
+    of grids whose definitions change are discarded.
+
+    Parameters
+    ----------
+
+    grid_def_files : list of str
+      YAML grid definitions files; grids in later files take precedence.
+    """
+
+    def __init__(self, grid_def_files):
+        self._files = list(grid_def_files)
+        self._compiled = {}
+        self._key = None
+        self._grid_defs = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        grid_defs = self._grid_defs
+        if grid_defs is None or self._key != (INPUTDATA, INPUT_TEMPLATES):
+            grid_defs = self._reload()
+        return grid_defs
+
+    def _reload(self):
+        """Recompile the definitions, forgetting grids whose definitions change."""
+        with self._lock:
+            key = (INPUTDATA, INPUT_TEMPLATES)
+            if self._key != key:
+                self._compiled = {}
+            previous = self._grid_defs
+            grid_defs = {}
+            for grid_def_file in self._files:
+                if grid_def_file not in self._compiled:
+                    self._compiled[grid_def_file] = compile_grid_defs(grid_def_file)
+                grid_defs.update(self._compiled[grid_def_file])
+            if previous is not None:
+                _forget_grids(
+                    name
+                    for name in set(grid_defs) | set(previous)
+                    if grid_defs.get(name) != previous.get(name)
+                )
+            self._grid_defs, self._key = grid_defs, key
+        return grid_defs
+
+    def register(self, grid_def_file):
+        """Add the grids defined in a YAML file.
+
+        The file has the format of `pop_grid_definitions.yaml`; its grids
+        take precedence over those already registered.
+        """
+        grid_def_file = os.path.abspath(grid_def_file)
+        with self._lock:
+            if grid_def_file in self._files:
+                self._files.remove(grid_def_file)
+                self._compiled.pop(grid_def_file, None)
+            self._files.append(grid_def_file)
+            # definitions not loaded yet are compiled on first access
+            if self._grid_defs is not None:
+                self._reload()
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+def _forget_grids(grid_names):
+    """Discard the memoized datasets and inputdata checks of grids."""
+    from .cache import clear_grid_memo
+
+    for grid_name in grid_names:
+        clear_grid_memo(grid_name)
+        _inputdata_checked.discard(grid_name)
 
-    for grid, grid_attrs in grid_defs.items():
 
-        for key, val in grid_attrs.items():
+def register_grids(grid_def_file):
+    """Register grids defined in a YAML file with `pop_tools.grid_defs`.
 
-            if key in indat_grid_file_keys and not os.path.lexists(val):
-                os.makedirs(os.path.dirname(val), exist_ok=True)
+    Parameters
+    ----------
 
-                repo_path = f'{inputdata_repo}/{inputdata_relpath(val)}'
-                svn_export(repo_path, val)
+    grid_def_file : str
+      Path to a file with the format of `pop_grid_definitions.yaml`; string
+      values may use the `{{INPUTDATA}}` and `{{INPUT_TEMPLATES}}`
+      placeholders.
+    """
+    grid_defs.register(grid_def_file)
 
 
-grid_defs = gen_grid_defs(grid_def_file)
-ensure_inputdata()
+grid_defs = GridRegistry([grid_def_file])
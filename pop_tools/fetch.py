@@ -0,0 +1,268 @@
+"""Retrieval of grid files from the CESM inputdata repository."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+
+
+class SVNSource(object):
+    """Fetch files with `svn export` from a subversion repository.
+
+    Parameters
+    ----------
+
+    repo : str, optional
+      Repository URL; default is `pop_tools.config.inputdata_repo`.
+    """
+
+    def __init__(self, repo=None):
+        self.repo = repo or config.inputdata_repo
+
+    def fetch(self, relpath, dest):
+        config.svn_export(f'{self.repo}/{relpath}', dest)
+
+
+class HTTPSource(object):
+    """Fetch files over HTTP(S).
+
+    Parameters
+    ----------
+
+    url : str, optional
+      Base URL under which files are found at their inputdata relative
+      path; default is `pop_tools.config.inputdata_repo`.
+
+    timeout : float, optional
+      Timeout in seconds for each request.
+    """
+
+    def __init__(self, url=None, timeout=60):
+        self.url = url or config.inputdata_repo
+        self.timeout = timeout
+
+    def fetch(self, relpath, dest):
+        with urllib.request.urlopen(f'{self.url}/{relpath}', timeout=self.timeout) as response:
+            with open(dest, 'wb') as f:
+                shutil.copyfileobj(response, f, 1 << 20)
+
+
+class LocalMirrorSource(object):
+    """Copy files from a local directory laid out like inputdata.
+
+    Parameters
+    ----------
+
+    root : str
+      Path to the mirror (the directory corresponding to `inputdata`).
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def fetch(self, relpath, dest):
+        shutil.copyfile(os.path.join(self.root, relpath), dest)
+
+
+def sha256sum(path):
+    """Return the sha256 digest of a file."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def check_file(path, size=None, sha256=None):
+    """Return `True` if `path` exists and matches the expected size and digest."""
+    if not os.path.isfile(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if sha256 is not None and sha256sum(path) != sha256:
+        return False
+    return True
+
+
+def _fetch_file(source, relpath, dest, size=None, sha256=None):
+    """Fetch one file to a temporary path, verify it, and move it into place."""
+    dest_dir = os.path.dirname(dest)
+    os.makedirs(dest_dir, exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(dir=dest_dir, prefix='.fetch-')
+    try:
+        tmp_path = os.path.join(tmp_dir, os.path.basename(dest))
+        source.fetch(relpath, tmp_path)
+        if not check_file(tmp_path, size, sha256):
+            raise OSError(f'fetched file failed integrity check: {relpath}')
+        os.replace(tmp_path, dest)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def fetch_files(files, source=None, max_workers=4):
+    """Fetch files that are missing or fail integrity checks.
+
+    Files are fetched concurrently, each to a temporary file that is
+    verified and atomically renamed, so an interrupted fetch never leaves
+    a partial file in place; rerunning fetches only what is still missing.
+
+    Parameters
+    ----------
+
+    files : list of dict
+      Each with keys `relpath` (path relative to inputdata), `dest` (local
+      path) and, optionally, `size` (bytes) and `sha256`.
+
+    source : object, optional
+      Object with a `fetch(relpath, dest)` method, e.g. `SVNSource`,
+      `HTTPSource` or `LocalMirrorSource`. Default is `SVNSource()`.
+
+    max_workers : int, optional
+      Number of concurrent fetches.
+
+    Returns
+    -------
+
+    fetched : list of str
+      Local paths of the files that were fetched.
+    """
+    if source is None:
+        source = SVNSource()
+
+    todo = [f for f in files if not check_file(f['dest'], f.get('size'), f.get('sha256'))]
+    if not todo:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _fetch_file, source, f['relpath'], f['dest'], f.get('size'), f.get('sha256')
+            )
+            for f in todo
+        ]
+
+    errors = [(f['relpath'], future.exception()) for f, future in zip(todo, futures)]
+    errors = [(relpath, exc) for relpath, exc in errors if exc is not None]
+    if errors:
+        msg = '\n'.join(f'  {relpath}: {exc}' for relpath, exc in errors)
+        raise RuntimeError(f'failed to fetch inputdata files:\n{msg}') from errors[0][1]
+
+    return [f['dest'] for f in todo]
+
+
+def _read_manifest(manifest):
+    if manifest is None:
+        return {}
+    if isinstance(manifest, str):
+        import yaml
+
+        with open(manifest) as f:
+            return yaml.safe_load(f) or {}
+    return manifest
+
+
+def inputdata_files(grid_name=None, manifest=None):
+    """Return the inputdata files required by grids, with expected sizes.
+
+    Sizes are derived from the grid dimensions; digests are taken from
+    `manifest` where available. Files outside an inputdata tree, e.g. of
+    grids added with `pop_tools.register_grids`, cannot be fetched; they
+    are omitted, and must exist locally.
+
+    Parameters
+    ----------
+
+    grid_name : str or list of str, optional
+      Grid(s); default is all grids in `pop_tools.grid_defs`.
+
+    manifest : dict or str, optional
+      Mapping (or path to a YAML file mapping) inputdata relative paths to
+      dicts with `size` and/or `sha256` keys.
+
+    Returns
+    -------
+
+    files : list of dict
+      Input for `fetch_files`.
+    """
+    if grid_name is None:
+        grid_name = list(config.grid_defs.keys())
+    elif isinstance(grid_name, str):
+        grid_name = [grid_name]
+    manifest = _read_manifest(manifest)
+
+    files = {}
+    for grid in grid_name:
+        grid_attrs = config.grid_defs[grid]
+        nlat, nlon = grid_attrs['lateral_dims']
+        sizes = {
+            'horiz_grid_fname': 7 * nlat * nlon * 8,
+            'topography_fname': nlat * nlon * 4,
+            'region_mask_fname': nlat * nlon * 4,
+        }
+        for key in config.indat_grid_file_keys:
+            dest = grid_attrs[key]
+            relpath = config.inputdata_relpath(dest)
+            if relpath is None:
+                if not os.path.exists(dest):
+                    raise FileNotFoundError(
+                        f'{key} of grid {grid} is not in inputdata and does not exist: {dest}'
+                    )
+                continue
+            entry = {'relpath': relpath, 'dest': dest, 'size': sizes[key]}
+            entry.update(manifest.get(relpath, {}))
+            files[dest] = entry
+    return list(files.values())
+
+
+def make_manifest(grid_name=None):
+    """Return a manifest of sizes and digests of local inputdata grid files.
+
+    Parameters
+    ----------
+
+    grid_name : str or list of str, optional
+      Grid(s); default is all grids in `pop_tools.grid_defs`.
+    """
+    manifest = {}
+    for f in inputdata_files(grid_name):
+        manifest[f['relpath']] = {
+            'size': os.path.getsize(f['dest']),
+            'sha256': sha256sum(f['dest']),
+        }
+    return manifest
+
+
+def fetch_inputdata(grid_name=None, source=None, manifest=None, max_workers=4):
+    """Fetch inputdata grid files that are missing or fail integrity checks.
+
+    Parameters
+    ----------
+
+    grid_name : str or list of str, optional
+      Grid(s) for which to fetch files; default is all grids in
+      `pop_tools.grid_defs`.
+
+    source : object, optional
+      Object with a `fetch(relpath, dest)` method, e.g. `SVNSource`,
+      `HTTPSource` or `LocalMirrorSource`. Default is `SVNSource()`.
+
+    manifest : dict or str, optional
+      Mapping (or path to a YAML file mapping) inputdata relative paths to
+      dicts with `size` and/or `sha256` keys used to verify files.
+
+    max_workers : int, optional
+      Number of concurrent fetches.
+
+    Returns
+    -------
+
+    fetched : list of str
+      Local paths of the files that were fetched.
+    """
+    return fetch_files(inputdata_files(grid_name, manifest), source, max_workers)
@@ -1,9 +1,25 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numba
 import numpy as np
 import xarray as xr
-from numba import jit
+from numba import jit, prange
 
 
-def lateral_fill(da_in, isvalid_mask, ltripole=False, tol=1.0e-4):
+def lateral_fill(
+    da_in,
+    isvalid_mask,
+    ltripole=False,
+    tol=1.0e-4,
+    method='jacobi',
+    max_iter=None,
+    time_budget=None,
+    diagnostics=False,
+):
     """Perform lateral fill on xarray.DataArray
 
     Parameters
@@ -11,7 +27,9 @@ def lateral_fill(da_in, isvalid_mask, ltripole=False, tol=1.0e-4):
     da_in : xarray.DataArray
       DataArray on which to fill NaNs. Fill is performed on the two
       rightmost dimenions. Grid is assumed periodic in `x` direction
-      (last dimension).
+      (last dimension). Dask-backed inputs are filled lazily, one block
+      per chunk of the leading dimensions; the lateral dimensions are
+      rechunked to a single chunk.
 
     isvalid_mask : xarray.DataArray, boolean
       Valid values mask: `True` where data should be filled. Must have the
@@ -25,45 +43,270 @@ def lateral_fill(da_in, isvalid_mask, ltripole=False, tol=1.0e-4):
       Convergence criteria: stop filling when values change is less or equal
       to `tol * var`; i.e. `delta <= tol * np.abs(var[j, i])`.
 
+    method : str, optional [default='jacobi']
+      Solver, one of 'jacobi', 'active_set', 'sor', 'redblack',
+      'multigrid' and 'sparse'. 'jacobi' is the original POP smoother;
+      'active_set' is the same smoother visiting only the points still
+      changing, and their neighbors, in each iteration; 'sor' is
+      successive over-relaxation; 'redblack' is red-black Gauss-Seidel
+      (with over-relaxation), parallel within each slice; 'multigrid'
+      fills a hierarchy of coarsened grids first and uses each result as
+      the initial guess on the next finer grid, converging on the original
+      grid with the red-black solver. All solve the same problem, with the
+      same boundary handling and convergence criterion; as `tol` bounds
+      the relative change of an iteration, not the error, results of
+      different methods can differ by much more than `tol`, with 'jacobi'
+      the least accurate at a given `tol`. 'sparse' solves for the
+      converged solution directly, with a sparse LU factorization shared
+      by all slices with the same NaN pattern and cached across calls
+      (`tol` is not used); it requires `scipy`.
+
+    max_iter : int, optional
+      Maximum number of iterations of each slice; default is no limit.
+
+    time_budget : float, optional
+      Wall-clock time limit, in seconds, for filling all slices (of each
+      block, for dask-backed inputs); default is no limit. Slices that
+      have not converged when `max_iter` or the budget is spent are
+      returned partially filled. The solver is compiled, on first use,
+      before the budget starts.
+
+    diagnostics : boolean, optional [default=False]
+      If `True`, also return per-slice diagnostics. Slices are then filled
+      one at a time, so that their times are their own.
+
     Returns
     -------
     da_out : xarray.DataArray
       DataArray with NaNs filled by iterative smoothing.
 
+    diagnostics : xarray.Dataset
+      Only if `diagnostics` is `True`: `iterations`, `converged`,
+      `max_residual` (the largest relative change the next iteration
+      would make, to compare with `tol`), `cells_filled` and `elapsed`
+      (seconds) of each slice, with the non-lateral dimensions of `da_in`.
+
     """
 
     dims_in = da_in.dims
-    non_lateral_dims = dims_in[:-2]
 
     attrs = da_in.attrs
     encoding = da_in.encoding
     coords = da_in.coords
 
-    da_in, isvalid_mask = xr.broadcast(da_in, isvalid_mask)
-
-    if len(non_lateral_dims) > 0:
-        da_in_stack = da_in.stack(non_lateral_dims=non_lateral_dims)
-        da_out_stack = xr.full_like(da_in_stack, fill_value=np.nan)
-        isvalid_mask_stack = isvalid_mask.stack(non_lateral_dims=non_lateral_dims)
-        for i in range(da_in_stack.shape[-1]):
-            arr = da_in_stack.data[:, :, i]
-            da_out_stack[:, :, i] = lateral_fill_np_array(arr, isvalid_mask_stack.data[:, :, i])
-
-        da_out = da_out_stack.unstack('non_lateral_dims').transpose(*dims_in)
+    kwargs = {
+        'ltripole': ltripole,
+        'tol': tol,
+        'method': method,
+        'max_iter': max_iter,
+        'time_budget': time_budget,
+        'diagnostics': diagnostics,
+    }
 
+    if da_in.chunks is not None or isvalid_mask.chunks is not None:
+        da_out = _lateral_fill_dask(da_in, isvalid_mask, kwargs)
+        if diagnostics:
+            da_out, *stats = da_out
+        da_out = da_out.transpose(*dims_in)
     else:
-        da_out = xr.full_like(da_in, fill_value=np.nan)
-        da_out[:, :] = lateral_fill_np_array(da_in.data, isvalid_mask.data)
+        da_in, isvalid_mask = xr.broadcast(da_in, isvalid_mask)
+
+        # all slices along the non-lateral dimensions are filled in one call
+        filled = _lateral_fill(da_in.data, isvalid_mask.transpose(*da_in.dims).data, **kwargs)
+        if diagnostics:
+            filled, *stats = filled
+            lead_dims = da_in.dims[:-2]
+            stats = [
+                xr.DataArray(
+                    x,
+                    dims=lead_dims,
+                    coords={k: v for k, v in da_in.coords.items() if set(v.dims) <= set(lead_dims)},
+                )
+                for x in stats
+            ]
+        da_out = da_in.copy(data=filled).transpose(*dims_in)
 
     da_out.attrs = attrs
     da_out.encoding = encoding
     for k, da in coords.items():
         da_out[k].attrs = da.attrs
 
+    if diagnostics:
+        return da_out, _diagnostics_dataset(stats)
     return da_out
 
 
-def lateral_fill_np_array(var, isvalid_mask, ltripole=False, tol=1.0e-4):
+def lateral_fill_to_zarr(
+    da_in,
+    isvalid_mask,
+    store,
+    dim=None,
+    batch_size=1,
+    resume=True,
+    ltripole=False,
+    tol=1.0e-4,
+    method='jacobi',
+    max_iter=None,
+    time_budget=None,
+):
+    """Perform lateral fill on a large DataArray, streaming it into a zarr store
+
+    The DataArray is read, filled and written in batches along one
+    dimension, so that peak memory is set by the batch size and not by the
+    length of that dimension. Progress is recorded in the store after each
+    batch, so that an interrupted fill can be resumed.
+
+    Parameters
+    ----------
+
+    da_in : xarray.DataArray
+      DataArray on which to fill NaNs, typically opened lazily from zarr
+      or netCDF files (e.g. with `xarray.open_zarr` or
+      `xarray.open_mfdataset`). Fill is performed on the two rightmost
+      dimenions.
+
+    isvalid_mask : xarray.DataArray, boolean
+      Valid values mask: `True` where data should be filled. Must have the
+      same rightmost dimenions as `da_in`.
+
+    store : str
+      Path of the output zarr store.
+
+    dim : str, optional
+      Dimension along which to stream; default is the first dimension of
+      `da_in`.
+
+    batch_size : int, optional [default=1]
+      Number of elements along `dim` read, filled (in parallel) and
+      written together; also the chunk size of the output along `dim`.
+
+    resume : boolean, optional [default=True]
+      If `True` and `store` exists, only fill the batches not yet written
+      to it; the store must hold a fill of data of the same shape with the
+      same `dim` and `batch_size`. If `False`, overwrite `store`.
+
+    ltripole, tol, method, max_iter, time_budget : optional
+      See `lateral_fill`; `time_budget` applies to each batch.
+
+    Returns
+    -------
+
+    da_out : xarray.DataArray
+      Filled DataArray, opened lazily from `store`.
+
+    """
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError('lateral_fill_to_zarr requires zarr')
+
+    if dim is None:
+        dim = da_in.dims[0]
+    if dim not in da_in.dims[:-2]:
+        raise ValueError(f'dim must be one of the non-lateral dimensions {da_in.dims[:-2]}')
+    name = da_in.name if da_in.name is not None else 'filled'
+    size = da_in.sizes[dim]
+    progress = {'dim': dim, 'batch_size': batch_size, 'shape': list(da_in.shape)}
+
+    if resume and os.path.isdir(store):
+        saved = zarr.open_group(store, mode='r').attrs.get(_fill_progress_attr)
+        if saved is None or {key: saved.get(key) for key in progress} != progress:
+            raise ValueError(
+                f'{store} does not hold a fill of this data with dim={dim!r} and '
+                f'batch_size={batch_size}; use resume=False to overwrite it'
+            )
+        done = set(saved['done'])
+    else:
+        # write the metadata and the coordinates; data are written batch by batch
+        chunks = {d: batch_size if d == dim else 1 for d in da_in.dims[:-2]}
+        chunks.update({d: -1 for d in da_in.dims[-2:]})
+        template = da_in.chunk(chunks).to_dataset(name=name)
+        for variable in template.variables.values():
+            variable.encoding = {}
+        template.to_zarr(store, mode='w', compute=False)
+        done = set()
+
+    # record the progress before the first batch, so that a fill interrupted
+    # at any point can be resumed
+    group = zarr.open_group(store, mode='r+')
+    group.attrs[_fill_progress_attr] = dict(progress, done=sorted(done))
+    if dim not in isvalid_mask.dims:
+        isvalid_mask = isvalid_mask.load()
+
+    for batch in range(-(-size // batch_size)):
+        if batch in done:
+            continue
+        region = {dim: slice(batch * batch_size, min((batch + 1) * batch_size, size))}
+        batch_mask = isvalid_mask.isel(region) if dim in isvalid_mask.dims else isvalid_mask
+        filled = lateral_fill(
+            da_in.isel(region).load(),
+            batch_mask.load(),
+            ltripole=ltripole,
+            tol=tol,
+            method=method,
+            max_iter=max_iter,
+            time_budget=time_budget,
+        )
+
+        ds = filled.to_dataset(name=name)
+        ds = ds.drop_vars([k for k, v in ds.variables.items() if dim not in v.dims])
+        for variable in ds.variables.values():
+            variable.encoding = {}
+        ds.to_zarr(store, region=region)
+
+        done.add(batch)
+        group.attrs[_fill_progress_attr] = dict(progress, done=sorted(done))
+
+    return xr.open_zarr(store)[name]
+
+
+# store attribute recording the progress of `lateral_fill_to_zarr`
+_fill_progress_attr = 'lateral_fill_progress'
+
+
+def _lateral_fill_dask(da_in, isvalid_mask, kwargs):
+    """Fill dask-backed DataArrays lazily, block by block.
+
+    Blocks span the lateral dimensions; leading dimensions keep their
+    chunks, to which the mask is aligned.
+    """
+    lateral_dims = list(da_in.dims[-2:])
+    da_in = da_in.chunk({dim: -1 for dim in lateral_dims})
+    chunks = dict(zip(da_in.dims, da_in.chunks))
+    isvalid_mask = isvalid_mask.chunk(
+        {dim: chunks[dim] for dim in isvalid_mask.dims if dim in chunks}
+    )
+
+    output_core_dims = [lateral_dims]
+    output_dtypes = [da_in.dtype]
+    if kwargs['diagnostics']:
+        output_core_dims += [[]] * len(_diagnostics_attrs)
+        output_dtypes += _diagnostics_dtypes
+
+    return xr.apply_ufunc(
+        _lateral_fill,
+        da_in,
+        isvalid_mask,
+        input_core_dims=[lateral_dims, lateral_dims],
+        output_core_dims=output_core_dims,
+        dask='parallelized',
+        output_dtypes=output_dtypes,
+        kwargs=kwargs,
+    )
+
+
+def lateral_fill_np_array(
+    var,
+    isvalid_mask,
+    ltripole=False,
+    tol=1.0e-4,
+    method='jacobi',
+    max_iter=None,
+    time_budget=None,
+    diagnostics=False,
+    out=None,
+    work=None,
+):
     """Perform lateral fill on numpy.array
 
     Parameters
@@ -71,12 +314,13 @@ def lateral_fill_np_array(var, isvalid_mask, ltripole=False, tol=1.0e-4):
 
     var : numpy.array
       Array on which to fill NaNs. Fill is performed on the two
-      rightmost dimenions. Grid is assumed periodic in `x` direction
-      (last dimension).
+      rightmost dimenions; slices along any leading dimensions are filled
+      in parallel. Grid is assumed periodic in `x` direction (last
+      dimension).
 
     isvalid_mask : numpy.array, boolean
-      Valid values mask: `True` where data should be filled. Must have the
-      same rightmost dimenions as `da_in`.
+      Valid values mask: `True` where data should be filled. Must be
+      broadcastable to the shape of `var`.
 
     ltripole : boolean, optional [default=False]
       Logical flag; if `True` then treat the top row of the grid as periodic
@@ -86,100 +330,1168 @@ def lateral_fill_np_array(var, isvalid_mask, ltripole=False, tol=1.0e-4):
       Convergence criteria: stop filling when values change is less or equal
       to `tol * var`; i.e. `delta <= tol * np.abs(var[j, i])`.
 
+    method : str, optional [default='jacobi']
+      Solver; see `lateral_fill`.
+
+    max_iter : int, optional
+      Maximum number of iterations of each slice; default is no limit.
+
+    time_budget : float, optional
+      Wall-clock time limit, in seconds, for filling all slices;
+      default is no limit. Slices that have not converged when
+      `max_iter` or the budget is spent are returned partially filled.
+      The solver is compiled, on first use, before the budget starts.
+
+    diagnostics : boolean, optional [default=False]
+      If `True`, also return per-slice diagnostics. Slices are then filled
+      one at a time, so that their times are their own.
+
+    out : numpy.array, optional
+      C-contiguous array with the shape of `var` in which to return the
+      result, e.g. `var` itself to fill in place. By default a copy of
+      `var` with the same dtype is returned. NaNs are filled directly and
+      slices are processed in blocks with work arrays reused from block
+      to block, sized to a small fraction of `var` (but at least one
+      slice), so no other full-size temporaries are allocated.
+
+    work : numpy.array, optional
+      C-contiguous work array of shape (`nblock`, `nlat`, `nlon`) with the
+      dtype of `var`, to reuse across calls; slices are then filled
+      `nblock` at a time. By default work arrays are allocated for each
+      call.
+
     Returns
     -------
 
-    da_out : xarray.DataArray
-      DataArray with NaNs filled by iterative smoothing.
+    var_out : numpy.array
+      Array with NaNs filled by iterative smoothing; `out` if given.
+
+    diagnostics : xarray.Dataset
+      Only if `diagnostics` is `True`: per-slice diagnostics as returned
+      by `lateral_fill`, with dimensions `dim_0`, `dim_1`, ... for the
+      leading dimensions of `var`.
+
+    """
+    result = _lateral_fill(
+        var,
+        isvalid_mask,
+        ltripole,
+        tol,
+        method,
+        max_iter,
+        time_budget,
+        diagnostics,
+        out=out,
+        work=work,
+    )
+    if not diagnostics:
+        return result
+
+    dims = tuple(f'dim_{k}' for k in range(result[0].ndim - 2))
+    return result[0], _diagnostics_dataset([xr.DataArray(x, dims=dims) for x in result[1:]])
+
+
+def _lateral_fill(
+    var,
+    isvalid_mask,
+    ltripole,
+    tol,
+    method,
+    max_iter,
+    time_budget,
+    diagnostics,
+    out=None,
+    work=None,
+):
+    """Fill a numpy array; return it, followed by the diagnostics arrays if `diagnostics`."""
+    if method not in fill_methods:
+        raise ValueError(f'Unknown method: {method}; please select from {fill_methods}')
+    if max_iter is not None and max_iter < 1:
+        raise ValueError(f'max_iter must be at least 1, got {max_iter}')
+
+    var = np.asarray(var)
+    if out is None:
+        out = np.array(var, order='C')
+    elif out.shape != var.shape or not out.flags.c_contiguous:
+        raise ValueError(f'out must be a C-contiguous array of shape {var.shape}')
+    elif out is not var:
+        np.copyto(out, var)
+
+    stats = _fill_slices(
+        out,
+        isvalid_mask,
+        tol,
+        ltripole,
+        method,
+        max_iter=max_iter,
+        time_budget=time_budget,
+        diagnostics=diagnostics,
+        work=work,
+    )
+
+    if not diagnostics:
+        return out
+    return (out,) + tuple(x.reshape(var.shape[:-2]) for x in stats)
+
+
+_diagnostics_attrs = {
+    'iterations': {'long_name': 'Number of iterations'},
+    'converged': {'long_name': 'Convergence criterion met'},
+    'max_residual': {'long_name': 'Largest relative change of the next iteration'},
+    'cells_filled': {'long_name': 'Number of points filled'},
+    'elapsed': {'long_name': 'Wall-clock time', 'units': 's'},
+}
+_diagnostics_dtypes = [np.int64, bool, np.float64, np.int64, np.float64]
+
+
+def _diagnostics_dataset(stats):
+    """Return the Dataset of the per-slice diagnostics DataArrays, in order."""
+    ds = xr.Dataset(dict(zip(_diagnostics_attrs, stats)))
+    for name, attrs in _diagnostics_attrs.items():
+        ds[name].attrs = attrs
+    return ds
+
+
+class FillPlan(object):
+    """Precomputed lateral fill of a fixed set of points.
+
+    The points to fill, their neighbors (with the periodic-x and tripole
+    boundary handling of `lateral_fill`) and the neighbor tables of the
+    active-set smoother (`method='active_set'`) are computed once, so that
+    many fields sharing the same NaN pattern and `isvalid_mask`, e.g. the
+    time steps of a simulation, can be filled without recomputing them.
+
+    Parameters
+    ----------
+
+    fillmask : numpy.ndarray, boolean
+      `True` at the points to fill, e.g. `np.isnan(var) & isvalid_mask`.
+      Fill is performed on the two rightmost dimensions; leading
+      dimensions (e.g. `z_t`, for masks below `KMT`) are planned slice by
+      slice.
+
+    ltripole : boolean, optional [default=False]
+      Logical flag; if `True` then treat the top row of the grid as periodic
+      in the sense of a tripole grid.
 
+    tol : float, optional [default=1.0e-4]
+      Convergence criteria: stop filling when values change is less or equal
+      to `tol * var`; i.e. `delta <= tol * np.abs(var[j, i])`.
+    """
+
+    def __init__(self, fillmask, ltripole=False, tol=1.0e-4):
+        fillmask = np.asarray(fillmask, dtype=bool)
+        if fillmask.ndim < 2:
+            raise ValueError(f'fillmask must have at least 2 dimensions, got {fillmask.shape}')
+        self.shape = fillmask.shape
+        self.ltripole = ltripole
+        self.tol = tol
+
+        nlat, nlon = self.shape[-2:]
+        cells, neighbors, neighbor_cells = [], [], []
+        for mask in fillmask.reshape((-1, nlat, nlon)):
+            c, n = _fill_neighbors(np.ascontiguousarray(mask), ltripole)
+            cells.append(c)
+            neighbors.append(n)
+            neighbor_cells.append(_neighbor_cells(c, n, nlat * nlon))
+        self._cells = np.concatenate(cells)
+        self._neighbors = np.concatenate(neighbors)
+        self._neighbor_cells = np.concatenate(neighbor_cells)
+        self._offsets = np.concatenate(([0], np.cumsum([len(c) for c in cells])))
+        self._previous = None
+
+    @classmethod
+    def from_array(cls, var, isvalid_mask, ltripole=False, tol=1.0e-4):
+        """Return the `FillPlan` of the NaN points of `var` where `isvalid_mask` is `True`."""
+        return cls(np.isnan(var) & isvalid_mask, ltripole=ltripole, tol=tol)
+
+    @property
+    def size(self):
+        """Number of points to fill."""
+        return int(self._offsets[-1])
+
+    def fill(self, var, warm_start=False):
+        """Fill a batch of fields.
+
+        Parameters
+        ----------
+
+        var : numpy.ndarray
+          Fields to fill, with trailing dimensions matching the plan's
+          `fillmask`; slices along any leading dimensions are filled in
+          parallel. Values at the planned points are ignored; other NaN
+          values are left unfilled.
+
+        warm_start : boolean, optional [default=False]
+          If `True`, start each field from the solution of the previous
+          field in the batch (or, for the first field, of the last field
+          filled with this plan), instead of from scratch. Warm starts
+          converge in fewer iterations when consecutive fields are similar;
+          the results differ from a cold start by about as much as either
+          differs from the fully converged solution.
+
+        Returns
+        -------
+
+        filled : numpy.ndarray
+          Copy of `var` with the planned points filled.
+        """
+        ndim = len(self.shape)
+        if var.ndim < ndim or var.shape[-ndim:] != self.shape:
+            raise ValueError(
+                f'trailing dimensions of var {var.shape} do not match the plan {self.shape}'
+            )
+
+        var = np.array(var, order='C')
+        flat = var.reshape((-1, self.shape[-2] * self.shape[-1]))
+        if warm_start and self._previous is not None:
+            initial = self._previous
+        else:
+            initial = np.full(self.size, np.nan)
+
+        _plan_fill(
+            flat,
+            self._cells,
+            self._neighbors,
+            self._neighbor_cells,
+            self._offsets,
+            initial,
+            warm_start,
+            self.tol,
+            _unlimited,
+        )
+
+        # keep the solution of the last field for later warm starts
+        nplan = len(self._offsets) - 1
+        rows = np.repeat(np.arange(flat.shape[0] - nplan, flat.shape[0]), np.diff(self._offsets))
+        self._previous = flat[rows, self._cells]
+        return var
+
+
+fill_methods = ['jacobi', 'active_set', 'sor', 'redblack', 'multigrid', 'sparse']
+
+# over-relaxation factor of the 'sor', 'redblack' and 'multigrid' methods
+_omega = 1.9
+
+# size below which 'multigrid' does not coarsen further
+_multigrid_min_size = 16
+
+# iteration cap standing for no cap
+_unlimited = np.iinfo(np.int64).max
+
+# limit on the bytes of the buffers of a block of slices filled together,
+# also kept below 1 / _block_fraction of the array filled
+_block_bytes = 64 * 1024 ** 2
+_block_fraction = 8
+
+# LU factorizations of the systems of recent 'sparse' fills, by NaN pattern,
+# with their approximate size in bytes
+_sparse_systems = OrderedDict()
+_sparse_systems_lock = threading.Lock()
+_sparse_systems_limits = {'maxsize': 8, 'max_bytes': 1024 ** 3}
+
+
+def _fill_slices(
+    var,
+    isvalid_mask,
+    tol,
+    ltripole,
+    method,
+    max_iter=None,
+    time_budget=None,
+    diagnostics=False,
+    work=None,
+):
+    """Fill the NaNs of the 2D slices of a C-contiguous array in place.
+
+    The points to fill, `np.isnan(var) & isvalid_mask`, and the work
+    arrays of the solvers are computed for blocks of slices, in buffers
+    reused from block to block. Blocks are sized so that the buffers stay
+    within `_block_bytes` and a small fraction of `var`, or have the
+    length of a given `work` array; with `diagnostics`, blocks are single
+    slices so that the times are their own. Within a `time_budget`,
+    iterations are run in chunks sized from the time per iteration so
+    far, until the slices converge or the budget is spent.
+
+    Returns the iterations, the convergence, the largest relative residual
+    and number of filled points (if `diagnostics`; NaN and 0 otherwise)
+    and the wall-clock time of each slice.
     """
-    fillmask = np.isnan(var) & isvalid_mask
     nlat, nlon = var.shape[-2:]
-    missing_value = 1e36
+    lead_shape = var.shape[:-2] or (1,)
+    stack = var.reshape((-1, nlat, nlon))
+    isvalid_mask = np.broadcast_to(np.asarray(isvalid_mask, dtype=bool), lead_shape + (nlat, nlon))
+
+    nslice = stack.shape[0]
+    niter = np.zeros(nslice, dtype=np.int64)
+    converged = np.zeros(nslice, dtype=bool)
+    residual = np.full(nslice, np.nan)
+    nfilled = np.zeros(nslice, dtype=np.int64)
+    elapsed = np.zeros(nslice)
+    if max_iter is None:
+        max_iter = _unlimited
+
+    if work is not None:
+        if (
+            work.ndim != 3
+            or work.shape[0] < 1
+            or work.shape[1:] != (nlat, nlon)
+            or work.dtype != var.dtype
+        ):
+            raise ValueError(
+                f'work must have shape (nblock, {nlat}, {nlon}) and dtype {var.dtype}, '
+                f'got {work.shape} {work.dtype}'
+            )
+        if not work.flags.c_contiguous:
+            raise ValueError('work must be C-contiguous')
+        block = work.shape[0]
+    else:
+        # work array, points to fill and a copy of the slices still active
+        slice_bytes = nlat * nlon * (2 * var.dtype.itemsize + 1)
+        block = min(_block_bytes, var.nbytes // _block_fraction) // max(slice_bytes, 1)
+    block = 1 if diagnostics else max(1, min(nslice, block))
+    fillmask = np.empty((block, nlat, nlon), dtype=bool)
+    if method == 'jacobi' and work is None:
+        work = np.empty((block, nlat, nlon), dtype=var.dtype)
+
+    deadline = None
+    if time_budget is not None:
+        # keep JIT compilation out of the budget
+        _warm_up(block, nlat, nlon, var.dtype, tol, ltripole, method)
+        deadline = time.perf_counter() + time_budget
+
+    for n0 in range(0, nslice, block):
+        start = time.perf_counter()
+        n1 = min(n0 + block, nslice)
+        block_var = stack[n0:n1]
+        block_fillmask = fillmask[: n1 - n0]
+        np.isnan(block_var, out=block_fillmask)
+        block_fillmask &= isvalid_mask[np.unravel_index(np.arange(n0, n1), lead_shape)]
+
+        active = np.arange(n1 - n0)
+        chunk = max_iter if deadline is None else 1
+
+        while active.size > 0 and (deadline is None or start < deadline):
+            chunk = min(chunk, max_iter - niter[n0 + active[0]])
+            chunk_start = time.perf_counter()
+            if active.size == n1 - n0:
+                chunk_iter, done = _iterate(
+                    block_var, block_fillmask, tol, ltripole, method, chunk, work
+                )
+            else:
+                active_var = block_var[active]
+                chunk_iter, done = _iterate(
+                    active_var, block_fillmask[active], tol, ltripole, method, chunk, work
+                )
+                block_var[active] = active_var
+            niter[n0 + active] += chunk_iter
+            converged[n0 + active] = done
+            active = active[~done & (niter[n0 + active] < max_iter)]
+
+            if deadline is not None:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                per_iter = max(now - chunk_start, 1e-9) / max(chunk_iter.max(), 1)
+                chunk = int(min(max((deadline - now) / per_iter, 1), 2 * chunk))
+
+        if diagnostics:
+            residual[n0:n1], nfilled[n0:n1] = _fill_residuals(block_var, block_fillmask, ltripole)
+        elapsed[n0:n1] = time.perf_counter() - start
+
+    return niter, converged, residual, nfilled, elapsed
 
-    var = var.copy()
-    var[np.isnan(var)] = missing_value
-    _iterative_fill_POP_core(nlat, nlon, var, fillmask, missing_value, tol, ltripole)
-    var[var == missing_value] = np.nan
 
-    return var
+def _warm_up(nslice, nlat, nlon, dtype, tol, ltripole, method):
+    """Compile the kernels `_iterate` runs, with one iteration on small slices.
+
+    The slices are large enough for 'multigrid' to coarsen them if slices
+    of shape (`nlat`, `nlon`) are, in stacks of one and of `nslice`.
+    """
+    if method == 'sparse':
+        return
+    nlat = min(nlat, 2 * _multigrid_min_size)
+    nlon = min(nlon, 2 * _multigrid_min_size)
+    # blocks of fewer slices, e.g. the last one, may run other kernels
+    for n in sorted({1, nslice}):
+        var = np.ones((n, nlat, nlon), dtype=dtype)
+        var[:, nlat // 2, nlon // 2] = np.nan
+        _iterate(var, np.isnan(var), tol, ltripole, method, 1, np.empty_like(var))
+
+
+def _iterate(var, fillmask, tol, ltripole, method, max_iter, work):
+    """Run up to `max_iter` iterations on a stack of 2D slices, in place.
+
+    `work` holds at least one work array per slice for 'jacobi'. Returns
+    the iterations and convergence of each slice.
+    """
+    if method == 'jacobi' and var.shape[0] >= numba.get_num_threads():
+        return _iterative_fill_POP_batch(var, fillmask, tol, ltripole, max_iter, work)
+    if method == 'active_set':
+        return _iterative_fill_active_set_batch(var, fillmask, tol, ltripole, max_iter)
+    if method == 'sparse':
+        return _sparse_fill(var, fillmask, ltripole)
+    if method == 'sor':
+        return _iterative_fill_sor_batch(var, fillmask, tol, ltripole, _omega, max_iter)
+
+    niter = np.zeros(var.shape[0], dtype=np.int64)
+    converged = np.zeros(var.shape[0], dtype=bool)
+    for n in range(var.shape[0]):
+        if method == 'jacobi':
+            # too few slices to keep all threads busy: parallelize within slices
+            niter[n], converged[n] = _iterative_fill_POP_rows(
+                var[n], fillmask[n], tol, ltripole, max_iter, work[n]
+            )
+        elif method == 'redblack':
+            niter[n], converged[n] = _iterative_fill_redblack_core(
+                var[n], fillmask[n], tol, ltripole, _omega, max_iter
+            )
+        else:
+            niter[n], converged[n] = _iterative_fill_multigrid(
+                var[n], fillmask[n], tol, ltripole, _omega, max_iter
+            )
+    return niter, converged
+
+
+def _sparse_fill(var, fillmask, ltripole):
+    """Fill a stack of 2D slices in place with the steady state of the smoother.
+
+    Each point to fill reachable from non-missing values is the mean of
+    its non-missing neighbors and of the other reachable points to fill
+    among its neighbors: a discrete Laplace problem, solved directly.
+    Slices sharing a NaN pattern share one factorization and are solved
+    together.
+    """
+    nslice = var.shape[0]
+    keys = [_sparse_system_key(var[n], fillmask[n], ltripole) for n in range(nslice)]
+    for key in dict.fromkeys(keys):
+        slices = [n for n in range(nslice) if keys[n] == key]
+        system = _sparse_system(key, var[slices[0]], fillmask[slices[0]], ltripole)
+        if system is None:
+            continue
+        cells, boundary, lu = system
+
+        flat = var.reshape((nslice, -1))
+        solution = lu.solve(boundary @ flat[slices].T.astype(np.float64))
+        for k, n in enumerate(slices):
+            flat[n, cells] = solution[:, k]
+
+    return np.ones(nslice, dtype=np.int64), np.ones(nslice, dtype=bool)
+
+
+def _sparse_system_key(var, fillmask, ltripole):
+    sha = hashlib.sha256()
+    sha.update(np.packbits(np.isnan(var)).tobytes())
+    sha.update(np.packbits(fillmask).tobytes())
+    sha.update(repr((var.shape, ltripole)).encode())
+    return sha.hexdigest()
+
+
+def _sparse_system(key, var, fillmask, ltripole):
+    """Return the points to fill, the boundary matrix and the factorized system.
+
+    Systems are cached by `key`, up to `_sparse_systems_limits` entries and
+    bytes; `None` if there is nothing to fill.
+    """
+    try:
+        from scipy import sparse
+        from scipy.sparse.linalg import splu
+    except ImportError:
+        raise ImportError("method='sparse' requires scipy")
+
+    with _sparse_systems_lock:
+        if key in _sparse_systems:
+            _sparse_systems.move_to_end(key)
+            return _sparse_systems[key][0]
+
+    size = var.size
+    missing = np.isnan(var).reshape((-1,))
+    reachable = _reachable(var, fillmask, ltripole).reshape((-1,))
+    cells, neighbors = _fill_neighbors(fillmask, ltripole)
+    cells_filled = reachable[cells]
+    cells, neighbors = cells[cells_filled], neighbors[cells_filled]
+
+    system, nbytes = None, 0
+    if len(cells):
+        position = np.full(size, -1, dtype=np.int64)
+        position[cells] = np.arange(len(cells))
+        rows = np.broadcast_to(np.arange(len(cells))[:, np.newaxis], neighbors.shape)
+        exists = neighbors >= 0
+        unknown = exists & (position[neighbors] >= 0)
+        known = exists & ~missing[neighbors]
+
+        # (number of neighbors) * x - sum of unknown neighbors = sum of known neighbors
+        matrix = sparse.coo_matrix(
+            (
+                np.concatenate([(unknown | known).sum(axis=1), -np.ones(unknown.sum())]),
+                (
+                    np.concatenate([np.arange(len(cells)), rows[unknown]]),
+                    np.concatenate([np.arange(len(cells)), position[neighbors[unknown]]]),
+                ),
+            ),
+            shape=(len(cells), len(cells)),
+        )
+        boundary = sparse.csr_matrix(
+            (np.ones(known.sum()), (rows[known], neighbors[known])),
+            shape=(len(cells), size),
+        )
+        lu = splu(matrix.tocsc())
+        system = (cells, boundary, lu)
+        # the supernodal storage of L and U holds lu.nnz values and row indices
+        nbytes = (
+            cells.nbytes
+            + boundary.data.nbytes
+            + boundary.indices.nbytes
+            + boundary.indptr.nbytes
+            + lu.nnz * (np.dtype(np.float64).itemsize + np.dtype(np.int32).itemsize)
+        )
+
+    with _sparse_systems_lock:
+        if nbytes <= _sparse_systems_limits['max_bytes']:
+            _sparse_systems[key] = (system, nbytes)
+            _sparse_systems.move_to_end(key)
+        total = sum(entry[1] for entry in _sparse_systems.values())
+        while _sparse_systems and (
+            len(_sparse_systems) > _sparse_systems_limits['maxsize']
+            or total > _sparse_systems_limits['max_bytes']
+        ):
+            _, (_, entry_nbytes) = _sparse_systems.popitem(last=False)
+            total -= entry_nbytes
+    return system
+
+
+def _iterative_fill_multigrid(var, fillmask, tol, ltripole, omega, max_iter):
+    """Fill a 2D slice in place, starting from the fill of a coarsened slice.
+
+    Returns the number of iterations on the finest grid and its convergence.
+    """
+    nlat, nlon = var.shape
+    if min(nlat, nlon) >= 2 * _multigrid_min_size and fillmask.any():
+        coarse_var, coarse_fillmask = _coarsen(var, fillmask)
+        _iterative_fill_multigrid(coarse_var, coarse_fillmask, tol, ltripole, omega, max_iter)
+        _prolong(var, fillmask, coarse_var, ltripole)
+    return _iterative_fill_redblack_core(var, fillmask, tol, ltripole, omega, max_iter)
+
+
+@jit(nopython=True, parallel=True)
+def _fill_residuals(var, fillmask, ltripole):
+    """Return the largest relative change of the next smoothing iteration and
+    the number of filled points of each slice of a stack.
+    """
+
+    nslice, nlat, nlon = var.shape
+    residual = np.full(nslice, np.nan)
+    nfilled = np.zeros(nslice, dtype=np.int64)
+
+    for n in prange(0, nslice):
+        for j in range(1, nlat):
+            for i in range(0, nlon):
+                if not fillmask[n, j, i] or np.isnan(var[n, j, i]):
+                    continue
+                nfilled[n] += 1
+
+                mean = _neighbor_mean(var[n], j, i, ltripole)
+                if np.isnan(mean):
+                    continue
+                value = var[n, j, i]
+                delta = 0.5 * np.fabs(mean - value)
+                if value != 0.0:
+                    r = delta / np.abs(value)
+                elif delta > 0.0:
+                    r = np.inf
+                else:
+                    r = 0.0
+                if np.isnan(residual[n]) or r > residual[n]:
+                    residual[n] = r
+
+    return residual, nfilled
+
+
+@jit(nopython=True, parallel=True)
+def _iterative_fill_POP_batch(var, fillmask, tol, ltripole, max_iter, work):
+    """Iterative smoothing of a stack of 2D slices, in parallel over slices.
+
+    Returns the iterations and convergence of each slice.
+    """
+
+    nslice, nlat, nlon = var.shape
+    niter = np.zeros(nslice, dtype=np.int64)
+    converged = np.zeros(nslice, dtype=np.bool_)
+    for n in prange(0, nslice):
+        niter[n], converged[n] = _iterative_fill_POP_core(
+            nlat, nlon, var[n], fillmask[n], tol, ltripole, max_iter, work[n]
+        )
+    return niter, converged
+
+
+@jit(nopython=True, parallel=True)
+def _iterative_fill_active_set_batch(var, fillmask, tol, ltripole, max_iter):
+    """Active-set smoothing of a stack of 2D slices, in parallel over slices."""
+
+    nslice = var.shape[0]
+    niter = np.zeros(nslice, dtype=np.int64)
+    converged = np.zeros(nslice, dtype=np.bool_)
+    for n in prange(0, nslice):
+        niter[n], converged[n] = _iterative_fill_active_set_core(
+            var[n], fillmask[n], tol, ltripole, max_iter
+        )
+    return niter, converged
+
+
+@jit(nopython=True, parallel=True)
+def _iterative_fill_sor_batch(var, fillmask, tol, ltripole, omega, max_iter):
+    """Successive over-relaxation of a stack of 2D slices, in parallel over slices."""
+
+    nslice = var.shape[0]
+    niter = np.zeros(nslice, dtype=np.int64)
+    converged = np.zeros(nslice, dtype=np.bool_)
+    for n in prange(0, nslice):
+        niter[n], converged[n] = _iterative_fill_sor_core(
+            var[n], fillmask[n], tol, ltripole, omega, max_iter
+        )
+    return niter, converged
 
 
 @jit(nopython=True)
-def _iterative_fill_POP_core(nlat, nlon, var, fillmask, missing_value, tol, ltripole):
-    """Iterative smoothing algorithm."""
+def _neighbor_mean(var, j, i, ltripole):
+    """Mean of the non-missing neighbors of point (j, i), or NaN.
+
+    Uses the boundary handling of `_iterative_fill_POP_core`: periodic in
+    x and, if `ltripole`, folded across the top row.
+    """
+
+    nlat, nlon = var.shape
+    im1 = i - 1 if i > 0 else nlon - 1
+    ip1 = i + 1 if i < nlon - 1 else 0
+
+    numer = 0.0
+    denom = 0.0
+
+    # East
+    if not np.isnan(var[j, ip1]):
+        numer += var[j, ip1]
+        denom += 1.0
+
+    # North
+    if j < nlat - 1:
+        if not np.isnan(var[j + 1, i]):
+            numer += var[j + 1, i]
+            denom += 1.0
+
+    else:
+        # assume only tripole has non-land top row
+        if ltripole:
+            if not np.isnan(var[j, (nlon - i) % nlon]):
+                numer += var[j, (nlon - i) % nlon]
+                denom += 1.0
+
+    # West
+    if not np.isnan(var[j, im1]):
+        numer += var[j, im1]
+        denom += 1.0
+
+    # South
+    if not np.isnan(var[j - 1, i]):
+        numer += var[j - 1, i]
+        denom += 1.0
 
+    if denom > 0.0:
+        return numer / denom
+    return np.nan
+
+
+@jit(nopython=True)
+def _fill_neighbors(fillmask, ltripole):
+    """Return the flat indices of the points to fill and of their neighbors.
+
+    Neighbors are ordered East, North, West, South, with the boundary
+    handling of `_iterative_fill_POP_core`; -1 where there is none. The
+    bottom row is never filled.
+    """
+
+    nlat, nlon = fillmask.shape
+    ncell = 0
+    for j in range(1, nlat):
+        for i in range(0, nlon):
+            if fillmask[j, i]:
+                ncell += 1
+
+    cells = np.empty(ncell, dtype=np.int64)
+    neighbors = np.empty((ncell, 4), dtype=np.int64)
+    c = 0
+    for j in range(1, nlat):
+        for i in range(0, nlon):
+            if not fillmask[j, i]:
+                continue
+            cells[c] = j * nlon + i
+            neighbors[c, 0] = j * nlon + (i + 1) % nlon
+            if j < nlat - 1:
+                neighbors[c, 1] = (j + 1) * nlon + i
+            elif ltripole:
+                neighbors[c, 1] = j * nlon + (nlon - i) % nlon
+            else:
+                neighbors[c, 1] = -1
+            neighbors[c, 2] = j * nlon + (i - 1) % nlon
+            neighbors[c, 3] = (j - 1) * nlon + i
+            c += 1
+
+    return cells, neighbors
+
+
+@jit(nopython=True)
+def _neighbor_cells(cells, neighbors, size):
+    """Return the position in `cells` of each neighbor, or -1 if not a point to fill."""
+
+    position = np.full(size, -1, dtype=np.int64)
+    for c in range(0, cells.shape[0]):
+        position[cells[c]] = c
+
+    neighbor_cells = np.full(neighbors.shape, -1, dtype=np.int64)
+    for c in range(0, cells.shape[0]):
+        for k in range(0, 4):
+            if neighbors[c, k] >= 0:
+                neighbor_cells[c, k] = position[neighbors[c, k]]
+    return neighbor_cells
+
+
+@jit(nopython=True)
+def _iterative_fill_active_set_core(var, fillmask, tol, ltripole, max_iter):
+    """Iterative smoothing of the points still changing."""
+
+    nlat, nlon = var.shape
+    cells, neighbors = _fill_neighbors(fillmask, ltripole)
+    neighbor_cells = _neighbor_cells(cells, neighbors, nlat * nlon)
+    return _active_set_iterate(
+        var.reshape(nlat * nlon), cells, neighbors, neighbor_cells, tol, max_iter
+    )
+
+
+@jit(nopython=True)
+def _active_set_iterate(flat, cells, neighbors, neighbor_cells, tol, max_iter):
+    """Iterative smoothing of the points still changing, on a flattened slice.
+
+    Each iteration applies the update of `_iterative_fill_POP_core` to the
+    active points only: those filled or not converged in the previous
+    iteration, and the points to fill next to them. Points whose
+    neighbors have all converged drop out of the active set, so the cost
+    of an iteration is proportional to the part of the fill region still
+    changing. Changes below `tol` can still add up at points that have
+    dropped out, so when the active set empties, the next iteration is a
+    full sweep over all points, and the fill has only converged when a
+    full sweep changes no point by more than `tol`, the convergence
+    criterion of the full smoother. Returns the number of iterations and
+    whether the fill converged.
+    """
+
+    ncell = cells.shape[0]
+    active = np.arange(ncell)
+    next_active = np.empty(ncell, dtype=np.int64)
+    nactive = ncell
+    queued = np.zeros(ncell, dtype=np.bool_)
+    work = np.empty(ncell)
+    changed = np.zeros(ncell, dtype=np.bool_)
+    full_sweep = True
+    converged = ncell == 0
+    iter = 0
+
+    while not converged and iter < max_iter:
+        iter += 1
+
+        for a in range(0, nactive):
+            c = active[a]
+            value = flat[cells[c]]
+            missing = np.isnan(value)
+
+            numer = 0.0
+            denom = 0.0
+            for k in range(0, 4):
+                n = neighbors[c, k]
+                if n >= 0 and not np.isnan(flat[n]):
+                    numer += flat[n]
+                    denom += 1.0
+
+            # self
+            if not missing:
+                numer += denom * value
+                denom *= 2.0
+
+            work[a] = value
+            changed[a] = False
+            if denom > 0.0:
+                work[a] = numer / denom
+                if missing:
+                    changed[a] = True
+                else:
+                    changed[a] = np.fabs(value - work[a]) > tol * np.abs(value)
+
+        # update, then queue the changed points and their neighbors
+        nnext = 0
+        for a in range(0, nactive):
+            c = active[a]
+            flat[cells[c]] = work[a]
+            if not changed[a]:
+                continue
+            if not queued[c]:
+                queued[c] = True
+                next_active[nnext] = c
+                nnext += 1
+            for k in range(0, 4):
+                n = neighbor_cells[c, k]
+                if n < 0 or queued[n]:
+                    continue
+                queued[n] = True
+                next_active[nnext] = n
+                nnext += 1
+
+        for a in range(0, nnext):
+            queued[next_active[a]] = False
+
+        if nnext > 0:
+            active, next_active = next_active, active
+            nactive = nnext
+            full_sweep = False
+        elif full_sweep:
+            converged = True
+        else:
+            # check all points again before declaring convergence
+            for c in range(0, ncell):
+                active[c] = c
+            nactive = ncell
+            full_sweep = True
+
+    return iter, converged
+
+
+@jit(nopython=True, parallel=True)
+def _plan_fill(var, cells, neighbors, neighbor_cells, offsets, initial, warm_start, tol, max_iter):
+    """Fill flattened slices (nbatch * nplan, nlat * nlon) with the tables of a `FillPlan`.
+
+    Slice `n` is filled with the tables of plan slice `n % nplan`. The
+    points to fill start from `initial` (NaN for a cold start) or, if
+    `warm_start`, from the solution of the previous slice with the same
+    plan slice, so the batch is then only parallel over plan slices.
+    """
+
+    nslice = var.shape[0]
+    nplan = offsets.shape[0] - 1
+    niter = np.zeros(nslice, dtype=np.int64)
+
+    if warm_start:
+        for s in prange(0, nplan):
+            c0, c1 = offsets[s], offsets[s + 1]
+            for n in range(s, nslice, nplan):
+                for c in range(c0, c1):
+                    if n < nplan:
+                        var[n, cells[c]] = initial[c]
+                    else:
+                        var[n, cells[c]] = var[n - nplan, cells[c]]
+                niter[n], _ = _active_set_iterate(
+                    var[n],
+                    cells[c0:c1],
+                    neighbors[c0:c1],
+                    neighbor_cells[c0:c1],
+                    tol,
+                    max_iter,
+                )
+    else:
+        for n in prange(0, nslice):
+            s = n % nplan
+            c0, c1 = offsets[s], offsets[s + 1]
+            for c in range(c0, c1):
+                var[n, cells[c]] = initial[c]
+            niter[n], _ = _active_set_iterate(
+                var[n], cells[c0:c1], neighbors[c0:c1], neighbor_cells[c0:c1], tol, max_iter
+            )
+
+    return niter
+
+
+@jit(nopython=True)
+def _relax_point(var, j, i, tol, ltripole, omega):
+    """Over-relax point (j, i) towards the mean of its neighbors, in place.
+
+    Returns `True` unless the point has converged, with the convergence
+    criterion of `_iterative_fill_POP_core`.
+    """
+
+    mean = _neighbor_mean(var, j, i, ltripole)
+    if np.isnan(mean):
+        return False
+
+    value = var[j, i]
+    if np.isnan(value):
+        var[j, i] = mean
+        return True
+
+    var[j, i] = value + omega * (mean - value)
+    return 0.5 * np.fabs(mean - value) > tol * np.abs(value)
+
+
+@jit(nopython=True)
+def _iterative_fill_sor_core(var, fillmask, tol, ltripole, omega, max_iter):
+    """Successive over-relaxation, sweeping rows in order."""
+
+    nlat, nlon = var.shape
     done = False
     iter = 0
 
-    work = np.empty((nlat, nlon))
+    while not done and iter < max_iter:
+        done = True
+        iter += 1
 
-    while not done:
+        # assume bottom row is land, so skip it
+        for j in range(1, nlat):
+            for i in range(0, nlon):
+                if fillmask[j, i]:
+                    if _relax_point(var, j, i, tol, ltripole, omega):
+                        done = False
+
+    return iter, done
+
+
+@jit(nopython=True, parallel=True)
+def _iterative_fill_redblack_core(var, fillmask, tol, ltripole, omega, max_iter):
+    """Red-black Gauss-Seidel with over-relaxation, in parallel over rows.
+
+    Points with even and odd `i + j` are updated in alternate half-sweeps;
+    points of one color only depend on points of the other color, except
+    across the periodic and tripole boundaries, which stay within a row.
+    """
+
+    nlat, nlon = var.shape
+    changed = np.zeros(nlat, dtype=np.bool_)
+    done = False
+    iter = 0
+
+    while not done and iter < max_iter:
+        iter += 1
+        changed[:] = False
+
+        for color in range(0, 2):
+            # assume bottom row is land, so skip it
+            for j in prange(1, nlat):
+                for i in range((j + color) % 2, nlon, 2):
+                    if fillmask[j, i]:
+                        if _relax_point(var, j, i, tol, ltripole, omega):
+                            changed[j] = True
+
+        done = not changed.any()
+
+    return iter, done
+
+
+@jit(nopython=True)
+def _coarsen(var, fillmask):
+    """Average 2x2 blocks of non-missing values.
+
+    Coarse points with no values but with points to fill are to be filled.
+    """
+
+    nlat, nlon = var.shape
+    coarse_shape = ((nlat + 1) // 2, (nlon + 1) // 2)
+    total = np.zeros(coarse_shape)
+    count = np.zeros(coarse_shape)
+    coarse_fillmask = np.zeros(coarse_shape, dtype=np.bool_)
+
+    for j in range(0, nlat):
+        for i in range(0, nlon):
+            if not np.isnan(var[j, i]):
+                total[j // 2, i // 2] += var[j, i]
+                count[j // 2, i // 2] += 1.0
+            elif fillmask[j, i]:
+                coarse_fillmask[j // 2, i // 2] = True
+
+    coarse_var = np.full(coarse_shape, np.nan, dtype=var.dtype)
+    for j in range(0, coarse_shape[0]):
+        for i in range(0, coarse_shape[1]):
+            if count[j, i] > 0.0:
+                coarse_var[j, i] = total[j, i] / count[j, i]
+                coarse_fillmask[j, i] = False
+
+    return coarse_var, coarse_fillmask
+
+
+@jit(nopython=True)
+def _prolong(var, fillmask, coarse_var, ltripole):
+    """Initialize missing points to fill from the coarse grid.
+
+    Only points that the fine-grid solvers would reach from non-missing
+    values are initialized, so that regions which cannot be filled stay
+    missing.
+    """
+
+    nlat, nlon = var.shape
+    reached = _reachable(var, fillmask, ltripole)
+    for j in range(1, nlat):
+        for i in range(0, nlon):
+            if reached[j, i] and np.isnan(var[j, i]):
+                var[j, i] = coarse_var[j // 2, i // 2]
+
+
+@jit(nopython=True)
+def _reachable(var, fillmask, ltripole):
+    """Return the non-missing points and the points to fill reachable from them."""
+
+    nlat, nlon = var.shape
+
+    # flood fill from the non-missing points through the points to fill
+    reached = np.zeros((nlat, nlon), dtype=np.bool_)
+    stack = np.empty(nlat * nlon, dtype=np.int64)
+    nstack = 0
+    for j in range(0, nlat):
+        for i in range(0, nlon):
+            if not np.isnan(var[j, i]):
+                reached[j, i] = True
+                stack[nstack] = j * nlon + i
+                nstack += 1
+
+    neighbors = np.empty((4, 2), dtype=np.int64)
+    while nstack > 0:
+        nstack -= 1
+        j = stack[nstack] // nlon
+        i = stack[nstack] % nlon
+
+        neighbors[0, 0], neighbors[0, 1] = j, (i + 1) % nlon
+        neighbors[1, 0], neighbors[1, 1] = j, (i - 1) % nlon
+        neighbors[2, 0], neighbors[2, 1] = j - 1, i
+        if j < nlat - 1:
+            neighbors[3, 0], neighbors[3, 1] = j + 1, i
+        elif ltripole:
+            neighbors[3, 0], neighbors[3, 1] = j, (nlon - i) % nlon
+        else:
+            neighbors[3, 0], neighbors[3, 1] = -1, i
+
+        for n in range(0, 4):
+            jn, jn_i = neighbors[n, 0], neighbors[n, 1]
+            # the bottom row is never filled
+            if jn >= 1 and fillmask[jn, jn_i] and not reached[jn, jn_i]:
+                reached[jn, jn_i] = True
+                stack[nstack] = jn * nlon + jn_i
+                nstack += 1
+
+    return reached
+
+
+@jit(nopython=True)
+def _iterative_fill_POP_core(nlat, nlon, var, fillmask, tol, ltripole, max_iter, work):
+    """Iterative smoothing algorithm, with a work array of the shape of `var`."""
+
+    done = False
+    iter = 0
+
+    while not done and iter < max_iter:
         done = True
         iter += 1
 
         # assume bottom row is land, so skip it
         for j in range(1, nlat):
-            jm1 = j - 1
-            jp1 = j + 1
+            if _smooth_row(var, work, fillmask, j, tol, ltripole) > 0:
+                done = False
 
-            for i in range(0, nlon):
-                # assume periodic in x
-                im1 = i - 1
-                if i == 0:
-                    im1 = nlon - 1
-                ip1 = i + 1
-                if i == nlon - 1:
-                    ip1 = 0
+        var[1:nlat, :] = work[1:nlat, :]
 
-                work[j, i] = var[j, i]
+    return iter, done
 
-                if not fillmask[j, i]:
-                    continue
 
-                numer = 0.0
-                denom = 0.0
+@jit(nopython=True, parallel=True)
+def _iterative_fill_POP_rows(var, fillmask, tol, ltripole, max_iter, work):
+    """Iterative smoothing of a 2D slice, in parallel over rows.
 
-                # East
-                if var[j, ip1] != missing_value:
-                    numer += var[j, ip1]
-                    denom += 1.0
+    Rows only read `var` and write their own row of `work`, so a sweep
+    can be split across threads; the number of points not converged is
+    summed by a parallel reduction. Results are identical to those of
+    `_iterative_fill_POP_core`.
+    """
+
+    nlat, nlon = var.shape
+    done = False
+    iter = 0
 
-                # North
-                if j < nlat - 1:
-                    if var[jp1, i] != missing_value:
-                        numer += var[jp1, i]
-                        denom += 1.0
+    while not done and iter < max_iter:
+        iter += 1
+        nchanged = 0
 
-                else:
-                    # assume only tripole has non-land top row
-                    if ltripole:
-                        if var[j, nlon - i] != missing_value:
-                            numer += var[j, nlon - i]
-                            denom += 1.0
-
-                # West
-                if var[j, im1] != missing_value:
-                    numer += var[j, im1]
-                    denom += 1.0
+        # assume bottom row is land, so skip it
+        for j in prange(1, nlat):
+            nchanged += _smooth_row(var, work, fillmask, j, tol, ltripole)
 
-                # South
-                if var[jm1, i] != missing_value:
-                    numer += var[jm1, i]
+        for j in prange(1, nlat):
+            var[j, :] = work[j, :]
+
+        done = nchanged == 0
+
+    return iter, done
+
+
+@jit(nopython=True)
+def _smooth_row(var, work, fillmask, j, tol, ltripole):
+    """One smoothing sweep of row `j` of `var` into `work`.
+
+    Returns the number of points of the row not converged.
+    """
+
+    nlat, nlon = var.shape
+    jm1 = j - 1
+    jp1 = j + 1
+    nchanged = 0
+
+    for i in range(0, nlon):
+        # assume periodic in x
+        im1 = i - 1
+        if i == 0:
+            im1 = nlon - 1
+        ip1 = i + 1
+        if i == nlon - 1:
+            ip1 = 0
+
+        work[j, i] = var[j, i]
+
+        if not fillmask[j, i]:
+            continue
+
+        numer = 0.0
+        denom = 0.0
+
+        # East
+        if not np.isnan(var[j, ip1]):
+            numer += var[j, ip1]
+            denom += 1.0
+
+        # North
+        if j < nlat - 1:
+            if not np.isnan(var[jp1, i]):
+                numer += var[jp1, i]
+                denom += 1.0
+
+        else:
+            # assume only tripole has non-land top row
+            if ltripole:
+                if not np.isnan(var[j, (nlon - i) % nlon]):
+                    numer += var[j, (nlon - i) % nlon]
                     denom += 1.0
 
-                # self
-                if var[j, i] != missing_value:
-                    numer += denom * var[j, i]
-                    denom *= 2.0
+        # West
+        if not np.isnan(var[j, im1]):
+            numer += var[j, im1]
+            denom += 1.0
 
-                if denom > 0.0:
-                    work[j, i] = numer / denom
-                    if var[j, i] == missing_value:
-                        done = False
-                    else:
-                        delta = np.fabs(var[j, i] - work[j, i])
-                        if delta > tol * np.abs(var[j, i]):
-                            done = False
+        # South
+        if not np.isnan(var[jm1, i]):
+            numer += var[jm1, i]
+            denom += 1.0
 
-        var[1:nlat, :] = work[1:nlat, :]
+        # self
+        if not np.isnan(var[j, i]):
+            numer += denom * var[j, i]
+            denom *= 2.0
+
+        if denom > 0.0:
+            work[j, i] = numer / denom
+            if np.isnan(var[j, i]):
+                nchanged += 1
+            else:
+                delta = np.fabs(var[j, i] - work[j, i])
+                if delta > tol * np.abs(var[j, i]):
+                    nchanged += 1
+
+    return nchanged
@@ -1,11 +1,30 @@
+import copy
+import os
+
+import dask
+import dask.array
 import numpy as np
 import xarray as xr
 from numba import jit, prange
 
-from .config import grid_defs
+from .cache import grid_cache_path, memo_get, memo_put, open_cached_grid, write_cached_grid
+from . import config
+from .config import ensure_inputdata, grid_defs
+
+# records in POP horizontal grid files
+horiz_grid_records = ['ULAT', 'ULONG', 'HTN', 'HTE', 'HUS', 'HUW', 'ANGLE']
 
 
-def get_grid(grid_name, scrip=False):
+def get_grid(
+    grid_name,
+    scrip=False,
+    variables=None,
+    chunks=None,
+    dtype=np.float64,
+    full_metrics=False,
+    cache=False,
+    memoize=True,
+):
     """Return a xarray.Dataset() with POP grid variables.
 
     Parameters
@@ -17,6 +36,43 @@ def get_grid(grid_name, scrip=False):
     scrip : boolean, optional
       Return grid in SCRIP format
 
+    variables : str or list of str, optional
+      Variables to return, e.g. `['KMT', 'TAREA']`. Only the input records
+      and intermediate fields these variables depend on are read or
+      computed. Default is all variables, except the U-grid metrics
+      added by `full_metrics`.
+
+    chunks : int, tuple, dict or 'auto', optional
+      If given, return lateral variables as dask arrays with these chunks
+      along (`nlat`, `nlon`); e.g. `chunks={'nlat': 600}`. Each block is
+      computed independently from the rows and columns of the input files
+      it needs, so no single task holds the whole grid.
+
+    dtype : numpy.dtype, optional [default=numpy.float64]
+      Floating point type of the SCRIP center and corner coordinates
+      (`scrip=True` only); `numpy.float32` halves their memory footprint.
+
+    full_metrics : boolean, optional [default=False]
+      Also return the U-grid metrics `DXU`, `DYU`, `UAREA`, `HUS`, `HUW`,
+      `ANGLE` and `ANGLET` (ignored if `scrip=True` or `variables` is
+      given).
+
+    cache : boolean or str, optional [default=False]
+      If `True`, read the grid from the on-disk cache in
+      `pop_tools.config.GRID_CACHE_DIR`, generating and storing it on a cache
+      miss; if a string, use it as the cache directory. Cache entries are
+      keyed on the grid name, `scrip`, `variables`, and the contents of the
+      input files; cached datasets are opened lazily, and rechunked to
+      `chunks` if given.
+
+    memoize : boolean, optional [default=True]
+      If `True`, keep the dataset in an in-process LRU memo and return
+      shallow copies of it on subsequent calls (separately for each `cache`
+      directory, so the on-disk cache is populated even after uncached
+      calls). The numpy arrays of memoized datasets are shared and
+      read-only; use `memoize=False` to obtain writeable arrays. See
+      `set_grid_memo_limits` and `clear_grid_memo`.
+
     Returns
     -------
 
@@ -30,206 +86,648 @@ def get_grid(grid_name, scrip=False):
              Please select from the following: {list(grid_defs.keys())}"""
         )
 
-    grid_attrs = grid_defs[grid_name]
-
-    nlat = grid_attrs['lateral_dims'][0]
-    nlon = grid_attrs['lateral_dims'][1]
-
-    # read horizontal grid
-    grid_file_data = np.fromfile(grid_attrs['horiz_grid_fname'], dtype='>f8', count=-1)
-    grid_file_data = grid_file_data.reshape((7, nlat, nlon))
-
-    ULAT = grid_file_data[0, :, :].astype(np.float)
-    ULONG = grid_file_data[1, :, :].astype(np.float)
-    HTN = grid_file_data[2, :, :].astype(np.float)
-    HTE = grid_file_data[3, :, :].astype(np.float)
-
-    # compute TLAT, TLONG
-    TLAT = np.empty((nlat, nlon), dtype=np.float)
-    TLONG = np.empty((nlat, nlon), dtype=np.float)
-    _compute_TLAT_TLONG(ULAT, ULONG, TLAT, TLONG, nlat, nlon)
-
-    # generate DXT, DYT, TAREA
-    DXT = np.empty((nlat, nlon))
-    DXT[1:nlat, :] = 0.5 * (HTN[0 : nlat - 1, :] + HTN[1:nlat, :])
-    DXT[0, :] = 0.5 * (2 * HTN[0, :] - HTN[1, :] + HTN[0, :])
-
-    DYT = np.empty((nlat, nlon))
-    DYT[:, 1:nlon] = 0.5 * (HTE[:, 0 : nlon - 1] + HTE[:, 1:nlon])
-    DYT[:, 0] = 0.5 * (HTE[:, nlon - 1] + HTE[:, 0])
-
-    TAREA = DXT * DYT
-
-    # vertical grid
-    tmp = np.loadtxt(grid_attrs['vert_grid_file'])
-    dz = tmp[:, 0]
-    depth_edges = np.concatenate(([0.0], np.cumsum(dz)))
-    z_w = depth_edges[0:-1]
-    z_w_bot = depth_edges[1:]
-    z_t = depth_edges[0:-1] + 0.5 * dz
-
-    # read KMT
-    kmt_flat = np.fromfile(grid_attrs['topography_fname'], dtype='>i4', count=-1)
-    assert kmt_flat.shape[0] == (
-        nlat * nlon
-    ), f'unexpected dims in topography file: {grid_attrs["topography_fname"]}'
-    assert kmt_flat.max() <= len(z_t), 'Max KMT > length z_t'
-    KMT = kmt_flat.reshape(grid_attrs['lateral_dims']).astype(np.int32)
-
-    # read REGION_MASK
-    region_mask_flat = np.fromfile(grid_attrs['region_mask_fname'], dtype='>i4', count=-1)
-    assert region_mask_flat.shape[0] == (
-        nlat * nlon
-    ), f'unexpected dims in region_mask file: {grid_attrs["region_mask_fname"]}'
-    REGION_MASK = region_mask_flat.reshape(grid_attrs['lateral_dims']).astype(np.int32)
-
-    # output dataset
-    dso = xr.Dataset()
-    if scrip:
-        corner_lat, corner_lon = _compute_corners(ULAT, ULONG)
+    if variables is not None:
+        variables = tuple(_check_variables(variables, scrip))
+    elif full_metrics and not scrip:
+        variables = tuple(_check_variables(None, scrip, full_metrics=True))
+
+    # normalize chunks to a hashable memo key
+    if isinstance(chunks, dict):
+        chunks = tuple(chunks.get(dim, -1) for dim in ['nlat', 'nlon'])
+    elif isinstance(chunks, list):
+        chunks = tuple(chunks)
+
+    dtype = np.dtype(dtype).name
+
+    # datasets read from (and stored in) a cache directory are memoized
+    # separately, so that a memo hit never skips populating the cache
+    cache_dir = None
+    if cache:
+        cache_dir = cache if isinstance(cache, str) else config.GRID_CACHE_DIR
+        cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+
+    memo_key = (grid_name, scrip, variables, chunks, dtype, cache_dir)
+    if memoize:
+        dso = memo_get(memo_key)
+        if dso is None and variables is not None:
+            # subset a memoized dataset with the default variables, which
+            # does not include the U-grid metrics
+            dso = memo_get((grid_name, scrip, None, chunks, dtype, cache_dir))
+            if dso is not None:
+                dso = dso[list(variables)] if set(variables) <= set(dso.variables) else None
+        if dso is not None:
+            return dso
+
+    ensure_inputdata(grid_name)
+
+    if cache_dir is None:
+        dso = _compute_grid(grid_name, scrip, variables, chunks, dtype)
+    else:
+        cache_path = grid_cache_path(
+            grid_name,
+            grid_defs[grid_name],
+            cache_dir=cache_dir,
+            scrip=scrip,
+            variables=variables,
+            dtype=dtype,
+        )
+        dso = open_cached_grid(cache_path)
+        if dso is None:
+            dso = _compute_grid(grid_name, scrip, variables, chunks, dtype)
+            write_cached_grid(dso, cache_path)
+        if chunks is not None:
+            # cache entries are shared by all chunks
+            dso = _rechunk_grid(dso, chunks, *grid_defs[grid_name]['lateral_dims'])
+
+    if memoize:
+        dso = memo_put(memo_key, dso)
+    return dso
 
-        dso['grid_dims'] = xr.DataArray(np.array([nlon, nlat], dtype=np.int32), dims=('grid_rank',))
-        dso.grid_dims.encoding = {'dtype': np.int32, '_FillValue': None}
 
-        dso['grid_center_lat'] = xr.DataArray(
-            np.rad2deg(TLAT.reshape((-1,))), dims=('grid_size'), attrs={'units': 'degrees'}
-        )
-        dso.grid_center_lat.encoding = {'dtype': np.float64, '_FillValue': None}
+def cache_grid(grid_name=None, scrip=False, cache_dir=None):
+    """Generate grids and store them in the on-disk cache.
 
-        dso['grid_center_lon'] = xr.DataArray(
-            np.rad2deg(TLONG.reshape((-1,))), dims=('grid_size'), attrs={'units': 'degrees'}
-        )
-        dso.grid_center_lon.encoding = {'dtype': np.float64, '_FillValue': None}
+    Parameters
+    ----------
 
-        dso['grid_corner_lat'] = xr.DataArray(
-            np.rad2deg(corner_lat.reshape((-1, 4))),
-            dims=('grid_size', 'grid_corners'),
-            attrs={'units': 'degrees'},
-        )
-        dso.grid_corner_lat.encoding = {'dtype': np.float64, '_FillValue': None}
+    grid_name : str or list of str, optional
+      Grid(s) to cache. If `None`, cache all grids in `pop_tools.grid_defs`.
 
-        dso['grid_corner_lon'] = xr.DataArray(
-            np.rad2deg(corner_lon.reshape((-1, 4))),
-            dims=('grid_size', 'grid_corners'),
-            attrs={'units': 'degrees'},
-        )
-        dso.grid_corner_lon.encoding = {'dtype': np.float64, '_FillValue': None}
+    scrip : boolean, optional
+      Cache the grid in SCRIP format
 
-        dso['grid_imask'] = xr.DataArray(
-            np.where(KMT > 0, 1, 0).reshape((-1,)), dims=('grid_size'), attrs={'units': 'unitless'}
-        )
-        dso.grid_imask.encoding = {'dtype': np.int32, '_FillValue': None}
+    cache_dir : str, optional
+      Cache directory; defaults to `pop_tools.config.GRID_CACHE_DIR`.
+    """
+    if grid_name is None:
+        grid_name = list(grid_defs.keys())
+    elif isinstance(grid_name, str):
+        grid_name = [grid_name]
 
-        grid_attrs.update({'conventions': 'SCRIP'})
+    for name in grid_name:
+        get_grid(name, scrip=scrip, cache=cache_dir or True, memoize=False)
 
-    else:
-        TLONG = np.where(TLONG < 0.0, TLONG + 2 * np.pi, TLONG)
 
-        dso['TLAT'] = xr.DataArray(
-            np.rad2deg(TLAT),
-            dims=('nlat', 'nlon'),
-            attrs={'units': 'degrees_north', 'long_name': 'T-grid latitude'},
+def _memmap_grid_file(fname, shape, dtype):
+    """Memory-map a POP binary grid file, checking its size against `shape`."""
+    expected_size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    file_size = os.path.getsize(fname)
+    if file_size != expected_size:
+        raise ValueError(
+            f'unexpected dims in {fname}: file has {file_size} bytes, '
+            f'expected {expected_size} for {shape} {dtype}'
         )
+    return np.memmap(fname, dtype=dtype, mode='r', shape=shape)
 
-        dso['TLONG'] = xr.DataArray(
-            np.rad2deg(TLONG),
-            dims=('nlat', 'nlon'),
-            attrs={'units': 'degrees_east', 'long_name': 'T-grid longitude'},
-        )
 
-        dso['ULAT'] = xr.DataArray(
-            np.rad2deg(ULAT),
-            dims=('nlat', 'nlon'),
-            attrs={'units': 'degrees_north', 'long_name': 'U-grid latitude'},
-        )
+def read_horiz_grid(fname, nlat, nlon, records, rows=None, cols=None):
+    """Read records from a POP horizontal grid file.
 
-        dso['ULONG'] = xr.DataArray(
-            np.rad2deg(ULONG),
-            dims=('nlat', 'nlon'),
-            attrs={'units': 'degrees_east', 'long_name': 'U-grid longitude'},
-        )
+    Only the requested records (and rows and columns) are read from disk;
+    each is byte-swapped into a new native-endian float64 array.
 
-        dso['DXT'] = xr.DataArray(
-            DXT,
-            dims=('nlat', 'nlon'),
-            attrs={
-                'units': 'cm',
-                'long_name': 'x-spacing centered at T points',
-                'coordinates': 'TLONG TLAT',
-            },
-        )
+    Parameters
+    ----------
 
-        dso['DYT'] = xr.DataArray(
-            DYT,
-            dims=('nlat', 'nlon'),
-            attrs={
-                'units': 'cm',
-                'long_name': 'y-spacing centered at T points',
-                'coordinates': 'TLONG TLAT',
-            },
-        )
+    fname : str
+      Path to big-endian (`ieeer8`) horizontal grid file.
 
-        dso['TAREA'] = xr.DataArray(
-            TAREA,
-            dims=('nlat', 'nlon'),
-            attrs={'units': 'cm^2', 'long_name': 'area of T cells', 'coordinates': 'TLONG TLAT'},
-        )
+    nlat, nlon : int
+      Lateral dimensions of the grid.
 
-        dso['KMT'] = xr.DataArray(
-            KMT,
-            dims=('nlat', 'nlon'),
-            attrs={
-                'long_name': 'k Index of Deepest Grid Cell on T Grid',
-                'coordinates': 'TLONG TLAT',
-            },
-        )
+    records : list of str
+      Records to read; a subset of `horiz_grid_records`.
 
-        dso['REGION_MASK'] = xr.DataArray(
-            REGION_MASK,
-            dims=('nlat', 'nlon'),
-            attrs={
-                'long_name': 'basin index number (signed integers)',
-                'coordinates': 'TLONG TLAT',
-            },
-        )
+    rows : slice, optional
+      Range of rows (`nlat` dimension) to read. Default is all rows.
 
-        dso['z_t'] = xr.DataArray(
-            z_t,
-            dims=('z_t'),
-            name='z_t',
-            attrs={
-                'units': 'cm',
-                'long_name': 'depth from surface to midpoint of layer',
-                'positive': 'down',
-            },
-        )
+    cols : slice or array of int, optional
+      Columns (`nlon` dimension) to read. Default is all columns.
+
+    Returns
+    -------
+
+    arrays : list of numpy.ndarray
+      One array per record.
+    """
+    if rows is None:
+        rows = slice(None)
+    if cols is None:
+        cols = slice(None)
+
+    mm = _memmap_grid_file(fname, (len(horiz_grid_records), nlat, nlon), '>f8')
+    arrays = []
+    for record in records:
+        field = mm[horiz_grid_records.index(record), rows]
+        if isinstance(cols, slice):
+            field = np.array(field[:, cols], dtype=np.float64)
+        else:
+            # fancy indexing already copies; swap bytes in that copy
+            field = np.asarray(field[:, cols])
+            if not field.dtype.isnative:
+                field = field.byteswap(inplace=True).view(field.dtype.newbyteorder())
+        arrays.append(field)
+    del mm
+    return arrays
+
+
+def read_int_field(fname, nlat, nlon, rows=None, cols=None):
+    """Read a POP integer field (e.g., KMT, REGION_MASK) from a binary file.
+
+    Parameters
+    ----------
+
+    fname : str
+      Path to big-endian (`ieeei4`) file.
+
+    nlat, nlon : int
+      Lateral dimensions of the grid.
+
+    rows : slice, optional
+      Range of rows (`nlat` dimension) to read. Default is all rows.
 
-        dso['dz'] = xr.DataArray(
-            dz,
-            dims=('z_t'),
-            coords={'z_t': dso.z_t},
-            attrs={'units': 'cm', 'long_name': 'thickness of layer k'},
+    cols : slice or array of int, optional
+      Columns (`nlon` dimension) to read. Default is all columns.
+
+    Returns
+    -------
+
+    field : numpy.ndarray
+      Native-endian int32 array.
+    """
+    if rows is None:
+        rows = slice(None)
+    if cols is None:
+        cols = slice(None)
+
+    mm = _memmap_grid_file(fname, (nlat, nlon), '>i4')
+    field = np.array(mm[rows][:, cols], dtype=np.int32)
+    del mm
+    return field
+
+
+class _GridFields(object):
+    """Intermediate fields of a POP grid, each computed on first access.
+
+    Fields are in the units of the input files (radians, cm), except for
+    the SCRIP corners, which are in degrees of type `corner_dtype`. Reading
+    or computing a field triggers only the fields it depends on. Lateral fields
+    cover the window `rows` x `cols` (half-open index ranges) of the global
+    grid; the extra rows and columns needed at the window edges, including
+    the zonal wrap, are read from the input files.
+    """
+
+    def __init__(self, grid_attrs, rows=None, cols=None, corner_dtype=np.float64):
+        self.grid_attrs = grid_attrs
+        self.nlat, self.nlon = grid_attrs['lateral_dims']
+        self.rows = rows or (0, self.nlat)
+        self.cols = cols or (0, self.nlon)
+        self.corner_dtype = corner_dtype
+        self._fields = {}
+
+    def __getitem__(self, name):
+        if name not in self._fields:
+            if name in horiz_grid_records:
+                self._fields[name] = self._read_horiz_grid(name, *self.rows)
+            else:
+                getattr(self, f'_compute_{_field_groups.get(name, name)}')()
+        return self._fields[name]
+
+    def _read_horiz_grid(self, record, j0, j1, west_halo=False, east_halo=False):
+        """Read rows `j0:j1` of a record, adding the columns west/east of the window."""
+        i0, i1 = self.cols
+        if west_halo or east_halo:
+            cols = np.arange(i0 - west_halo, i1 + east_halo) % self.nlon
+        else:
+            cols = slice(i0, i1)
+        (field,) = read_horiz_grid(
+            self.grid_attrs['horiz_grid_fname'],
+            self.nlat,
+            self.nlon,
+            [record],
+            rows=slice(j0, j1),
+            cols=cols,
+        )
+        return field
+
+    def _compute_TLAT_TLONG(self):
+        j0, j1 = self.rows
+        ni = self.cols[1] - self.cols[0]
+
+        # the bottom row is extrapolated from the two rows above it
+        jt0 = max(j0, 1)
+        jt1 = max(j1, 3) if j0 == 0 else j1
+
+        ULAT = self._read_horiz_grid('ULAT', jt0 - 1, jt1, west_halo=True)
+        ULONG = self._read_horiz_grid('ULONG', jt0 - 1, jt1, west_halo=True)
+
+        TLAT = np.empty((jt1 - j0, ni), dtype=np.float64)
+        TLONG = np.empty((jt1 - j0, ni), dtype=np.float64)
+        _compute_TLAT_TLONG(ULAT, ULONG, TLAT[jt0 - j0 :], TLONG[jt0 - j0 :])
+
+        if j0 == 0:
+            TLAT[0, :] = TLAT[1, :] - (TLAT[2, :] - TLAT[1, :])
+            TLONG[0, :] = TLONG[1, :] - (TLONG[2, :] - TLONG[1, :])
+
+        self._fields.update(TLAT=TLAT[: j1 - j0], TLONG=TLONG[: j1 - j0])
+
+    def _compute_DXT(self):
+        j0, j1 = self.rows
+        if j0 == 0:
+            # the row south of the grid is extrapolated
+            HTN = self._read_horiz_grid('HTN', 0, max(j1, 2))
+            DXT = np.empty(HTN.shape)
+            DXT[1:, :] = 0.5 * (HTN[:-1, :] + HTN[1:, :])
+            DXT[0, :] = 0.5 * (2 * HTN[0, :] - HTN[1, :] + HTN[0, :])
+            DXT = DXT[:j1, :]
+        else:
+            HTN = self._read_horiz_grid('HTN', j0 - 1, j1)
+            DXT = 0.5 * (HTN[:-1, :] + HTN[1:, :])
+        self._fields['DXT'] = DXT
+
+    def _compute_DYT(self):
+        HTE = self._read_horiz_grid('HTE', *self.rows, west_halo=True)
+        self._fields['DYT'] = 0.5 * (HTE[:, :-1] + HTE[:, 1:])
+
+    def _compute_TAREA(self):
+        self._fields['TAREA'] = self['DXT'] * self['DYT']
+
+    def _compute_U_metrics(self):
+        j0, j1 = self.rows
+        ni = self.cols[1] - self.cols[0]
+
+        # one row and column of halo on each side, where the grid has them
+        ja, jb = max(j0 - 1, 0), min(j1 + 1, self.nlat)
+        HTN, HTE, ANGLE = [
+            self._read_horiz_grid(record, ja, jb, west_halo=True, east_halo=True)
+            for record in ['HTN', 'HTE', 'ANGLE']
+        ]
+
+        fields = {name: np.empty((j1 - j0, ni)) for name in ['DXU', 'DYU', 'UAREA', 'ANGLET']}
+        _compute_U_metrics(
+            HTN,
+            HTE,
+            ANGLE,
+            j0 - ja,
+            fields['DXU'],
+            fields['DYU'],
+            fields['UAREA'],
+            fields['ANGLET'],
+        )
+        self._fields.update(fields)
+
+    def _compute_vertical_grid(self):
+        tmp = np.loadtxt(self.grid_attrs['vert_grid_file'])
+        dz = tmp[:, 0]
+        depth_edges = np.concatenate(([0.0], np.cumsum(dz)))
+        self._fields.update(
+            dz=dz,
+            z_w=depth_edges[0:-1],
+            z_w_bot=depth_edges[1:],
+            z_t=depth_edges[0:-1] + 0.5 * dz,
         )
 
-        dso['z_w'] = xr.DataArray(
-            z_w,
-            dims=('z_w'),
-            attrs={
-                'units': 'cm',
-                'positive': 'down',
-                'long_name': 'depth from surface to top of layer',
-            },
+    def _compute_KMT(self):
+        KMT = read_int_field(
+            self.grid_attrs['topography_fname'],
+            self.nlat,
+            self.nlon,
+            rows=slice(*self.rows),
+            cols=slice(*self.cols),
         )
+        assert KMT.max() <= len(self['z_t']), 'Max KMT > length z_t'
+        self._fields['KMT'] = KMT
+
+    def _compute_REGION_MASK(self):
+        self._fields['REGION_MASK'] = read_int_field(
+            self.grid_attrs['region_mask_fname'],
+            self.nlat,
+            self.nlon,
+            rows=slice(*self.rows),
+            cols=slice(*self.cols),
+        )
+
+    def _compute_corners(self):
+        j0, j1 = self.rows
+        i0, i1 = self.cols
+        if j0 == 0:
+            # corners south of the grid are extrapolated
+            ju0, ju1 = 0, max(j1, 2)
+        else:
+            ju0, ju1 = j0 - 1, j1
+        ULAT = self._read_horiz_grid('ULAT', ju0, ju1, west_halo=True)
+        ULONG = self._read_horiz_grid('ULONG', ju0, ju1, west_halo=True)
+
+        corner_lat = np.empty((j1 - j0, i1 - i0, 4), dtype=self.corner_dtype)
+        corner_lon = np.empty((j1 - j0, i1 - i0, 4), dtype=self.corner_dtype)
+        _compute_corners(ULAT, ULONG, corner_lat, corner_lon, j0 == 0)
+        self._fields.update(corner_lat=corner_lat, corner_lon=corner_lon)
 
-        dso['z_w_bot'] = xr.DataArray(
-            z_w_bot,
-            dims=('z_w_bot'),
-            attrs={
-                'units': 'cm',
-                'positive': 'down',
-                'long_name': 'depth from surface to bottom of layer',
-            },
+
+def _grid_field_block(grid_attrs, name, corner_dtype, block_info=None):
+    """Compute one block of a lateral grid field."""
+    location = block_info[None]['array-location']
+    fields = _GridFields(grid_attrs, rows=location[0], cols=location[1], corner_dtype=corner_dtype)
+    return fields[name]
+
+
+class _DaskGridFields(object):
+    """Intermediate fields of a POP grid as dask arrays.
+
+    Each block of a lateral field is computed independently by
+    `_GridFields`, reading only its window (plus halo) of the input files.
+    """
+
+    def __init__(self, grid_attrs, chunks, corner_dtype=np.float64):
+        self.grid_attrs = grid_attrs
+        self.nlat, self.nlon = grid_attrs['lateral_dims']
+        self.chunks = chunks
+        self.corner_dtype = corner_dtype
+        self._vertical_fields = _GridFields(grid_attrs)
+        self._fields = {}
+
+    def __getitem__(self, name):
+        if _field_groups.get(name) == 'vertical_grid':
+            return self._vertical_fields[name]
+
+        if name not in self._fields:
+            chunks = self.chunks
+            dtype = np.float64
+            if name in ['corner_lat', 'corner_lon']:
+                chunks = chunks + ((4,),)
+                dtype = self.corner_dtype
+            elif name in ['KMT', 'REGION_MASK']:
+                dtype = np.int32
+            token = dask.base.tokenize(self.grid_attrs, name, chunks, dtype)
+            self._fields[name] = dask.array.map_blocks(
+                _grid_field_block,
+                self.grid_attrs,
+                name,
+                self.corner_dtype,
+                chunks=chunks,
+                dtype=dtype,
+                name=f'{name}-{token}',
+            )
+        return self._fields[name]
+
+
+def _normalize_grid_chunks(chunks, nlat, nlon):
+    """Return dask chunks for lateral fields from int, tuple or 'auto'."""
+    return dask.array.core.normalize_chunks(chunks, shape=(nlat, nlon), dtype=np.float64)
+
+
+def _rechunk_grid(dso, chunks, nlat, nlon):
+    """Rechunk a grid dataset along (`nlat`, `nlon`), or by rows along `grid_size`."""
+    lat_chunks, lon_chunks = _normalize_grid_chunks(chunks, nlat, nlon)
+    if 'grid_size' in dso.dims:
+        dims = {'grid_size': tuple(n * nlon for n in lat_chunks)}
+    else:
+        dims = {'nlat': lat_chunks, 'nlon': lon_chunks}
+    return dso.chunk({dim: dim_chunks for dim, dim_chunks in dims.items() if dim in dso.dims})
+
+
+# fields computed together
+_field_groups = {
+    'TLAT': 'TLAT_TLONG',
+    'TLONG': 'TLAT_TLONG',
+    'dz': 'vertical_grid',
+    'z_w': 'vertical_grid',
+    'z_w_bot': 'vertical_grid',
+    'z_t': 'vertical_grid',
+    'corner_lat': 'corners',
+    'corner_lon': 'corners',
+    'DXU': 'U_metrics',
+    'DYU': 'U_metrics',
+    'UAREA': 'U_metrics',
+    'ANGLET': 'U_metrics',
+}
+
+# variables returned by get_grid only if requested or with full_metrics=True
+_full_metric_variables = ['DXU', 'DYU', 'UAREA', 'HUS', 'HUW', 'ANGLE', 'ANGLET']
+
+
+def _with_encoding(da, encoding):
+    da.encoding = encoding
+    return da
+
+
+def _TLONG_positive(fields):
+    TLONG = fields['TLONG']
+    return np.where(TLONG < 0.0, TLONG + 2 * np.pi, TLONG)
+
+
+def _tgrid_attrs(**attrs):
+    return dict(attrs, coordinates='TLONG TLAT')
+
+
+def _ugrid_attrs(**attrs):
+    return dict(attrs, coordinates='ULONG ULAT')
+
+
+# output variables: functions of the grid fields returning DataArrays
+_grid_variables = {
+    'TLAT': lambda f: xr.DataArray(
+        np.rad2deg(f['TLAT']),
+        dims=('nlat', 'nlon'),
+        attrs={'units': 'degrees_north', 'long_name': 'T-grid latitude'},
+    ),
+    'TLONG': lambda f: xr.DataArray(
+        np.rad2deg(_TLONG_positive(f)),
+        dims=('nlat', 'nlon'),
+        attrs={'units': 'degrees_east', 'long_name': 'T-grid longitude'},
+    ),
+    'ULAT': lambda f: xr.DataArray(
+        np.rad2deg(f['ULAT']),
+        dims=('nlat', 'nlon'),
+        attrs={'units': 'degrees_north', 'long_name': 'U-grid latitude'},
+    ),
+    'ULONG': lambda f: xr.DataArray(
+        np.rad2deg(f['ULONG']),
+        dims=('nlat', 'nlon'),
+        attrs={'units': 'degrees_east', 'long_name': 'U-grid longitude'},
+    ),
+    'DXT': lambda f: xr.DataArray(
+        f['DXT'],
+        dims=('nlat', 'nlon'),
+        attrs=_tgrid_attrs(units='cm', long_name='x-spacing centered at T points'),
+    ),
+    'DYT': lambda f: xr.DataArray(
+        f['DYT'],
+        dims=('nlat', 'nlon'),
+        attrs=_tgrid_attrs(units='cm', long_name='y-spacing centered at T points'),
+    ),
+    'TAREA': lambda f: xr.DataArray(
+        f['TAREA'],
+        dims=('nlat', 'nlon'),
+        attrs=_tgrid_attrs(units='cm^2', long_name='area of T cells'),
+    ),
+    'DXU': lambda f: xr.DataArray(
+        f['DXU'],
+        dims=('nlat', 'nlon'),
+        attrs=_ugrid_attrs(units='cm', long_name='x-spacing centered at U points'),
+    ),
+    'DYU': lambda f: xr.DataArray(
+        f['DYU'],
+        dims=('nlat', 'nlon'),
+        attrs=_ugrid_attrs(units='cm', long_name='y-spacing centered at U points'),
+    ),
+    'UAREA': lambda f: xr.DataArray(
+        f['UAREA'],
+        dims=('nlat', 'nlon'),
+        attrs=_ugrid_attrs(units='cm^2', long_name='area of U cells'),
+    ),
+    'HUS': lambda f: xr.DataArray(
+        f['HUS'],
+        dims=('nlat', 'nlon'),
+        attrs=_tgrid_attrs(units='cm', long_name='U cell widths on South sides of T cell'),
+    ),
+    'HUW': lambda f: xr.DataArray(
+        f['HUW'],
+        dims=('nlat', 'nlon'),
+        attrs=_tgrid_attrs(units='cm', long_name='U cell widths on West sides of T cell'),
+    ),
+    'ANGLE': lambda f: xr.DataArray(
+        f['ANGLE'],
+        dims=('nlat', 'nlon'),
+        attrs=_ugrid_attrs(units='radians', long_name='angle grid makes with latitude line'),
+    ),
+    'ANGLET': lambda f: xr.DataArray(
+        f['ANGLET'],
+        dims=('nlat', 'nlon'),
+        attrs=_tgrid_attrs(
+            units='radians', long_name='angle grid makes with latitude line on T grid'
+        ),
+    ),
+    'KMT': lambda f: xr.DataArray(
+        f['KMT'],
+        dims=('nlat', 'nlon'),
+        attrs=_tgrid_attrs(long_name='k Index of Deepest Grid Cell on T Grid'),
+    ),
+    'REGION_MASK': lambda f: xr.DataArray(
+        f['REGION_MASK'],
+        dims=('nlat', 'nlon'),
+        attrs=_tgrid_attrs(long_name='basin index number (signed integers)'),
+    ),
+    'z_t': lambda f: xr.DataArray(
+        f['z_t'],
+        dims=('z_t'),
+        name='z_t',
+        attrs={
+            'units': 'cm',
+            'long_name': 'depth from surface to midpoint of layer',
+            'positive': 'down',
+        },
+    ),
+    'dz': lambda f: xr.DataArray(
+        f['dz'],
+        dims=('z_t'),
+        coords={'z_t': _grid_variables['z_t'](f)},
+        attrs={'units': 'cm', 'long_name': 'thickness of layer k'},
+    ),
+    'z_w': lambda f: xr.DataArray(
+        f['z_w'],
+        dims=('z_w'),
+        attrs={
+            'units': 'cm',
+            'positive': 'down',
+            'long_name': 'depth from surface to top of layer',
+        },
+    ),
+    'z_w_bot': lambda f: xr.DataArray(
+        f['z_w_bot'],
+        dims=('z_w_bot'),
+        attrs={
+            'units': 'cm',
+            'positive': 'down',
+            'long_name': 'depth from surface to bottom of layer',
+        },
+    ),
+}
+
+_scrip_variables = {
+    'grid_dims': lambda f: _with_encoding(
+        xr.DataArray(np.array([f.nlon, f.nlat], dtype=np.int32), dims=('grid_rank',)),
+        {'dtype': np.int32, '_FillValue': None},
+    ),
+    'grid_center_lat': lambda f: _with_encoding(
+        xr.DataArray(
+            np.rad2deg(f['TLAT'].reshape((-1,))).astype(f.corner_dtype, copy=False),
+            dims=('grid_size'),
+            attrs={'units': 'degrees'},
+        ),
+        {'dtype': f.corner_dtype, '_FillValue': None},
+    ),
+    'grid_center_lon': lambda f: _with_encoding(
+        xr.DataArray(
+            np.rad2deg(f['TLONG'].reshape((-1,))).astype(f.corner_dtype, copy=False),
+            dims=('grid_size'),
+            attrs={'units': 'degrees'},
+        ),
+        {'dtype': f.corner_dtype, '_FillValue': None},
+    ),
+    'grid_corner_lat': lambda f: _with_encoding(
+        xr.DataArray(
+            f['corner_lat'].reshape((-1, 4)),
+            dims=('grid_size', 'grid_corners'),
+            attrs={'units': 'degrees'},
+        ),
+        {'dtype': f.corner_dtype, '_FillValue': None},
+    ),
+    'grid_corner_lon': lambda f: _with_encoding(
+        xr.DataArray(
+            f['corner_lon'].reshape((-1, 4)),
+            dims=('grid_size', 'grid_corners'),
+            attrs={'units': 'degrees'},
+        ),
+        {'dtype': f.corner_dtype, '_FillValue': None},
+    ),
+    'grid_imask': lambda f: _with_encoding(
+        xr.DataArray(
+            np.where(f['KMT'] > 0, 1, 0).reshape((-1,)),
+            dims=('grid_size'),
+            attrs={'units': 'unitless'},
+        ),
+        {'dtype': np.int32, '_FillValue': None},
+    ),
+}
+
+
+def _check_variables(variables, scrip, full_metrics=False):
+    """Return the output variables in canonical order, validating `variables`."""
+    available = list(_scrip_variables if scrip else _grid_variables)
+    if variables is None:
+        if full_metrics:
+            return available
+        return [v for v in available if v not in _full_metric_variables]
+    if isinstance(variables, str):
+        variables = [variables]
+    unknown = [v for v in variables if v not in available]
+    if unknown:
+        raise ValueError(
+            f"""Unknown variable(s): {unknown}
+             Please select from the following: {available}"""
         )
+    return [v for v in available if v in variables]
+
+
+def _compute_grid(grid_name, scrip, variables=None, chunks=None, dtype=np.float64):
+    """Generate POP grid dataset from input files."""
+
+    grid_attrs = copy.deepcopy(grid_defs[grid_name])
+    if chunks is None:
+        fields = _GridFields(grid_attrs, corner_dtype=dtype)
+    else:
+        nlat, nlon = grid_attrs['lateral_dims']
+        chunks = _normalize_grid_chunks(chunks, nlat, nlon)
+        fields = _DaskGridFields(grid_attrs, chunks, corner_dtype=dtype)
+    output_variables = _scrip_variables if scrip else _grid_variables
+
+    dso = xr.Dataset()
+    for name in _check_variables(variables, scrip):
+        dso[name] = output_variables[name](fields)
+
+    if scrip:
+        grid_attrs.update({'conventions': 'SCRIP'})
 
     grid_attrs.update({'title': f'{grid_name} grid'})
     dso.attrs = grid_attrs
@@ -238,33 +736,35 @@ def get_grid(grid_name, scrip=False):
 
 
 @jit(nopython=True, parallel=True)
-def _compute_TLAT_TLONG(ULAT, ULONG, TLAT, TLONG, nlat, nlon):
-    """Compute TLAT and TLONG from ULAT, ULONG"""
+def _compute_TLAT_TLONG(ULAT, ULONG, TLAT, TLONG):
+    """Compute TLAT and TLONG from ULAT, ULONG
 
-    for j in prange(1, nlat):
-        jm1 = j - 1
-        for i in prange(0, nlon):
-            im1 = np.mod(i - 1 + nlon, nlon)
+    ULAT and ULONG have one more row and column than TLAT and TLONG:
+    the row to the south and the column to the west of the T points.
+    """
 
-            tmp = np.cos(ULAT[jm1, im1])
-            xsw = np.cos(ULONG[jm1, im1]) * tmp
-            ysw = np.sin(ULONG[jm1, im1]) * tmp
-            zsw = np.sin(ULAT[jm1, im1])
+    nj, ni = TLAT.shape
+    for j in prange(0, nj):
+        for i in prange(0, ni):
+            tmp = np.cos(ULAT[j, i])
+            xsw = np.cos(ULONG[j, i]) * tmp
+            ysw = np.sin(ULONG[j, i]) * tmp
+            zsw = np.sin(ULAT[j, i])
 
-            tmp = np.cos(ULAT[jm1, i])
-            xse = np.cos(ULONG[jm1, i]) * tmp
-            yse = np.sin(ULONG[jm1, i]) * tmp
-            zse = np.sin(ULAT[jm1, i])
+            tmp = np.cos(ULAT[j, i + 1])
+            xse = np.cos(ULONG[j, i + 1]) * tmp
+            yse = np.sin(ULONG[j, i + 1]) * tmp
+            zse = np.sin(ULAT[j, i + 1])
 
-            tmp = np.cos(ULAT[j, im1])
-            xnw = np.cos(ULONG[j, im1]) * tmp
-            ynw = np.sin(ULONG[j, im1]) * tmp
-            znw = np.sin(ULAT[j, im1])
+            tmp = np.cos(ULAT[j + 1, i])
+            xnw = np.cos(ULONG[j + 1, i]) * tmp
+            ynw = np.sin(ULONG[j + 1, i]) * tmp
+            znw = np.sin(ULAT[j + 1, i])
 
-            tmp = np.cos(ULAT[j, i])
-            xne = np.cos(ULONG[j, i]) * tmp
-            yne = np.sin(ULONG[j, i]) * tmp
-            zne = np.sin(ULAT[j, i])
+            tmp = np.cos(ULAT[j + 1, i + 1])
+            xne = np.cos(ULONG[j + 1, i + 1]) * tmp
+            yne = np.sin(ULONG[j + 1, i + 1]) * tmp
+            zne = np.sin(ULAT[j + 1, i + 1])
 
             xc = 0.25 * (xsw + xse + xnw + xne)
             yc = 0.25 * (ysw + yse + ynw + yne)
@@ -275,36 +775,89 @@ def _compute_TLAT_TLONG(ULAT, ULONG, TLAT, TLONG, nlat, nlon):
             TLAT[j, i] = np.arcsin(zc / r)
             TLONG[j, i] = np.arctan2(yc, xc)
 
-    # generate bottom row
-    TLAT[0, :] = TLAT[1, :] - (TLAT[2, :] - TLAT[1, :])
-    TLONG[0, :] = TLONG[1, :] - (TLONG[2, :] - TLONG[1, :])
 
+@jit(nopython=True, parallel=True)
+def _compute_corners(ULAT, ULONG, corner_lat, corner_lon, extrapolate_south):
+    """Compute SCRIP grid corners in degrees.
+
+    ULAT and ULONG (radians) include the column to the west of the cells.
+    If `extrapolate_south`, the first row is the southern boundary of the grid
+    and its southern corners are extrapolated from the 2 rows above;
+    otherwise the first row lies to the south of the cells. Corners are
+    written counterclockwise (NE, NW, SW, SE) to `corner_lat` and
+    `corner_lon`, arrays of shape (nlat, nlon, 4).
+    """
+
+    rad2deg = 180.0 / np.pi
+    nlat, nlon = corner_lat.shape[0], corner_lat.shape[1]
 
-def _compute_corners(ULAT, ULONG):
-    """Compute grid corners."""
+    # offset of the row of ULAT, ULONG north of each cell
+    jn = 0 if extrapolate_south else 1
 
-    nlat, nlon = ULAT.shape
-    corner_lat = np.empty((nlat, nlon, 4), dtype=np.float)
-    corner_lon = np.empty((nlat, nlon, 4), dtype=np.float)
+    for j in prange(0, nlat):
+        ju = j + jn
+        for i in range(0, nlon):
+            # NE corner
+            corner_lat[j, i, 0] = ULAT[ju, i + 1] * rad2deg
+            corner_lon[j, i, 0] = ULONG[ju, i + 1] * rad2deg
 
-    # NE corner
-    corner_lat[:, :, 0] = ULAT
-    corner_lon[:, :, 0] = ULONG
+            # NW corner (NE corner of column to the left)
+            corner_lat[j, i, 1] = ULAT[ju, i] * rad2deg
+            corner_lon[j, i, 1] = ULONG[ju, i] * rad2deg
 
-    # NW corner (copy from NE corner of column to the left, assume zonal periodic bc)
-    corner_lat[:, :, 1] = np.roll(corner_lat[:, :, 0], 1, axis=1)
-    corner_lon[:, :, 1] = np.roll(corner_lon[:, :, 0], 1, axis=1)
+            if ju > 0:
+                # SW corner (NW corner of row below)
+                corner_lat[j, i, 2] = ULAT[ju - 1, i] * rad2deg
+                corner_lon[j, i, 2] = ULONG[ju - 1, i] * rad2deg
 
-    # SW corner (copy from NW corner of row below, bottom row is extrapolated from 2 rows above)
-    corner_lat[1:nlat, :, 2] = corner_lat[0 : nlat - 1, :, 1]
-    corner_lon[1:nlat, :, 2] = corner_lon[0 : nlat - 1, :, 1]
-    corner_lat[0, :, 2] = corner_lat[1, :, 2] - (corner_lat[2, :, 2] - corner_lat[1, :, 2])
-    corner_lon[0, :, 2] = corner_lon[1, :, 2] - (corner_lon[2, :, 2] - corner_lon[1, :, 2])
+                # SE corner (NE corner of row below)
+                corner_lat[j, i, 3] = ULAT[ju - 1, i + 1] * rad2deg
+                corner_lon[j, i, 3] = ULONG[ju - 1, i + 1] * rad2deg
 
-    # SE corner (copy from NE corner of row below, bottom row is extrapolated from 2 rows above)
-    corner_lat[1:nlat, :, 3] = corner_lat[0 : nlat - 1, :, 0]
-    corner_lon[1:nlat, :, 3] = corner_lon[0 : nlat - 1, :, 0]
-    corner_lat[0, :, 3] = corner_lat[1, :, 3] - (corner_lat[2, :, 3] - corner_lat[1, :, 3])
-    corner_lon[0, :, 3] = corner_lon[1, :, 3] - (corner_lon[2, :, 3] - corner_lon[1, :, 3])
+            else:
+                # bottom row is extrapolated from 2 rows above
+                corner_lat[j, i, 2] = (ULAT[0, i] - (ULAT[1, i] - ULAT[0, i])) * rad2deg
+                corner_lon[j, i, 2] = (ULONG[0, i] - (ULONG[1, i] - ULONG[0, i])) * rad2deg
+
+                corner_lat[j, i, 3] = (
+                    ULAT[0, i + 1] - (ULAT[1, i + 1] - ULAT[0, i + 1])
+                ) * rad2deg
+                corner_lon[j, i, 3] = (
+                    ULONG[0, i + 1] - (ULONG[1, i + 1] - ULONG[0, i + 1])
+                ) * rad2deg
+
+
+@jit(nopython=True, parallel=True)
+def _compute_U_metrics(HTN, HTE, ANGLE, joff, DXU, DYU, UAREA, ANGLET):
+    """Compute DXU, DYU, UAREA and ANGLET from HTN, HTE, ANGLE
+
+    HTN, HTE and ANGLE include the columns to the west and east of the
+    output and the rows to the south and north of it, except where the
+    output reaches the boundary of the grid; `joff` is the row of the
+    inputs corresponding to the first output row. The row of HTE north of
+    the grid is extrapolated; ANGLET on the bottom row averages the two
+    U points to its north.
+    """
 
-    return corner_lat, corner_lon
+    nj, ni = DXU.shape
+    nr = HTN.shape[0]
+    for j in prange(0, nj):
+        jj = j + joff
+        for i in range(0, ni):
+            ii = i + 1
+
+            dxu = 0.5 * (HTN[jj, ii] + HTN[jj, ii + 1])
+            if jj + 1 < nr:
+                dyu = 0.5 * (HTE[jj, ii] + HTE[jj + 1, ii])
+            else:
+                dyu = 0.5 * (HTE[jj, ii] + 2 * HTE[jj, ii] - HTE[jj - 1, ii])
+            DXU[j, i] = dxu
+            DYU[j, i] = dyu
+            UAREA[j, i] = dxu * dyu
+
+            s = np.sin(ANGLE[jj, ii - 1]) + np.sin(ANGLE[jj, ii])
+            c = np.cos(ANGLE[jj, ii - 1]) + np.cos(ANGLE[jj, ii])
+            if jj > 0:
+                s += np.sin(ANGLE[jj - 1, ii - 1]) + np.sin(ANGLE[jj - 1, ii])
+                c += np.cos(ANGLE[jj - 1, ii - 1]) + np.cos(ANGLE[jj - 1, ii])
+            ANGLET[j, i] = np.arctan2(s, c)
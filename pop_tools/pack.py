@@ -0,0 +1,270 @@
+"""Compressed storage of the ocean points of POP fields."""
+
+import dask.array
+import numpy as np
+import xarray as xr
+from numba import jit, prange
+
+from .grid import get_grid
+
+
+class OceanIndex(object):
+    """Gather/scatter index of the ocean points of a POP grid.
+
+    Fields on the grid, with trailing dimensions (`z_t`, `nlat`, `nlon`) or
+    (`nlat`, `nlon`), are packed into a dense trailing `ocean_point`
+    dimension holding only the points above the sea floor, i.e. level `k`
+    of column `(j, i)` if `k < KMT[j, i]`. Packed points are ordered by
+    level, then row, then column. The index itself is just `KMT` and one
+    offset per level.
+
+    Parameters
+    ----------
+
+    KMT : numpy.ndarray
+      Index of the deepest ocean level (1-based; 0 on land), shape
+      (`nlat`, `nlon`).
+
+    nz : int, optional
+      Number of vertical levels; default is `KMT.max()`.
+
+    dims : tuple of str, optional
+      Dimension names of unpacked 3D DataArrays; the last two are used for
+      unpacked 2D DataArrays.
+    """
+
+    point_dim = 'ocean_point'
+
+    def __init__(self, KMT, nz=None, dims=('z_t', 'nlat', 'nlon')):
+        self.KMT = np.ascontiguousarray(KMT, dtype=np.int32)
+        self.nlat, self.nlon = self.KMT.shape
+        self.nz = int(self.KMT.max()) if nz is None else nz
+        if self.KMT.max() > self.nz:
+            raise ValueError(f'KMT exceeds the number of levels: {self.KMT.max()} > {self.nz}')
+        self.dims = tuple(dims)
+
+        # number of ocean points at or below each level
+        counts = self.KMT.size - np.cumsum(np.bincount(self.KMT.ravel(), minlength=self.nz + 1))
+        self.offsets = np.concatenate(([0], np.cumsum(counts[: self.nz])))
+
+    @classmethod
+    def from_grid(cls, grid_name):
+        """Return the `OceanIndex` of a grid in `pop_tools.grid_defs`."""
+        ds = get_grid(grid_name, variables=['KMT', 'z_t'])
+        return cls(ds.KMT.values, nz=ds.sizes['z_t'])
+
+    @property
+    def size(self):
+        """Number of ocean points in a 3D field."""
+        return int(self.offsets[-1])
+
+    @property
+    def size_2d(self):
+        """Number of ocean points in a 2D field."""
+        return int(self.offsets[1])
+
+    def _lateral_shape(self, ndim):
+        return (self.nz, self.nlat, self.nlon) if ndim == 3 else (self.nlat, self.nlon)
+
+    def _unpacked_ndim(self, shape, vertical=None):
+        """Return 3 or 2 if `shape` ends with the 3D or 2D grid dimensions."""
+        ndims = [3, 2] if vertical is None else [3 if vertical else 2]
+        matches = [ndim for ndim in ndims if tuple(shape[-ndim:]) == self._lateral_shape(ndim)]
+        if len(matches) > 1:
+            raise ValueError(
+                f'trailing dimensions {tuple(shape)} match both the 3D and the 2D grid; '
+                'please specify vertical=True or vertical=False'
+            )
+        if matches:
+            return matches[0]
+        raise ValueError(
+            f'trailing dimensions {tuple(shape)} do not match the grid: '
+            f'{self._lateral_shape(3)} or {self._lateral_shape(2)}'
+        )
+
+    def _packed_ndim(self, npoints):
+        """Return 3 or 2 if `npoints` is the size of a packed 3D or 2D field."""
+        if npoints == self.size:
+            return 3
+        if npoints == self.size_2d:
+            return 2
+        raise ValueError(
+            f'number of points {npoints} does not match the grid: {self.size} or {self.size_2d}'
+        )
+
+    def pack(self, arr, out=None, vertical=None):
+        """Pack the ocean points of a field.
+
+        Parameters
+        ----------
+
+        arr : numpy.ndarray, dask.array.Array or xarray.DataArray
+          Field with trailing dimensions (`nz`, `nlat`, `nlon`) or
+          (`nlat`, `nlon`).
+
+        out : numpy.ndarray, optional
+          C-contiguous array into which to pack a numpy `arr`.
+
+        vertical : boolean, optional
+          Whether `arr` is a 3D field. By default, DataArrays are 3D if they
+          have the vertical dimension of `dims`; other fields are 3D or 2D
+          according to their trailing shape, which is ambiguous (and raises
+          a ValueError) if the third-to-last dimension has length `nz`.
+
+        Returns
+        -------
+
+        packed : same type as `arr`
+          Field with the trailing dimensions replaced by `ocean_point`. If
+          there is no land, a numpy `arr` is reshaped without copying.
+        """
+        if isinstance(arr, xr.DataArray):
+            if vertical is None and self.dims[0] in arr.dims:
+                if arr.dims[-3:] != self.dims:
+                    raise ValueError(f'dimensions {arr.dims} do not end with {self.dims}')
+                vertical = True
+            elif vertical is None and arr.dims[-2:] == self.dims[-2:]:
+                vertical = False
+            ndim = self._unpacked_ndim(arr.shape, vertical)
+            lead_dims = arr.dims[:-ndim]
+            return xr.DataArray(
+                self.pack(arr.data, vertical=ndim == 3),
+                dims=lead_dims + (self.point_dim,),
+                coords={k: v for k, v in arr.coords.items() if set(v.dims) <= set(lead_dims)},
+                attrs=arr.attrs,
+                name=arr.name,
+            )
+
+        ndim = self._unpacked_ndim(arr.shape, vertical)
+        lead_shape = arr.shape[:-ndim]
+        npoints = self.size if ndim == 3 else self.size_2d
+
+        if isinstance(arr, dask.array.Array):
+            arr = arr.rechunk({axis: -1 for axis in range(arr.ndim - ndim, arr.ndim)})
+            return arr.map_blocks(
+                self.pack,
+                vertical=ndim == 3,
+                drop_axis=list(range(arr.ndim - ndim + 1, arr.ndim)),
+                chunks=arr.chunks[:-ndim] + ((npoints,),),
+                dtype=arr.dtype,
+            )
+
+        arr = np.asarray(arr)
+        if out is None and npoints == np.prod(arr.shape[-ndim:]):
+            return arr.reshape(lead_shape + (npoints,))
+        if out is None:
+            out = np.empty(lead_shape + (npoints,), dtype=arr.dtype)
+        _check_out(out, lead_shape + (npoints,))
+        _pack(
+            arr.reshape((-1,) + (1,) * (3 - ndim) + arr.shape[-ndim:]),
+            self.KMT,
+            self.offsets,
+            out.reshape((-1, npoints)),
+        )
+        return out
+
+    def unpack(self, packed, fill_value=np.nan, out=None):
+        """Scatter packed ocean points back onto the grid.
+
+        Parameters
+        ----------
+
+        packed : numpy.ndarray, dask.array.Array or xarray.DataArray
+          Field with trailing dimension `ocean_point`, as returned by
+          `pack`.
+
+        fill_value : scalar, optional [default=numpy.nan]
+          Value of the points below the sea floor; if `None`, they are left
+          untouched in `out`.
+
+        out : numpy.ndarray, optional
+          C-contiguous array into which to unpack a numpy `packed`.
+
+        Returns
+        -------
+
+        arr : same type as `packed`
+          Field with trailing dimensions (`nz`, `nlat`, `nlon`) or
+          (`nlat`, `nlon`). If there is no land, a numpy `packed` is
+          reshaped without copying.
+        """
+        if isinstance(packed, xr.DataArray):
+            ndim = self._packed_ndim(packed.shape[-1])
+            lead_dims = packed.dims[:-1]
+            return xr.DataArray(
+                self.unpack(packed.data, fill_value=fill_value),
+                dims=lead_dims + self.dims[-ndim:],
+                coords={k: v for k, v in packed.coords.items() if self.point_dim not in v.dims},
+                attrs=packed.attrs,
+                name=packed.name,
+            )
+
+        npoints = packed.shape[-1]
+        ndim = self._packed_ndim(npoints)
+        lead_shape = packed.shape[:-1]
+        lateral_shape = self._lateral_shape(ndim)
+
+        if isinstance(packed, dask.array.Array):
+            packed = packed.rechunk({packed.ndim - 1: -1})
+            return packed.map_blocks(
+                self.unpack,
+                fill_value,
+                new_axis=list(range(packed.ndim, packed.ndim + ndim - 1)),
+                chunks=packed.chunks[:-1] + tuple((n,) for n in lateral_shape),
+                dtype=packed.dtype,
+            )
+
+        packed = np.asarray(packed)
+        if out is None and npoints == np.prod(lateral_shape):
+            return packed.reshape(lead_shape + lateral_shape)
+        if out is None:
+            out = np.empty(lead_shape + lateral_shape, dtype=packed.dtype)
+            if fill_value is None:
+                fill_value = np.nan
+        _check_out(out, lead_shape + lateral_shape)
+        if fill_value is not None:
+            out.fill(fill_value)
+        _unpack(
+            packed.reshape((-1, npoints)),
+            self.KMT,
+            self.offsets,
+            out.reshape((-1,) + (1,) * (3 - ndim) + lateral_shape),
+        )
+        return out
+
+
+def _check_out(out, shape):
+    if out.shape != shape or not out.flags.c_contiguous:
+        raise ValueError(f'out must be a C-contiguous array of shape {shape}')
+
+
+@jit(nopython=True, parallel=True)
+def _pack(arr, KMT, offsets, out):
+    """Gather the ocean points of `arr` (n, nz, nlat, nlon) into `out` (n, npoints)."""
+
+    n, nz, nlat, nlon = arr.shape
+    for m in prange(0, n * nz):
+        s = m // nz
+        k = m % nz
+        p = offsets[k]
+        for j in range(0, nlat):
+            for i in range(0, nlon):
+                if KMT[j, i] > k:
+                    out[s, p] = arr[s, k, j, i]
+                    p += 1
+
+
+@jit(nopython=True, parallel=True)
+def _unpack(packed, KMT, offsets, out):
+    """Scatter `packed` (n, npoints) onto the ocean points of `out` (n, nz, nlat, nlon)."""
+
+    n, nz, nlat, nlon = out.shape
+    for m in prange(0, n * nz):
+        s = m // nz
+        k = m % nz
+        p = offsets[k]
+        for j in range(0, nlat):
+            for i in range(0, nlon):
+                if KMT[j, i] > k:
+                    out[s, k, j, i] = packed[s, p]
+                    p += 1
@@ -0,0 +1,323 @@
+"""Remapping weights between grids in SCRIP format."""
+
+import dask.array
+import numpy as np
+import xarray as xr
+
+from .cache import grid_cache_path, grid_input_keys, open_cached_object, write_cached_object
+from .config import ensure_inputdata, grid_defs
+from .grid import get_grid
+from .spatial import SpatialIndex, _xyz
+
+remap_methods = ['bilinear', 'nearest']
+
+
+class RemapWeights(object):
+    """Sparse remapping weights from a source to a destination grid.
+
+    Parameters
+    ----------
+
+    matrix : scipy.sparse.csr_matrix
+      Weights, shape (destination grid size, source grid size).
+
+    src_shape, dst_shape : tuple of int
+      Lateral shapes (`nlat`, `nlon`) of the source and destination grids.
+
+    method : str
+      Remapping method the weights were generated with.
+    """
+
+    def __init__(self, matrix, src_shape, dst_shape, method):
+        self.matrix = matrix
+        self.src_shape = tuple(src_shape)
+        self.dst_shape = tuple(dst_shape)
+        self.method = method
+
+
+def _scrip_arrays(ds):
+    """Return the lateral shape, centers and mask of a SCRIP dataset."""
+    nlon, nlat = ds.grid_dims.values
+    lat = ds.grid_center_lat.values.reshape((nlat, nlon))
+    lon = ds.grid_center_lon.values.reshape((nlat, nlon))
+    if 'grid_imask' in ds:
+        mask = ds.grid_imask.values.reshape((nlat, nlon)) == 1
+    else:
+        mask = np.ones((nlat, nlon), dtype=bool)
+    return (nlat, nlon), lat, lon, mask
+
+
+def remap_weights(src, dst, method='bilinear', batch_size=100000):
+    """Compute remapping weights between two grids.
+
+    Weights are computed for the unmasked destination points and refer
+    only to unmasked source points. Bilinear weights interpolate between
+    the four source centers surrounding a destination center; where some
+    of them are masked, the weights of the others are renormalized, and
+    where none is available (e.g., near the tripole fold) the nearest
+    unmasked source point is used. Requires `scipy`.
+
+    Parameters
+    ----------
+
+    src, dst : xarray.Dataset
+      Source and destination grids in SCRIP format, e.g. from
+      `get_grid(grid_name, scrip=True)`.
+
+    method : {'bilinear', 'nearest'}, optional [default='bilinear']
+      Remapping method.
+
+    batch_size : int, optional
+      Number of destination points processed at once.
+
+    Returns
+    -------
+
+    weights : `RemapWeights`
+    """
+    try:
+        from scipy import sparse
+    except ImportError:
+        raise ImportError('remap_weights requires scipy')
+
+    if method not in remap_methods:
+        raise ValueError(f'Unknown method: {method}; please select from {remap_methods}')
+
+    src_shape, src_lat, src_lon, src_mask = _scrip_arrays(src)
+    dst_shape, dst_lat, dst_lon, dst_mask = _scrip_arrays(dst)
+
+    dst_points = np.flatnonzero(dst_mask)
+    dst_lat = dst_lat.reshape((-1,))[dst_points]
+    dst_lon = dst_lon.reshape((-1,))[dst_points]
+
+    nearest_index = SpatialIndex(src_lat, src_lon, mask=src_mask)
+    if method == 'bilinear':
+        index = SpatialIndex(src_lat, src_lon)
+
+    rows, cols, values = [], [], []
+    for start in range(0, len(dst_points), batch_size):
+        batch = slice(start, start + batch_size)
+        lat, lon = dst_lat[batch], dst_lon[batch]
+        points = dst_points[batch]
+
+        if method == 'bilinear':
+            j, i, _ = index.query(lat, lon)
+            corners, weights = _bilinear_weights(lat, lon, j, i, src_lat, src_lon)
+            weights = weights * src_mask.reshape((-1,))[corners]
+            total = weights.sum(axis=1)
+            found = total > 0.0
+            weights[found] /= total[found, np.newaxis]
+
+            nonzero = weights[found] > 0.0
+            rows.append(np.broadcast_to(points[found, np.newaxis], nonzero.shape)[nonzero])
+            cols.append(corners[found][nonzero])
+            values.append(weights[found][nonzero])
+
+            lat, lon, points = lat[~found], lon[~found], points[~found]
+
+        j, i, _ = nearest_index.query(lat, lon)
+        rows.append(points)
+        cols.append(np.ravel_multi_index((j, i), src_shape))
+        values.append(np.ones(len(points)))
+
+    matrix = sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(dst_mask.size, src_mask.size),
+    )
+    return RemapWeights(matrix, src_shape, dst_shape, method)
+
+
+def get_remap_weights(src_grid, dst_grid, method='bilinear', cache=False):
+    """Return remapping weights between two grids in `pop_tools.grid_defs`.
+
+    Parameters
+    ----------
+
+    src_grid, dst_grid : str
+      Names of the source and destination grids.
+
+    method : {'bilinear', 'nearest'}, optional [default='bilinear']
+      Remapping method.
+
+    cache : boolean or str, optional [default=False]
+      If `True`, load the weights from the on-disk grid cache in
+      `pop_tools.config.GRID_CACHE_DIR`, computing and storing them on a
+      cache miss; if a string, use it as the cache directory. Entries are
+      keyed on the grid pair, the method and the contents of the input
+      files of both grids.
+
+    Returns
+    -------
+
+    weights : `RemapWeights`
+    """
+    for grid_name in [src_grid, dst_grid]:
+        if grid_name not in grid_defs:
+            raise ValueError(
+                f"""Unknown grid: {grid_name}
+                 Please select from the following: {list(grid_defs.keys())}"""
+            )
+
+    if cache:
+        ensure_inputdata(src_grid)
+        ensure_inputdata(dst_grid)
+        cache_path = grid_cache_path(
+            src_grid,
+            grid_defs[src_grid],
+            cache_dir=cache if isinstance(cache, str) else None,
+            suffix='.pkl',
+            input_files=[grid_defs[dst_grid][key] for key in grid_input_keys],
+            kind='remap_weights',
+            dst_grid=dst_grid,
+            method=method,
+        )
+        weights = open_cached_object(cache_path)
+        if weights is not None:
+            return weights
+
+    weights = remap_weights(
+        get_grid(src_grid, scrip=True), get_grid(dst_grid, scrip=True), method=method
+    )
+
+    if cache:
+        write_cached_object(weights, cache_path)
+    return weights
+
+
+def apply_weights(weights, field):
+    """Remap a field with precomputed weights.
+
+    All slices of the field are remapped with one sparse matrix product.
+    Source points that are NaN are excluded and the weights of the
+    remaining points renormalized; destination points without weights are
+    NaN.
+
+    Parameters
+    ----------
+
+    weights : `RemapWeights`
+      Weights from `remap_weights` or `get_remap_weights`.
+
+    field : numpy.ndarray, dask.array.Array or xarray.DataArray
+      Field on the source grid, with trailing dimensions (`nlat`, `nlon`).
+      Dask arrays are remapped block by block along the leading dimensions.
+
+    Returns
+    -------
+
+    remapped : same type as `field`
+      Field on the destination grid. DataArrays keep their dimension names
+      and the coordinates not on the lateral dimensions.
+    """
+    if isinstance(field, xr.DataArray):
+        lateral_dims = field.dims[-2:]
+        return xr.DataArray(
+            apply_weights(weights, field.data),
+            dims=field.dims,
+            coords={k: v for k, v in field.coords.items() if not set(v.dims) & set(lateral_dims)},
+            attrs=field.attrs,
+            name=field.name,
+        )
+
+    if tuple(field.shape[-2:]) != weights.src_shape:
+        raise ValueError(
+            f'trailing dimensions of field {field.shape} do not match the source grid '
+            f'{weights.src_shape}'
+        )
+
+    if isinstance(field, dask.array.Array):
+        field = field.rechunk({field.ndim - 2: -1, field.ndim - 1: -1})
+        return dask.array.map_blocks(
+            apply_weights,
+            weights,
+            field,
+            chunks=field.chunks[:-2] + tuple((n,) for n in weights.dst_shape),
+            dtype=np.result_type(field.dtype, np.float32),
+        )
+
+    field = np.asarray(field)
+    lead_shape = field.shape[:-2]
+    src = field.reshape((-1, field.shape[-2] * field.shape[-1])).T
+
+    valid = ~np.isnan(src)
+    if valid.all():
+        numer = weights.matrix @ src
+        denom = weights.matrix @ np.ones((src.shape[0], 1))
+    else:
+        numer = weights.matrix @ np.where(valid, src, 0.0)
+        denom = weights.matrix @ valid.astype(np.float64)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dst = np.where(denom > 0.0, numer / denom, np.nan)
+    dtype = np.result_type(field.dtype, np.float32)
+    return dst.T.reshape(lead_shape + weights.dst_shape).astype(dtype, copy=False)
+
+
+def _bilinear_weights(lat, lon, j, i, src_lat, src_lon, tol=1e-9):
+    """Bilinear weights of points given the nearest source center `(j, i)`.
+
+    The four quadrilaterals of source centers sharing the nearest center
+    are tested in a gnomonic projection about each point. Returns the flat
+    indices of the corners of the containing quadrilaterals (SW, SE, NE,
+    NW) and their weights, shape (npoints, 4); the weights are zero where
+    no quadrilateral contains the point.
+    """
+    nlat, nlon = src_lat.shape
+    points = _xyz(lat, lon)
+
+    # southwest corners of the candidate quadrilaterals, then all corners
+    j0 = j[:, np.newaxis] + np.array([0, 0, -1, -1])
+    i0 = i[:, np.newaxis] + np.array([0, -1, 0, -1])
+    cj = j0[..., np.newaxis] + np.array([0, 0, 1, 1])
+    ci = (i0[..., np.newaxis] + np.array([0, 1, 1, 0])) % nlon
+    valid = (j0 >= 0) & (j0 + 1 < nlat)
+    cj = np.clip(cj, 0, nlat - 1)
+    corners = _xyz(src_lat[cj, ci], src_lon[cj, ci])
+
+    # gnomonic projection on the plane tangent at each point
+    east = np.cross([0.0, 0.0, 1.0], points)
+    norm = np.linalg.norm(east, axis=-1, keepdims=True)
+    east = np.where(norm > 1e-12, east / np.maximum(norm, 1e-12), [1.0, 0.0, 0.0])
+    north = np.cross(points, east)
+    dot = np.einsum('pqcx,px->pqc', corners, points)
+    valid &= (dot > 0.0).all(axis=-1)
+    dot = np.where(dot > 0.0, dot, 1.0)
+    x = np.einsum('pqcx,px->pqc', corners, east) / dot
+    y = np.einsum('pqcx,px->pqc', corners, north) / dot
+
+    a, b = _invert_bilinear(x, y)
+    inside = valid & (a >= -tol) & (a <= 1 + tol) & (b >= -tol) & (b <= 1 + tol)
+
+    n = np.arange(len(points))
+    q = inside.argmax(axis=1)
+    found = inside[n, q]
+    a = np.clip(a[n, q], 0.0, 1.0)
+    b = np.clip(b[n, q], 0.0, 1.0)
+    weights = np.stack([(1 - a) * (1 - b), a * (1 - b), a * b, (1 - a) * b], axis=-1)
+    weights[~found] = 0.0
+    return np.ravel_multi_index((cj[n, q], ci[n, q]), (nlat, nlon)), weights
+
+
+def _invert_bilinear(x, y, niter=20):
+    """Solve for the bilinear coordinates (a, b) of the origin by Newton's method.
+
+    `x` and `y` hold the corners (SW, SE, NE, NW) of quadrilaterals along
+    the last axis.
+    """
+    x0, x1, x2, x3 = np.moveaxis(x, -1, 0)
+    y0, y1, y2, y3 = np.moveaxis(y, -1, 0)
+    xa, xb, xab = x1 - x0, x3 - x0, x0 - x1 + x2 - x3
+    ya, yb, yab = y1 - y0, y3 - y0, y0 - y1 + y2 - y3
+
+    a = np.full(x0.shape, 0.5)
+    b = np.full(x0.shape, 0.5)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(niter):
+            fx = x0 + a * xa + b * xb + a * b * xab
+            fy = y0 + a * ya + b * yb + a * b * yab
+            dxa, dxb = xa + b * xab, xb + a * xab
+            dya, dyb = ya + b * yab, yb + a * yab
+            det = dxa * dyb - dxb * dya
+            a = a - (fx * dyb - fy * dxb) / det
+            b = b - (fy * dxa - fx * dya) / det
+    return a, b
@@ -0,0 +1,201 @@
+"""Spatial index of POP grid cells for nearest-point and point-in-cell queries."""
+
+import numpy as np
+
+from .cache import grid_cache_path, open_cached_object, write_cached_object
+from .config import ensure_inputdata, grid_defs
+from .grid import get_grid
+
+
+def _xyz(lat, lon):
+    """Return unit-sphere Cartesian coordinates of points in degrees, stacked last."""
+    lat = np.deg2rad(lat)
+    lon = np.deg2rad(lon)
+    coslat = np.cos(lat)
+    return np.stack([coslat * np.cos(lon), coslat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class SpatialIndex(object):
+    """Index of the T points and cells of a grid for batched location queries.
+
+    T points are stored in a KD-tree on their 3D unit-sphere coordinates,
+    so that nearest-point queries are exact across the dateline, near the
+    poles and across the tripole fold. Requires `scipy`.
+
+    Parameters
+    ----------
+
+    TLAT, TLONG : numpy.ndarray
+      Latitude and longitude of T points (degrees), shape (`nlat`, `nlon`).
+
+    corner_lat, corner_lon : numpy.ndarray, optional
+      Latitude and longitude (degrees) of the cell corners, in the
+      counterclockwise order of SCRIP grids, shape (`nlat`, `nlon`, 4) or
+      (`nlat * nlon`, 4). Required by `locate`.
+
+    mask : numpy.ndarray of bool, optional
+      Cells to index, e.g. `KMT > 0` for ocean cells only. Default is all
+      cells.
+    """
+
+    def __init__(self, TLAT, TLONG, corner_lat=None, corner_lon=None, mask=None):
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            raise ImportError('SpatialIndex requires scipy')
+
+        TLAT = np.asarray(TLAT)
+        self.shape = TLAT.shape
+        if mask is None:
+            self._cells = np.arange(TLAT.size)
+        else:
+            self._cells = np.flatnonzero(np.asarray(mask))
+        self._tree = cKDTree(
+            _xyz(TLAT.reshape((-1,))[self._cells], np.asarray(TLONG).reshape((-1,))[self._cells])
+        )
+
+        self._corner_lat = self._corner_lon = None
+        if corner_lat is not None:
+            self._corner_lat = np.asarray(corner_lat).reshape((-1, 4))
+            self._corner_lon = np.asarray(corner_lon).reshape((-1, 4))
+
+    @classmethod
+    def from_grid(cls, grid_name, cells=True, ocean_only=False, cache=False):
+        """Return the `SpatialIndex` of a grid in `pop_tools.grid_defs`.
+
+        Parameters
+        ----------
+
+        grid_name : str
+          Name of grid.
+
+        cells : boolean, optional [default=True]
+          Include the cell corners, for `locate`.
+
+        ocean_only : boolean, optional [default=False]
+          Only index ocean cells (`KMT > 0`).
+
+        cache : boolean or str, optional [default=False]
+          If `True`, load the index from the on-disk grid cache in
+          `pop_tools.config.GRID_CACHE_DIR`, building and storing it on a
+          cache miss; if a string, use it as the cache directory. Entries
+          are keyed on the contents of the grid input files.
+        """
+        if grid_name not in grid_defs:
+            raise ValueError(
+                f"""Unknown grid: {grid_name}
+                 Please select from the following: {list(grid_defs.keys())}"""
+            )
+
+        if cache:
+            ensure_inputdata(grid_name)
+            cache_path = grid_cache_path(
+                grid_name,
+                grid_defs[grid_name],
+                cache_dir=cache if isinstance(cache, str) else None,
+                suffix='.pkl',
+                kind='spatial_index',
+                cells=cells,
+                ocean_only=ocean_only,
+            )
+            index = open_cached_object(cache_path)
+            if index is not None:
+                return index
+
+        variables = ['grid_dims', 'grid_center_lat', 'grid_center_lon']
+        if cells:
+            variables += ['grid_corner_lat', 'grid_corner_lon']
+        if ocean_only:
+            variables += ['grid_imask']
+        ds = get_grid(grid_name, scrip=True, variables=variables)
+
+        nlon, nlat = ds.grid_dims.values
+        index = cls(
+            ds.grid_center_lat.values.reshape((nlat, nlon)),
+            ds.grid_center_lon.values.reshape((nlat, nlon)),
+            corner_lat=ds.grid_corner_lat.values if cells else None,
+            corner_lon=ds.grid_corner_lon.values if cells else None,
+            mask=ds.grid_imask.values == 1 if ocean_only else None,
+        )
+
+        if cache:
+            write_cached_object(index, cache_path)
+        return index
+
+    def query(self, lat, lon, k=1):
+        """Find the nearest T points.
+
+        Parameters
+        ----------
+
+        lat, lon : array_like
+          Latitudes and longitudes of the query points (degrees).
+
+        k : int, optional [default=1]
+          Number of nearest points to return for each query point; at most
+          the number of indexed points.
+
+        Returns
+        -------
+
+        j, i : numpy.ndarray
+          Row and column indices of the nearest points, with the shape of
+          the broadcast query points plus a trailing dimension of length
+          `k` if `k > 1`.
+
+        distance : numpy.ndarray
+          Great-circle distances (radians) to the nearest points.
+        """
+        if k > len(self._cells):
+            raise ValueError(
+                f'k={k} is larger than the number of indexed points, {len(self._cells)}'
+            )
+
+        lat, lon = np.broadcast_arrays(lat, lon)
+        chord, n = self._tree.query(_xyz(lat, lon), k=k)
+        j, i = np.unravel_index(self._cells[n], self.shape)
+        return j, i, 2 * np.arcsin(np.minimum(0.5 * chord, 1.0))
+
+    def locate(self, lat, lon, k=8):
+        """Find the cells containing points.
+
+        Each point is tested against the `k` cells with the nearest T points.
+
+        Parameters
+        ----------
+
+        lat, lon : array_like
+          Latitudes and longitudes of the query points (degrees).
+
+        k : int, optional [default=8]
+          Number of candidate cells tested for each point.
+
+        Returns
+        -------
+
+        j, i : numpy.ndarray
+          Row and column indices of the containing cells, with the shape of
+          the broadcast query points; -1 where no candidate cell contains
+          the point.
+        """
+        if self._corner_lat is None:
+            raise ValueError('index was built without cell corners')
+
+        lat, lon = np.broadcast_arrays(lat, lon)
+        shape = lat.shape
+        points = _xyz(lat, lon).reshape((-1, 3))
+        k = min(k, len(self._cells))
+
+        _, n = self._tree.query(points, k=k)
+        cells = self._cells[n.reshape((-1, k))]
+
+        # a point is in a cell if it is to the left of each edge, going
+        # counterclockwise around the corners
+        corners = _xyz(self._corner_lat[cells], self._corner_lon[cells])
+        normals = np.cross(corners, np.roll(corners, -1, axis=2))
+        inside = (np.einsum('pkcx,px->pkc', normals, points) >= 0.0).all(axis=-1)
+
+        found = inside.any(axis=1)
+        cell = np.where(found, cells[np.arange(len(cells)), inside.argmax(axis=1)], -1)
+        j, i = np.unravel_index(np.where(found, cell, 0), self.shape)
+        return np.where(found, j, -1).reshape(shape), np.where(found, i, -1).reshape(shape)
@@ -0,0 +1,188 @@
+"""Vertical interpolation of POP fields to depths."""
+
+import dask.array
+import numpy as np
+import xarray as xr
+from numba import jit, prange
+
+from .grid import get_grid
+
+
+def depth_to_level(depth, z_w_bot):
+    """Return the index of the vertical level containing each depth.
+
+    Parameters
+    ----------
+
+    depth : array_like
+      Depths, in the units of `z_w_bot` (cm for `get_grid` output).
+
+    z_w_bot : array_like
+      Depth of the bottom of each level.
+
+    Returns
+    -------
+
+    level : numpy.ndarray
+      Level indices (0-based); -1 above the surface and `len(z_w_bot)`
+      below the bottom level.
+    """
+    depth = np.asarray(depth)
+    level = np.searchsorted(np.asarray(z_w_bot), depth, side='right')
+    return np.where(depth < 0, -1, level)
+
+
+class VerticalInterpolator(object):
+    """Linear interpolation of fields on `z_t` levels to fixed target depths.
+
+    The levels bracketing each target depth and the interpolation weights
+    are computed once, so the interpolator can be applied to many fields.
+    Values between the surface and the first level center are taken from
+    the first level, and values between the center and the bottom of the
+    deepest ocean level of a column (`KMT`) from that level; depths below
+    the sea floor are NaN.
+
+    Parameters
+    ----------
+
+    z_t : array_like
+      Depth of the level centers.
+
+    z_w_bot : array_like
+      Depth of the bottom of each level.
+
+    depths : array_like
+      Target depths, in the units of `z_t` (cm for `get_grid` output).
+
+    KMT : numpy.ndarray, optional
+      Number of ocean levels in each column, shape (`nlat`, `nlon`).
+      Default is all levels everywhere.
+    """
+
+    def __init__(self, z_t, z_w_bot, depths, KMT=None):
+        z_t = np.asarray(z_t, dtype=np.float64)
+        self.depths = np.asarray(depths, dtype=np.float64).reshape((-1,))
+        self.nz = len(z_t)
+        self.KMT = None if KMT is None else np.ascontiguousarray(KMT, dtype=np.int32)
+
+        k0 = np.clip(np.searchsorted(z_t, self.depths, side='right') - 1, 0, self.nz - 1)
+        k1 = np.minimum(k0 + 1, self.nz - 1)
+        dz = z_t[k1] - z_t[k0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(dz > 0, (self.depths - z_t[k0]) / dz, 0.0)
+        self._k0 = k0.astype(np.int32)
+        self._weight = np.clip(weight, 0.0, 1.0)
+
+        level = depth_to_level(self.depths, z_w_bot)
+        self._level = np.where(level < 0, self.nz, level).astype(np.int32)
+
+    @classmethod
+    def from_grid(cls, grid_name, depths):
+        """Return a `VerticalInterpolator` for a grid in `pop_tools.grid_defs`."""
+        ds = get_grid(grid_name, variables=['KMT', 'z_t', 'z_w_bot'])
+        return cls(ds.z_t.values, ds.z_w_bot.values, depths, KMT=ds.KMT.values)
+
+    def __call__(self, field, dim='z_t'):
+        """Interpolate a field to the target depths.
+
+        Parameters
+        ----------
+
+        field : numpy.ndarray, dask.array.Array or xarray.DataArray
+          Field with trailing dimensions (`z_t`, `nlat`, `nlon`); for
+          DataArrays, the vertical dimension `dim` may be anywhere before
+          the lateral dimensions. Dask arrays are interpolated block by
+          block; their vertical dimension is rechunked to a single chunk.
+
+        dim : str, optional [default='z_t']
+          Vertical dimension of DataArrays.
+
+        Returns
+        -------
+
+        interpolated : same type as `field`
+          Field with the vertical dimension replaced by the target depths
+          (dimension `depth` with a coordinate for DataArrays).
+        """
+        if isinstance(field, xr.DataArray):
+            lateral_dims = [d for d in field.dims if d != dim][-2:]
+            lead_dims = [d for d in field.dims if d != dim and d not in lateral_dims]
+            field = field.transpose(*lead_dims, dim, *lateral_dims)
+            coords = {
+                k: v
+                for k, v in field.coords.items()
+                if dim not in v.dims and set(v.dims) <= set(field.dims)
+            }
+            coords['depth'] = self.depths
+            return xr.DataArray(
+                self(field.data),
+                dims=(*lead_dims, 'depth', *lateral_dims),
+                coords=coords,
+                attrs=field.attrs,
+                name=field.name,
+            )
+
+        if field.ndim < 3 or field.shape[-3] != self.nz:
+            raise ValueError(
+                f'field dimensions {field.shape} do not end with {self.nz} levels, nlat, nlon'
+            )
+        KMT = self.KMT
+        if KMT is None:
+            KMT = np.full(field.shape[-2:], self.nz, dtype=np.int32)
+        elif KMT.shape != field.shape[-2:]:
+            raise ValueError(f'lateral dimensions of field {field.shape} do not match KMT')
+
+        if isinstance(field, dask.array.Array):
+            field = field.rechunk({field.ndim - 3: -1})
+            KMT = dask.array.from_array(KMT, chunks=field.chunks[-2:])
+            return dask.array.map_blocks(
+                self._interpolate,
+                field,
+                KMT,
+                chunks=field.chunks[:-3] + ((len(self.depths),),) + field.chunks[-2:],
+                dtype=np.result_type(field.dtype, np.float32),
+            )
+        return self._interpolate(np.asarray(field), KMT)
+
+    def _interpolate(self, field, KMT):
+        lead_shape = field.shape[:-3]
+        # integer fields are interpolated, and NaN below the sea floor, in floating point
+        dtype = np.result_type(field.dtype, np.float32)
+        out = np.empty(lead_shape + (len(self.depths),) + field.shape[-2:], dtype=dtype)
+        _interp_columns(
+            field.reshape((-1,) + field.shape[-3:]),
+            KMT,
+            self._k0,
+            self._weight,
+            self._level,
+            out.reshape((-1,) + out.shape[-3:]),
+        )
+        return out
+
+
+@jit(nopython=True, parallel=True)
+def _interp_columns(field, KMT, k0, weight, level, out):
+    """Interpolate the columns of `field` (n, nz, nlat, nlon) to `out` (n, nd, nlat, nlon).
+
+    Target depth `d` lies between levels `k0[d]` and `k0[d] + 1` with
+    weight `weight[d]` on the latter, and in level `level[d]`.
+    """
+
+    n, nz, nlat, nlon = field.shape
+    nd = k0.shape[0]
+    for m in prange(0, n * nlat):
+        s = m // nlat
+        j = m % nlat
+        for d in range(0, nd):
+            k = k0[d]
+            w = weight[d]
+            kd = level[d]
+            for i in range(0, nlon):
+                kmt = KMT[j, i]
+                if kd >= kmt:
+                    # below the sea floor
+                    out[s, d, j, i] = np.nan
+                elif k + 1 >= kmt or w == 0.0:
+                    out[s, d, j, i] = field[s, k, j, i]
+                else:
+                    out[s, d, j, i] = (1.0 - w) * field[s, k, j, i] + w * field[s, k + 1, j, i]
@@ -17,6 +17,12 @@ else:
 with open('requirements.txt') as f:
     install_requires = f.read().strip().split('\n')
 
+# optional dependencies: scipy for remapping, SpatialIndex and
+# lateral_fill(method='sparse'); zarr for the on-disk grid cache and
+# lateral_fill_to_zarr
+extras_require = {'scipy': ['scipy'], 'zarr': ['zarr']}
+extras_require['complete'] = sorted({dep for deps in extras_require.values() for dep in deps})
+
 test_requirements = ['pytest']
 
 
@@ -37,6 +43,7 @@ setup(
     maintainer_email='mclong@ucar.edu',
     description='POP2-CESM tools',
     install_requires=install_requires,
+    extras_require=extras_require,
     license='Apache License 2.0',
     long_description=long_description,
     classifiers=CLASSIFIERS,
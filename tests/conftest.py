@@ -0,0 +1,13 @@
+import pytest
+
+from pop_tools import config
+
+
+@pytest.fixture(scope='session', autouse=True)
+def grid_cache_dir(tmp_path_factory):
+    """Keep compiled grid definitions and cached grids out of the user's cache."""
+    cache_dir = str(tmp_path_factory.mktemp('grid_cache'))
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(config, 'GRID_CACHE_DIR', cache_dir)
+        mp.setenv('POP_TOOLS_GRID_CACHE', cache_dir)
+        yield cache_dir
@@ -0,0 +1,72 @@
+import dask.array
+import numpy as np
+import pytest
+import xarray as xr
+
+import pop_tools
+
+
+@pytest.fixture(scope='module')
+def grid():
+    return pop_tools.get_grid('POP_gx3v7')
+
+
+@pytest.fixture(scope='module')
+def field(grid):
+    nlat, nlon = grid.KMT.shape
+    field = np.random.default_rng(0).random((3, len(grid.z_t), nlat, nlon))
+    field[:, :, :10, :] = np.nan
+    return field
+
+
+def test_basin_reduce_area_mean(grid, field):
+    region_mask, tarea = grid.REGION_MASK.values, grid.TAREA.values
+    regions = [1, 2, -1]
+    mean = pop_tools.basin_reduce(field, region_mask, tarea, regions=regions)
+    assert mean.shape == field.shape[:2] + (3,)
+    for n, region in enumerate(regions):
+        weights = np.where((region_mask == region) & ~np.isnan(field), tarea, 0.0)
+        expected = np.nansum(field * weights, axis=(-2, -1)) / weights.sum(axis=(-2, -1))
+        np.testing.assert_allclose(mean[..., n], expected)
+
+
+def test_basin_reduce_volume_sum(grid, field):
+    region_mask = grid.REGION_MASK.values
+    volume = grid.dz.values[:, None, None] * grid.TAREA.values
+    total = pop_tools.basin_reduce(field, region_mask, volume, how='sum')
+    regions = np.unique(region_mask)
+    regions = regions[regions != 0]
+    assert total.shape == (3, len(regions))
+    for n, region in enumerate(regions):
+        expected = np.nansum(field * np.where(region_mask == region, volume, 0.0), axis=(1, 2, 3))
+        np.testing.assert_allclose(total[:, n], expected)
+
+
+def test_basin_reduce_dask_xarray(grid, field):
+    expected = pop_tools.basin_reduce(field, grid.REGION_MASK.values, grid.TAREA.values)
+
+    darr = dask.array.from_array(field, chunks=(1, 20, 40, 50))
+    mean = pop_tools.basin_reduce(darr, grid.REGION_MASK.values, grid.TAREA.values)
+    assert isinstance(mean, dask.array.Array)
+    np.testing.assert_allclose(mean.compute(), expected)
+
+    da = xr.DataArray(darr, dims=('time', 'z_t', 'nlat', 'nlon'), coords={'time': [0, 1, 2]})
+    mean = pop_tools.basin_reduce(da, grid.REGION_MASK, grid.TAREA)
+    assert mean.dims == ('time', 'z_t', 'region')
+    assert 0 not in mean.region
+    np.testing.assert_allclose(mean.values, expected)
+
+    total = pop_tools.basin_reduce(da, grid.REGION_MASK, grid.TAREA * grid.dz, how='sum')
+    assert total.dims == ('time', 'region')
+
+
+def test_basin_reduce_bad_args(grid, field):
+    with pytest.raises(ValueError):
+        pop_tools.basin_reduce(field, grid.REGION_MASK.values, how='max')
+    with pytest.raises(ValueError):
+        pop_tools.basin_reduce(field[..., 1:], grid.REGION_MASK.values)
+    for regions in [[], np.array([], dtype=int)]:
+        with pytest.raises(ValueError, match='no regions'):
+            pop_tools.basin_reduce(field, grid.REGION_MASK.values, regions=regions)
+    with pytest.raises(ValueError, match='no regions'):
+        pop_tools.basin_reduce(grid.TAREA, grid.REGION_MASK * 0)
@@ -0,0 +1,159 @@
+import os
+
+import pytest
+import xarray as xr
+
+import pop_tools
+from pop_tools.cache import grid_cache_path, write_cached_grid
+
+
+def test_get_grid_cache(tmp_path):
+    pytest.importorskip('zarr')
+    cache_dir = str(tmp_path)
+    ds_ref = pop_tools.get_grid('POP_gx3v7')
+    ds_miss = pop_tools.get_grid('POP_gx3v7', cache=cache_dir, memoize=False)
+    ds_hit = pop_tools.get_grid('POP_gx3v7', cache=cache_dir, memoize=False)
+    assert ds_hit.KMT.chunks is not None
+    xr.testing.assert_identical(ds_ref, ds_miss)
+    xr.testing.assert_identical(ds_ref, ds_hit.load())
+
+
+def test_get_grid_cache_after_memo(tmp_path):
+    pytest.importorskip('zarr')
+    cache_dir = str(tmp_path)
+    ds_ref = pop_tools.get_grid('POP_gx3v7')
+    ds = pop_tools.get_grid('POP_gx3v7', cache=cache_dir)
+    assert len(os.listdir(tmp_path / 'POP_gx3v7')) == 1
+    xr.testing.assert_identical(ds_ref, ds.compute())
+
+
+def test_get_grid_cache_scrip(tmp_path):
+    pytest.importorskip('zarr')
+    cache_dir = str(tmp_path)
+    pop_tools.cache_grid('POP_gx3v7', scrip=True, cache_dir=cache_dir)
+    assert len(os.listdir(tmp_path / 'POP_gx3v7')) == 1
+    ds_hit = pop_tools.get_grid('POP_gx3v7', scrip=True, cache=cache_dir, memoize=False)
+    xr.testing.assert_identical(pop_tools.get_grid('POP_gx3v7', scrip=True), ds_hit.load())
+
+
+def test_get_grid_cache_chunks(tmp_path):
+    pytest.importorskip('zarr')
+    cache_dir = str(tmp_path)
+    for scrip in [False, True]:
+        ds_ref = pop_tools.get_grid('POP_gx3v7', scrip=scrip, memoize=False)
+        for chunks in [(7, 33), [50, 50]]:
+            ds = pop_tools.get_grid(
+                'POP_gx3v7', scrip=scrip, chunks=chunks, cache=cache_dir, memoize=False
+            )
+            if scrip:
+                # whole rows along grid_size
+                assert ds.grid_imask.chunks[0][0] == chunks[0] * ds.grid_dims.values[0]
+            else:
+                ds_chunked = pop_tools.get_grid('POP_gx3v7', chunks=chunks, memoize=False)
+                assert ds.KMT.chunks == ds_chunked.KMT.chunks
+            xr.testing.assert_identical(ds_ref, ds.compute())
+    assert len(os.listdir(tmp_path / 'POP_gx3v7')) == 2
+
+
+def test_cache_invalidation(tmp_path):
+    pytest.importorskip('zarr')
+    cache_dir = str(tmp_path / 'cache')
+    grid_attrs = {}
+    for key in ['horiz_grid_fname', 'topography_fname', 'region_mask_fname', 'vert_grid_file']:
+        grid_attrs[key] = str(tmp_path / key)
+        with open(grid_attrs[key], 'w') as f:
+            f.write(key)
+
+    path = grid_cache_path('test', grid_attrs, cache_dir=cache_dir, scrip=False)
+    assert path == grid_cache_path('test', grid_attrs, cache_dir=cache_dir, scrip=False)
+    assert path != grid_cache_path('test', grid_attrs, cache_dir=cache_dir, scrip=True)
+    write_cached_grid(xr.Dataset({'x': ('x', [1, 2, 3])}), path)
+
+    with open(grid_attrs['topography_fname'], 'w') as f:
+        f.write('modified')
+    new_path = grid_cache_path('test', grid_attrs, cache_dir=cache_dir, scrip=False)
+    assert new_path != path
+
+    write_cached_grid(xr.Dataset({'x': ('x', [1, 2])}), new_path)
+    assert not os.path.exists(path)
+    assert os.path.exists(new_path)
+
+    # only the files of the cache are removed
+    with open(os.path.join(cache_dir, 'notes.txt'), 'w') as f:
+        f.write('unrelated')
+    os.makedirs(os.path.join(cache_dir, 'project'))
+    with open(os.path.join(cache_dir, 'project', 'data.nc'), 'w') as f:
+        f.write('unrelated')
+    pop_tools.purge_grid_cache(cache_dir=cache_dir)
+    assert sorted(os.listdir(cache_dir)) == ['notes.txt', 'project']
+    assert os.listdir(os.path.join(cache_dir, 'project')) == ['data.nc']
+
+
+def test_get_grid_memoize():
+    pop_tools.clear_grid_memo()
+    ds1 = pop_tools.get_grid('POP_gx3v7', scrip=True)
+    ds2 = pop_tools.get_grid('POP_gx3v7')
+    ds3 = pop_tools.get_grid('POP_gx3v7')
+    assert 'conventions' not in ds2.attrs
+    assert 'conventions' not in pop_tools.grid_defs['POP_gx3v7']
+    assert ds3.KMT.data is ds2.KMT.data
+    assert not ds3.KMT.data.flags.writeable
+
+    ds3.attrs['history'] = 'modified'
+    assert 'history' not in pop_tools.get_grid('POP_gx3v7').attrs
+
+    ds4 = pop_tools.get_grid('POP_gx3v7', memoize=False)
+    assert ds4.KMT.data.flags.writeable
+    xr.testing.assert_identical(ds1, pop_tools.get_grid('POP_gx3v7', scrip=True))
+
+    pop_tools.clear_grid_memo('POP_gx3v7')
+    assert pop_tools.grid_memo_info()['entries'] == []
+
+
+def test_get_grid_memoize_list_chunks():
+    pop_tools.clear_grid_memo()
+    ds = pop_tools.get_grid('POP_gx3v7', variables=['KMT'], chunks=[50, 50])
+    assert ds.KMT.chunks == ((50, 50, 16), (50, 50))
+    hits = pop_tools.grid_memo_info()['hits']
+    pop_tools.get_grid('POP_gx3v7', variables=['KMT'], chunks=[50, 50])
+    assert pop_tools.grid_memo_info()['hits'] == hits + 1
+    assert len(pop_tools.grid_memo_info()['entries']) == 1
+    pop_tools.clear_grid_memo()
+
+
+def test_grid_memo_limits():
+    pop_tools.clear_grid_memo()
+    try:
+        pop_tools.set_grid_memo_limits(maxsize=1)
+        pop_tools.get_grid('POP_gx3v7')
+        pop_tools.get_grid('POP_gx3v7', scrip=True)
+        entries = pop_tools.grid_memo_info()['entries']
+        assert [key[:2] for key in entries] == [('POP_gx3v7', True)]
+
+        pop_tools.set_grid_memo_limits(max_bytes=0)
+        assert pop_tools.grid_memo_info()['entries'] == []
+    finally:
+        pop_tools.set_grid_memo_limits(maxsize=16, max_bytes=2 * 1024 ** 3)
+
+
+def test_open_cached_object_errors(tmp_path, monkeypatch):
+    from pop_tools.cache import open_cached_object, write_cached_object
+
+    path = str(tmp_path / 'POP_gx3v7' / 'entry.pkl')
+    write_cached_object({'a': 1}, path)
+    assert open_cached_object(path) == {'a': 1}
+
+    # an error that does not mean the entry is corrupt is a miss that keeps the entry
+    def failing_load(f):
+        raise OSError('transient')
+
+    with monkeypatch.context() as m:
+        m.setattr(pop_tools.cache.pickle, 'load', failing_load)
+        assert open_cached_object(path) is None
+    assert open_cached_object(path) == {'a': 1}
+
+    # a truncated entry is removed
+    with open(path, 'r+b') as f:
+        f.truncate(3)
+    assert open_cached_object(path) is None
+    assert not os.path.exists(path)
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+import pop_tools
+from pop_tools.fetch import LocalMirrorSource, fetch_files, inputdata_files, make_manifest
+
+
+class CountingSource(LocalMirrorSource):
+    def __init__(self, root):
+        super().__init__(root)
+        self.fetched = []
+
+    def fetch(self, relpath, dest):
+        self.fetched.append(relpath)
+        super().fetch(relpath, dest)
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    root = tmp_path / 'mirror'
+    files = []
+    for n in range(5):
+        relpath = f'ocn/pop/test/grid/file_{n}.ieeei4'
+        os.makedirs(root / os.path.dirname(relpath), exist_ok=True)
+        with open(root / relpath, 'wb') as f:
+            f.write(bytes(range(n + 1)) * 100)
+        files.append(
+            {
+                'relpath': relpath,
+                'dest': str(tmp_path / 'inputdata' / relpath),
+                'size': 100 * (n + 1),
+            }
+        )
+    return str(root), files
+
+
+def test_fetch_files_local_mirror(mirror):
+    root, files = mirror
+    source = CountingSource(root)
+    fetched = fetch_files(files, source=source, max_workers=3)
+    assert sorted(fetched) == sorted(f['dest'] for f in files)
+    for f in files:
+        with open(f['dest'], 'rb') as fd, open(os.path.join(root, f['relpath']), 'rb') as fm:
+            assert fd.read() == fm.read()
+        assert not [p for p in os.listdir(os.path.dirname(f['dest'])) if p.startswith('.fetch-')]
+
+    # nothing left to fetch
+    assert fetch_files(files, source=source) == []
+    assert len(source.fetched) == len(files)
+
+
+def test_fetch_files_replaces_partial_file(mirror):
+    root, files = mirror
+    os.makedirs(os.path.dirname(files[2]['dest']), exist_ok=True)
+    with open(files[2]['dest'], 'wb') as f:
+        f.write(b'\0' * 10)
+
+    fetch_files(files[2:3], source=LocalMirrorSource(root))
+    assert os.path.getsize(files[2]['dest']) == files[2]['size']
+
+
+def test_fetch_files_integrity_failure(mirror):
+    root, files = mirror
+    bad = dict(files[0], sha256='0' * 64)
+    with pytest.raises(RuntimeError):
+        fetch_files([bad, files[1]], source=LocalMirrorSource(root))
+    assert not os.path.exists(bad['dest'])
+    assert os.path.exists(files[1]['dest'])
+
+
+def test_inputdata_files():
+    files = inputdata_files('POP_gx3v7')
+    nlat, nlon = pop_tools.grid_defs['POP_gx3v7']['lateral_dims']
+    assert len(files) == 3
+    assert files[0]['size'] == 7 * nlat * nlon * 8
+    assert all(f['relpath'].startswith('ocn/pop/gx3v7/grid/') for f in files)
+
+    manifest = make_manifest('POP_gx3v7')
+    files = inputdata_files('POP_gx3v7', manifest=manifest)
+    assert all(len(f['sha256']) == 64 for f in files)
+    assert fetch_files(files, source=LocalMirrorSource('/nonexistent')) == []
+
+
+def test_ensure_inputdata_shared_tree(tmp_path, monkeypatch):
+    inputdata = tmp_path / 'shared' / 'inputdata'
+    monkeypatch.setattr(pop_tools.config, 'inputdata_local', str(inputdata))
+    grid_dir = inputdata / 'ocn' / 'pop' / 'mygrid'
+    os.makedirs(grid_dir)
+    keys = pop_tools.config.indat_grid_file_keys
+    for key in keys:
+        with open(grid_dir / key, 'wb') as f:
+            f.write(b'\0' * 10)
+    grid_def_file = tmp_path / 'my_grids.yaml'
+    files = ''.join(f"    {key}: '{grid_dir / key}'\n" for key in keys)
+    grid_def_file.write_text('MYGRID:\n    lateral_dims: [4, 5]\n' + files)
+
+    pop_tools.register_grids(str(grid_def_file))
+    try:
+        with pytest.raises(RuntimeError, match='shared'):
+            pop_tools.config.ensure_inputdata('MYGRID')
+        assert 'MYGRID' not in pop_tools.config._inputdata_checked
+        for key in keys:
+            assert os.path.getsize(grid_dir / key) == 10
+    finally:
+        pop_tools.grid_defs._files.remove(str(grid_def_file))
+        pop_tools.grid_defs._reload()
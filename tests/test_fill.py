@@ -1,9 +1,12 @@
 import os
+import tracemalloc
 
 import numpy as np
+import pytest
 import xarray as xr
 
 import pop_tools
+from pop_tools.fill import _fill_residuals, _iterative_fill_POP_core, _iterative_fill_POP_rows
 
 testdata_dir = os.path.join(os.path.dirname(__file__), 'data')
 
@@ -176,3 +179,458 @@ def test_lateral_fill_4D_3Dmask():
             np.testing.assert_array_equal(arr_0, arr_i)
 
     assert da_out.attrs == attrs
+
+
+def test_lateral_fill_np_array_batched():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = np.where(ds.KMT > 0, ds.KMT * 1.0, np.nan)
+    field[20:40, 80:] = np.nan
+    valid_points = ds.KMT.values > 0
+
+    var = np.stack([field, 2 * field, field + 1.0])
+    var[1, 50:60, :] = np.nan
+    filled = pop_tools.lateral_fill_np_array(var, valid_points)
+    assert filled.shape == var.shape
+    for n in range(var.shape[0]):
+        np.testing.assert_array_equal(
+            filled[n], pop_tools.lateral_fill_np_array(var[n], valid_points)
+        )
+    assert np.isnan(var[1, 50:60, :]).all()
+
+
+def test_lateral_fill_empty():
+    valid_points = np.ones((7, 9), dtype=bool)
+    var = np.empty((0, 7, 9))
+    assert pop_tools.lateral_fill_np_array(var, valid_points).shape == (0, 7, 9)
+
+    da_in = xr.DataArray(var, dims=('time', 'nlat', 'nlon'))
+    da_out = pop_tools.lateral_fill(da_in, xr.DataArray(valid_points, dims=('nlat', 'nlon')))
+    assert da_out.shape == (0, 7, 9)
+    filled, diagnostics = pop_tools.lateral_fill_np_array(var, valid_points, diagnostics=True)
+    assert filled.shape == (0, 7, 9)
+    assert diagnostics.iterations.shape == (0,)
+
+
+def test_lateral_fill_tol():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = ds.KMT.copy() * 1.0
+    field = field.where(ds.KMT > 0)
+    field.values[20:40, 80:] = np.nan
+    valid_points = ds.KMT > 0
+
+    da_out = pop_tools.lateral_fill(field, valid_points, tol=1e-2)
+    np.testing.assert_array_equal(
+        da_out.values, pop_tools.lateral_fill_np_array(field.values, valid_points.values, tol=1e-2)
+    )
+    assert not np.array_equal(da_out.values, pop_tools.lateral_fill(field, valid_points).values)
+
+
+def test_lateral_fill_dask():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = ds.KMT.copy() * 1.0
+    field = field.where(ds.KMT > 0)
+    field.values[20:40, 80:] = np.nan
+    da_in = xr.DataArray(np.arange(1.0, 7.0), dims=('time')) * field
+    da_in.attrs = {'long_name': 'test field', 'units': 'none'}
+    valid_points = ds.KMT > 0
+
+    da_out = pop_tools.lateral_fill(da_in.chunk({'time': 2, 'nlon': 50}), valid_points)
+    assert da_out.chunks is not None
+    assert da_out.chunks[0] == (2, 2, 2)
+    xr.testing.assert_identical(da_out.compute(), pop_tools.lateral_fill(da_in, valid_points))
+
+
+@pytest.mark.parametrize('ltripole', [False, True])
+@pytest.mark.parametrize('method', ['active_set', 'sor', 'redblack', 'multigrid'])
+def test_lateral_fill_methods(method, ltripole):
+    ds = pop_tools.get_grid('POP_gx3v7')
+    lat, lon = np.deg2rad(ds.TLAT.values), np.deg2rad(ds.TLONG.values)
+    field = 10.0 + np.cos(lat) * np.sin(2 * lon)
+    field = np.where(ds.KMT.values > 0, field, np.nan)
+    field[20:40, 80:] = np.nan
+    field[-1, :] = 10.0
+    field[-1, 10:30] = np.nan
+    valid_points = ds.KMT.values > 0
+    valid_points[-1, :] = True
+
+    converged = pop_tools.lateral_fill_np_array(
+        field, valid_points, ltripole=ltripole, tol=1e-10, method='multigrid'
+    )
+    filled = pop_tools.lateral_fill_np_array(
+        field, valid_points, ltripole=ltripole, tol=1e-6, method=method
+    )
+    np.testing.assert_array_equal(np.isnan(filled), np.isnan(converged))
+    np.testing.assert_allclose(filled, converged, rtol=1e-3)
+
+    jacobi = pop_tools.lateral_fill_np_array(field, valid_points, ltripole=ltripole, tol=1e-5)
+    np.testing.assert_array_equal(np.isnan(filled), np.isnan(jacobi))
+    np.testing.assert_allclose(filled, jacobi, rtol=1e-2)
+
+
+@pytest.mark.parametrize('method', ['jacobi', 'active_set'])
+def test_lateral_fill_converged_residual(method):
+    y, x = np.mgrid[0:60, 0:80]
+    field = 10.0 + np.sin(x / 8.0) * np.cos(y / 6.0)
+    field[15:45, 20:50] = np.nan
+    valid_points = np.ones(field.shape, dtype=bool)
+
+    filled, diag = pop_tools.lateral_fill_np_array(
+        field, valid_points, tol=1e-4, method=method, diagnostics=True
+    )
+    assert diag.converged
+    assert diag.max_residual <= 1e-4
+
+    # tol bounds the change of an iteration, not the error: the smoothers
+    # only get close to the solution at a much smaller tol
+    filled, diag = pop_tools.lateral_fill_np_array(
+        field, valid_points, tol=1e-6, method=method, diagnostics=True
+    )
+    assert diag.converged
+    assert diag.max_residual <= 1e-6
+    converged = pop_tools.lateral_fill_np_array(field, valid_points, tol=1e-10, method='multigrid')
+    np.testing.assert_allclose(filled, converged, rtol=1e-3)
+
+
+def test_lateral_fill_unknown_method():
+    with pytest.raises(ValueError):
+        pop_tools.lateral_fill_np_array(np.ones((4, 4)), np.ones((4, 4), dtype=bool), method='cg')
+
+
+def test_fill_plan():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    lat, lon = np.deg2rad(ds.TLAT.values), np.deg2rad(ds.TLONG.values)
+    field = 10.0 + np.cos(lat) * np.sin(2 * lon)
+    field = np.where(ds.KMT.values > 0, field, np.nan)
+    field[20:40, 80:] = np.nan
+    valid_points = ds.KMT.values > 0
+
+    # two levels with different masks, four time steps
+    var = np.stack([field, np.roll(field, 10, axis=-1)])
+    var = np.linspace(1.0, 1.01, 4)[:, np.newaxis, np.newaxis, np.newaxis] * var
+    plan = pop_tools.FillPlan.from_array(var[0], valid_points, ltripole=True)
+    assert plan.size == (np.isnan(var[0]) & valid_points).sum()
+
+    filled = plan.fill(var)
+    assert np.isnan(var).any()
+    expected = pop_tools.lateral_fill_np_array(
+        var, valid_points, ltripole=True, method='active_set'
+    )
+    np.testing.assert_array_equal(filled, expected)
+
+    # values at the planned points are ignored
+    fillmask = np.isnan(var) & valid_points
+    np.testing.assert_array_equal(plan.fill(np.where(fillmask, 0.0, var)), expected)
+
+    warm = plan.fill(var, warm_start=True)
+    np.testing.assert_array_equal(np.isnan(warm), np.isnan(expected))
+    np.testing.assert_allclose(warm, expected, rtol=2e-2)
+
+    # cold and warm starts both converge to the solution
+    converged = pop_tools.lateral_fill_np_array(
+        var, valid_points, ltripole=True, tol=1e-10, method='multigrid'
+    )
+    plan = pop_tools.FillPlan.from_array(var[0], valid_points, ltripole=True, tol=1e-6)
+    for warm_start in [False, True]:
+        filled = plan.fill(var, warm_start=warm_start)
+        np.testing.assert_array_equal(np.isnan(filled), np.isnan(converged))
+        np.testing.assert_allclose(filled, converged, rtol=1e-3)
+        stack = filled.reshape((-1,) + filled.shape[-2:])
+        residual, _ = _fill_residuals(stack, fillmask.reshape(stack.shape), True)
+        assert (residual <= 1e-6).all()
+
+
+def test_fill_plan_shape_mismatch():
+    plan = pop_tools.FillPlan(np.zeros((3, 4, 5), dtype=bool))
+    with pytest.raises(ValueError):
+        plan.fill(np.ones((4, 5)))
+
+
+@pytest.mark.parametrize('ltripole', [False, True])
+def test_iterative_fill_POP_rows(ltripole):
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = np.where(ds.KMT.values > 0, ds.KMT.values * 1.0, np.nan)
+    field[20:40, 80:] = np.nan
+    fillmask = np.isnan(field) & (ds.KMT.values > 0)
+    fillmask[-1, :] = True
+
+    serial = field.copy()
+    niter, done = _iterative_fill_POP_core(
+        *field.shape, serial, fillmask, 1e-4, ltripole, 10000, np.empty(field.shape)
+    )
+    assert done
+    parallel = field.copy()
+    assert _iterative_fill_POP_rows(
+        parallel, fillmask, 1e-4, ltripole, 10000, np.empty(field.shape)
+    ) == (niter, done)
+    np.testing.assert_array_equal(parallel, serial)
+
+
+def test_lateral_fill_diagnostics():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = ds.KMT.copy() * 1.0
+    field = field.where(ds.KMT > 0)
+    field.values[20:40, 80:] = np.nan
+    da_in = xr.DataArray(np.arange(1.0, 5.0), dims=('time')) * field
+    da_in['time'] = np.arange(4)
+    valid_points = ds.KMT > 0
+
+    da_out, diag = pop_tools.lateral_fill(da_in, valid_points, tol=1e-4, diagnostics=True)
+    xr.testing.assert_identical(da_out, pop_tools.lateral_fill(da_in, valid_points))
+    assert set(diag.data_vars) == {
+        'iterations',
+        'converged',
+        'max_residual',
+        'cells_filled',
+        'elapsed',
+    }
+    assert diag.iterations.dims == ('time',)
+    np.testing.assert_array_equal(diag.time, da_in.time)
+    assert diag.converged.all()
+    assert (diag.max_residual <= 1e-4).all()
+    assert (diag.cells_filled == (field.isnull() & valid_points).sum()).all()
+    assert (diag.elapsed > 0).all()
+
+    filled, diag_np = pop_tools.lateral_fill_np_array(
+        da_in.values, valid_points.values, diagnostics=True
+    )
+    np.testing.assert_array_equal(filled, da_out.values)
+    assert diag_np.iterations.dims == ('dim_0',)
+    np.testing.assert_array_equal(diag_np.iterations, diag.iterations)
+
+    da_out, diag = pop_tools.lateral_fill(
+        da_in.chunk({'time': 2}), valid_points, max_iter=5, diagnostics=True
+    )
+    assert da_out.chunks is not None
+    assert (diag.iterations.compute() == 5).all()
+    assert not diag.converged.any()
+    assert (da_out.isnull() & valid_points).any()
+
+
+def test_lateral_fill_budget():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = ds.KMT.values * 1.0
+    field = np.where(ds.KMT.values > 0, field, np.nan)
+    field[20:40, 80:] = np.nan
+    valid_points = ds.KMT.values > 0
+
+    expected = pop_tools.lateral_fill_np_array(field, valid_points)
+    np.testing.assert_array_equal(
+        pop_tools.lateral_fill_np_array(field, valid_points, time_budget=60.0), expected
+    )
+
+    filled, diag = pop_tools.lateral_fill_np_array(
+        field, valid_points, time_budget=0.0, diagnostics=True
+    )
+    assert diag.iterations == 0
+    assert not diag.converged
+    np.testing.assert_array_equal(filled, field)
+
+    with pytest.raises(ValueError):
+        pop_tools.lateral_fill_np_array(field, valid_points, max_iter=0)
+
+
+def test_lateral_fill_np_array_dtype_and_out():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = np.where(ds.KMT.values > 0, ds.KMT.values * 1.0, np.nan)
+    field[20:40, 80:] = np.nan
+    valid_points = ds.KMT.values > 0
+    expected = pop_tools.lateral_fill_np_array(field, valid_points)
+
+    filled = pop_tools.lateral_fill_np_array(field.astype(np.float32), valid_points)
+    assert filled.dtype == np.float32
+    np.testing.assert_array_equal(np.isnan(filled), np.isnan(expected))
+    np.testing.assert_allclose(filled, expected, rtol=1e-3)
+
+    var = np.stack([field] * 64)
+    filled = pop_tools.lateral_fill_np_array(var, valid_points, out=var)
+    assert filled is var
+    np.testing.assert_array_equal(var[-1], expected)
+
+    out = np.empty_like(field)
+    assert pop_tools.lateral_fill_np_array(field, valid_points, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+    with pytest.raises(ValueError):
+        pop_tools.lateral_fill_np_array(field, valid_points, out=np.empty((2,) + field.shape))
+
+
+def test_lateral_fill_np_array_in_place_memory():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = np.where(ds.KMT.values > 0, ds.KMT.values * 1.0, np.nan)
+    valid_points = ds.KMT.values > 0
+    var = np.stack([field] * 64)
+    pop_tools.lateral_fill_np_array(var[:1].copy(), valid_points, out=None)
+
+    tracemalloc.start()
+    pop_tools.lateral_fill_np_array(var, valid_points, out=var)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < var.nbytes / 4
+
+
+def test_lateral_fill_np_array_int_mask():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = np.where(ds.KMT.values > 0, ds.KMT.values * 1.0, np.nan)
+    field[20:40, 80:] = np.nan
+    valid_points = ds.KMT.values > 0
+    np.testing.assert_array_equal(
+        pop_tools.lateral_fill_np_array(field, valid_points.astype(np.int32)),
+        pop_tools.lateral_fill_np_array(field, valid_points),
+    )
+
+
+def test_lateral_fill_np_array_work():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = np.where(ds.KMT.values > 0, ds.KMT.values * 1.0, np.nan)
+    field[20:40, 80:] = np.nan
+    valid_points = ds.KMT.values > 0
+    var = np.stack([field] * 5)
+    expected = pop_tools.lateral_fill_np_array(var, valid_points)
+
+    work = np.empty((2,) + field.shape)
+    for _ in range(2):
+        np.testing.assert_array_equal(
+            pop_tools.lateral_fill_np_array(var, valid_points, work=work), expected
+        )
+
+    with pytest.raises(ValueError):
+        pop_tools.lateral_fill_np_array(var, valid_points, work=np.empty((2, 4, 4)))
+
+
+@pytest.mark.parametrize('ltripole', [False, True])
+def test_lateral_fill_sparse(ltripole):
+    pytest.importorskip('scipy')
+    from pop_tools.fill import _sparse_systems
+
+    ds = pop_tools.get_grid('POP_gx3v7')
+    lat, lon = np.deg2rad(ds.TLAT.values), np.deg2rad(ds.TLONG.values)
+    field = 10.0 + np.cos(lat) * np.sin(2 * lon)
+    field = np.where(ds.KMT.values > 0, field, np.nan)
+    field[20:40, 80:] = np.nan
+    field[-1, :] = 10.0
+    field[-1, 10:30] = np.nan
+    valid_points = ds.KMT.values > 0
+    valid_points[-1, :] = True
+
+    # two NaN patterns, three slices each
+    var = np.stack([field, np.roll(field, 10, axis=-1)] * 3)
+    var = np.linspace(1.0, 2.0, 6)[:, np.newaxis, np.newaxis] * var
+    converged = pop_tools.lateral_fill_np_array(
+        var, valid_points, ltripole=ltripole, tol=1e-10, method='multigrid'
+    )
+
+    _sparse_systems.clear()
+    filled = pop_tools.lateral_fill_np_array(var, valid_points, ltripole=ltripole, method='sparse')
+    assert len(_sparse_systems) == 2
+    np.testing.assert_array_equal(np.isnan(filled), np.isnan(converged))
+    np.testing.assert_allclose(filled, converged, rtol=1e-6)
+
+    systems = dict(_sparse_systems)
+    np.testing.assert_allclose(
+        pop_tools.lateral_fill_np_array(var[:1], valid_points, ltripole=ltripole, method='sparse'),
+        filled[:1],
+        rtol=1e-12,
+    )
+    assert all(_sparse_systems[key] is system for key, system in systems.items())
+
+
+def test_lateral_fill_sparse_cache_bytes(monkeypatch):
+    pytest.importorskip('scipy')
+    from pop_tools.fill import _sparse_systems, _sparse_systems_limits
+
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = np.where(ds.KMT.values > 0, 1.0 + ds.TLAT.values, np.nan)
+    field[20:40, 80:] = np.nan
+    var = np.stack([field, np.roll(field, 10, axis=-1)])
+    valid_points = ds.KMT.values > 0
+
+    _sparse_systems.clear()
+    filled = pop_tools.lateral_fill_np_array(var, valid_points, method='sparse')
+    nbytes = [entry[1] for entry in _sparse_systems.values()]
+    assert len(nbytes) == 2 and min(nbytes) > 0
+
+    # systems are evicted, or not cached at all, beyond max_bytes
+    for max_bytes, n_entries in [(max(nbytes), 1), (0, 0)]:
+        _sparse_systems.clear()
+        monkeypatch.setitem(_sparse_systems_limits, 'max_bytes', max_bytes)
+        np.testing.assert_array_equal(
+            pop_tools.lateral_fill_np_array(var, valid_points, method='sparse'), filled
+        )
+        assert len(_sparse_systems) == n_entries
+    _sparse_systems.clear()
+
+
+def test_lateral_fill_to_zarr(tmp_path, monkeypatch):
+    pytest.importorskip('zarr')
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = ds.KMT.copy() * 1.0
+    field = field.where(ds.KMT > 0)
+    field.values[20:40, 80:] = np.nan
+    da_in = xr.DataArray(np.arange(1.0, 7.0), dims=('time')) * field
+    da_in = (xr.DataArray([1.0, 2.0], dims=('z_t')) * da_in).astype(np.float32)
+    da_in = da_in.transpose('time', 'z_t', 'nlat', 'nlon')
+    da_in['time'] = np.arange(6)
+    da_in.name = 'TEMP'
+    da_in.attrs = {'long_name': 'test field', 'units': 'none'}
+    da_in.to_dataset().to_zarr(tmp_path / 'in.zarr')
+    valid_points = ds.KMT > 0
+
+    expected = pop_tools.lateral_fill(da_in, valid_points)
+    da_lazy = xr.open_zarr(tmp_path / 'in.zarr').TEMP
+    store = str(tmp_path / 'out.zarr')
+
+    # interrupt the fill of the second batch
+    calls = []
+    lateral_fill = pop_tools.fill.lateral_fill
+
+    def interrupted_fill(da, *args, **kwargs):
+        calls.append(da.time.values)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        return lateral_fill(da, *args, **kwargs)
+
+    monkeypatch.setattr(pop_tools.fill, 'lateral_fill', interrupted_fill)
+    with pytest.raises(KeyboardInterrupt):
+        pop_tools.lateral_fill_to_zarr(da_lazy, valid_points, store, batch_size=4)
+
+    with pytest.raises(ValueError):
+        pop_tools.lateral_fill_to_zarr(da_lazy, valid_points, store, batch_size=2)
+
+    da_out = pop_tools.lateral_fill_to_zarr(da_lazy, valid_points, store, batch_size=4)
+    np.testing.assert_array_equal(calls[-1], [4, 5])
+    assert len(calls) == 3
+    assert da_out.dtype == np.float32
+    assert da_out.chunks[0] == (4, 2)
+    xr.testing.assert_equal(da_out.compute(), expected)
+    assert da_out.attrs == da_in.attrs
+
+    da_out = pop_tools.lateral_fill_to_zarr(da_lazy, valid_points, store, batch_size=4)
+    assert len(calls) == 3
+    da_out = pop_tools.lateral_fill_to_zarr(
+        da_lazy, valid_points, store, dim='z_t', resume=False
+    )
+    assert len(calls) == 5
+    xr.testing.assert_equal(da_out.compute(), expected)
+
+
+def test_lateral_fill_to_zarr_interrupt_first_batch(tmp_path, monkeypatch):
+    pytest.importorskip('zarr')
+    ds = pop_tools.get_grid('POP_gx3v7')
+    field = ds.KMT.where(ds.KMT > 0) * 1.0
+    field.values[20:40, 80:] = np.nan
+    da_in = (xr.DataArray(np.arange(1.0, 4.0), dims=('time')) * field).rename('TEMP')
+    valid_points = ds.KMT > 0
+    store = str(tmp_path / 'out.zarr')
+
+    lateral_fill = pop_tools.fill.lateral_fill
+
+    def interrupted_fill(da, *args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(pop_tools.fill, 'lateral_fill', interrupted_fill)
+    with pytest.raises(KeyboardInterrupt):
+        pop_tools.lateral_fill_to_zarr(da_in, valid_points, store, batch_size=2)
+
+    monkeypatch.setattr(pop_tools.fill, 'lateral_fill', lateral_fill)
+    da_out = pop_tools.lateral_fill_to_zarr(da_in, valid_points, store, batch_size=2)
+    xr.testing.assert_equal(da_out.compute(), pop_tools.lateral_fill(da_in, valid_points))
@@ -1,8 +1,14 @@
 import os
+import shutil
+import subprocess
+import sys
 
+import numpy as np
+import pytest
 import xarray as xr
 
 import pop_tools
+from pop_tools.grid import read_horiz_grid, read_int_field
 
 from .util import ds_compare
 
@@ -13,6 +19,129 @@ def test_template():
     print(pop_tools.grid_defs)
 
 
+def test_import_is_lazy():
+    code = (
+        'import pop_tools; '
+        'assert pop_tools.config.grid_defs._grid_defs is None; '
+        'assert not pop_tools.config._inputdata_checked'
+    )
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def test_render_template(monkeypatch):
+    # plain placeholders are rendered without jinja2
+    monkeypatch.setitem(sys.modules, 'jinja2', None)
+    rendered = pop_tools.config.render_template(
+        '{{INPUTDATA}}/ocn/{{ INPUT_TEMPLATES }}', INPUTDATA='/a', INPUT_TEMPLATES='b'
+    )
+    assert rendered == '/a/ocn/b'
+
+
+def test_compiled_grid_defs(tmp_path, monkeypatch):
+    monkeypatch.setattr(pop_tools.config, 'GRID_CACHE_DIR', str(tmp_path))
+    grid_defs = pop_tools.config.gen_grid_defs(pop_tools.config.grid_def_file)
+    assert pop_tools.config.compile_grid_defs(pop_tools.config.grid_def_file) == grid_defs
+    compiled_path = pop_tools.config._compiled_grid_defs_path(pop_tools.config.grid_def_file)
+    assert compiled_path.startswith(str(tmp_path))
+    assert os.path.exists(compiled_path)
+    assert pop_tools.config.compile_grid_defs(pop_tools.config.grid_def_file) == grid_defs
+
+    # the registry compiles into the same directory
+    registry = pop_tools.config.GridRegistry([pop_tools.config.grid_def_file])
+    os.remove(compiled_path)
+    assert dict(registry) == grid_defs
+    assert os.path.exists(compiled_path)
+
+
+def test_register_grids(tmp_path):
+    grid_def_file = tmp_path / 'my_grids.yaml'
+    grid_def_file.write_text(
+        'POP_mygrid:\n'
+        '    lateral_dims: [116, 100]\n'
+        "    horiz_grid_fname: '{{ INPUTDATA }}/ocn/pop/mygrid/horiz_grid.ieeer8'\n"
+        "    comment: '{% if true %}templated{% endif %}'\n"
+    )
+    n_grids = len(pop_tools.grid_defs)
+    pop_tools.register_grids(str(grid_def_file))
+    try:
+        assert len(pop_tools.grid_defs) == n_grids + 1
+        grid_attrs = pop_tools.grid_defs['POP_mygrid']
+        assert grid_attrs['horiz_grid_fname'] == (
+            f'{pop_tools.config.INPUTDATA}/ocn/pop/mygrid/horiz_grid.ieeer8'
+        )
+        assert grid_attrs['comment'] == 'templated'
+    finally:
+        pop_tools.grid_defs._files.remove(str(grid_def_file))
+        pop_tools.grid_defs._reload()
+
+
+def test_get_grid_registered_local_files(tmp_path):
+    grid_attrs = pop_tools.grid_defs['POP_gx3v7']
+    keys = ['horiz_grid_fname', 'topography_fname', 'region_mask_fname', 'vert_grid_file']
+    for key in keys:
+        shutil.copy(grid_attrs[key], tmp_path / key)
+    grid_def_file = tmp_path / 'my_grids.yaml'
+    grid_def_file.write_text(
+        'MYGRID:\n'
+        '    lateral_dims: [116, 100]\n'
+        '    vertical_dims: 60\n'
+        '    type: dipole\n' + ''.join(f"    {key}: '{tmp_path / key}'\n" for key in keys)
+    )
+    pop_tools.register_grids(str(grid_def_file))
+    try:
+        ds = pop_tools.get_grid('MYGRID', memoize=False)
+        ds_ref = pop_tools.get_grid('POP_gx3v7', memoize=False)
+        np.testing.assert_array_equal(ds.KMT, ds_ref.KMT)
+        np.testing.assert_array_equal(ds.TAREA, ds_ref.TAREA)
+
+        os.remove(tmp_path / 'topography_fname')
+        pop_tools.config._inputdata_checked.discard('MYGRID')
+        with pytest.raises(FileNotFoundError):
+            pop_tools.get_grid('MYGRID', memoize=False)
+    finally:
+        pop_tools.grid_defs._files.remove(str(grid_def_file))
+        pop_tools.grid_defs._reload()
+        pop_tools.config._inputdata_checked.discard('MYGRID')
+
+
+def test_register_grids_override_memoized(tmp_path):
+    grid_attrs = pop_tools.grid_defs['POP_gx3v7']
+    keys = ['horiz_grid_fname', 'topography_fname', 'region_mask_fname', 'vert_grid_file']
+    for key in keys:
+        shutil.copy(grid_attrs[key], tmp_path / key)
+    # shallower topography for the overriding definition
+    topography = np.fromfile(grid_attrs['topography_fname'], dtype='>i4')
+    np.minimum(topography, 10).astype('>i4').tofile(tmp_path / 'shallow_topography')
+
+    grid_def_files = []
+    for topography_fname in ['topography_fname', 'shallow_topography']:
+        grid_def_file = tmp_path / f'{topography_fname}.yaml'
+        files = dict(
+            {key: tmp_path / key for key in keys}, topography_fname=tmp_path / topography_fname
+        )
+        grid_def_file.write_text(
+            'MYGRID:\n'
+            '    lateral_dims: [116, 100]\n'
+            '    vertical_dims: 60\n'
+            '    type: dipole\n' + ''.join(f"    {k}: '{v}'\n" for k, v in files.items())
+        )
+        grid_def_files.append(str(grid_def_file))
+
+    pop_tools.register_grids(grid_def_files[0])
+    try:
+        assert pop_tools.get_grid('MYGRID').KMT.max() > 10
+        assert 'MYGRID' in pop_tools.config._inputdata_checked
+        pop_tools.register_grids(grid_def_files[1])
+        assert pop_tools.get_grid('MYGRID').KMT.max() == 10
+    finally:
+        for grid_def_file in grid_def_files:
+            pop_tools.grid_defs._files.remove(grid_def_file)
+        # reloading the definitions forgets the removed grid
+        pop_tools.grid_defs._reload()
+    assert 'MYGRID' not in pop_tools.config._inputdata_checked
+    assert not [key for key in pop_tools.grid_memo_info()['entries'] if key[0] == 'MYGRID']
+
+
 def test_get_grid():
     for grid in pop_tools.grid_defs.keys():
         print('-' * 80)
@@ -27,3 +156,99 @@ def test_get_grid_scrip():
     ds_test = pop_tools.get_grid('POP_gx3v7', scrip=True)
     ds_ref = xr.open_zarr(f'{testdata_dir}/POP_gx3v7.zarr')
     assert ds_compare(ds_test, ds_ref, assertion='allclose', rtol=1e-14, atol=1e-14)
+
+
+def test_read_horiz_grid_selective():
+    grid_attrs = pop_tools.grid_defs['POP_gx3v7']
+    nlat, nlon = grid_attrs['lateral_dims']
+    ref = np.fromfile(grid_attrs['horiz_grid_fname'], dtype='>f8').reshape((7, nlat, nlon))
+
+    HTE, ULAT = read_horiz_grid(
+        grid_attrs['horiz_grid_fname'], nlat, nlon, ['HTE', 'ULAT'], rows=slice(10, 20)
+    )
+    assert HTE.dtype == np.float64 and HTE.dtype.isnative
+    np.testing.assert_array_equal(HTE, ref[3, 10:20, :])
+    np.testing.assert_array_equal(ULAT, ref[0, 10:20, :])
+
+    KMT = read_int_field(grid_attrs['topography_fname'], nlat, nlon)
+    ref = np.fromfile(grid_attrs['topography_fname'], dtype='>i4').reshape((nlat, nlon))
+    np.testing.assert_array_equal(KMT, ref)
+
+
+def test_read_int_field_bad_dims():
+    grid_attrs = pop_tools.grid_defs['POP_gx3v7']
+    nlat, nlon = grid_attrs['lateral_dims']
+    with pytest.raises(ValueError):
+        read_int_field(grid_attrs['topography_fname'], nlat + 1, nlon)
+
+
+def test_get_grid_variables():
+    ds_full = pop_tools.get_grid('POP_gx3v7', memoize=False)
+    ds = pop_tools.get_grid('POP_gx3v7', variables=['KMT', 'TAREA'], memoize=False)
+    assert set(ds.data_vars) == {'KMT', 'TAREA'}
+    xr.testing.assert_identical(ds.TAREA, ds_full.TAREA)
+    xr.testing.assert_identical(ds.KMT, ds_full.KMT)
+
+    ds = pop_tools.get_grid('POP_gx3v7', scrip=True, variables='grid_imask', memoize=False)
+    assert list(ds.data_vars) == ['grid_imask']
+
+    with pytest.raises(ValueError):
+        pop_tools.get_grid('POP_gx3v7', variables=['grid_imask'])
+
+
+def test_get_grid_chunks():
+    for scrip in [False, True]:
+        ds_ref = pop_tools.get_grid('POP_gx3v7', scrip=scrip, memoize=False)
+        for chunks in [(1, 100), (7, 33), {'nlat': 50}]:
+            ds = pop_tools.get_grid('POP_gx3v7', scrip=scrip, chunks=chunks, memoize=False)
+            assert ds['grid_imask' if scrip else 'KMT'].chunks is not None
+            xr.testing.assert_identical(ds_ref, ds.compute())
+
+
+def test_get_grid_full_metrics():
+    ds = pop_tools.get_grid('POP_gx3v7', full_metrics=True, memoize=False)
+    assert 'UAREA' not in pop_tools.get_grid('POP_gx3v7', memoize=False)
+
+    grid_attrs = pop_tools.grid_defs['POP_gx3v7']
+    nlat, nlon = grid_attrs['lateral_dims']
+    HTN, HTE, ANGLE = read_horiz_grid(
+        grid_attrs['horiz_grid_fname'], nlat, nlon, ['HTN', 'HTE', 'ANGLE']
+    )
+    DXU = 0.5 * (HTN + np.roll(HTN, -1, axis=1))
+    DYU = 0.5 * (HTE + np.concatenate((HTE[1:], 2 * HTE[-1:] - HTE[-2:-1])))
+    np.testing.assert_allclose(ds.DXU, DXU)
+    np.testing.assert_allclose(ds.DYU, DYU)
+    np.testing.assert_allclose(ds.UAREA, DXU * DYU)
+    np.testing.assert_array_equal(ds.ANGLE, ANGLE)
+    # ANGLET averages the four surrounding U points (two on the bottom row)
+    s, c = np.sin(ANGLE), np.cos(ANGLE)
+    s, c = s + np.roll(s, 1, axis=1), c + np.roll(c, 1, axis=1)
+    s[1:], c[1:] = s[1:] + s[:-1], c[1:] + c[:-1]
+    np.testing.assert_allclose(ds.ANGLET, np.arctan2(s, c))
+
+    ds_chunked = pop_tools.get_grid('POP_gx3v7', full_metrics=True, chunks=(1, 33), memoize=False)
+    xr.testing.assert_identical(ds, ds_chunked.compute())
+
+
+def test_get_grid_full_metrics_memoized():
+    pop_tools.clear_grid_memo()
+    try:
+        ds = pop_tools.get_grid('POP_gx3v7')
+        assert 'DXU' not in ds
+        ds_metrics = pop_tools.get_grid('POP_gx3v7', full_metrics=True)
+        assert 'UAREA' in ds_metrics
+        assert 'DXU' in pop_tools.get_grid('POP_gx3v7', variables=['DXU'])
+        xr.testing.assert_identical(
+            ds_metrics, pop_tools.get_grid('POP_gx3v7', full_metrics=True, memoize=False)
+        )
+    finally:
+        pop_tools.clear_grid_memo()
+
+
+def test_get_grid_scrip_float32():
+    ds_ref = pop_tools.get_grid('POP_gx3v7', scrip=True, memoize=False)
+    ds = pop_tools.get_grid('POP_gx3v7', scrip=True, dtype=np.float32, memoize=False)
+    for v in ['grid_center_lat', 'grid_center_lon', 'grid_corner_lat', 'grid_corner_lon']:
+        assert ds[v].dtype == np.float32
+        assert np.dtype(ds[v].encoding['dtype']) == np.float32
+        np.testing.assert_allclose(ds[v], ds_ref[v], rtol=1e-6)
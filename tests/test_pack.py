@@ -0,0 +1,79 @@
+import dask.array
+import numpy as np
+import pytest
+import xarray as xr
+
+import pop_tools
+
+
+@pytest.fixture(scope='module')
+def index():
+    return pop_tools.OceanIndex.from_grid('POP_gx3v7')
+
+
+def test_pack_unpack_numpy(index):
+    arr = np.random.default_rng(0).random((2, index.nz, index.nlat, index.nlon))
+    ocean = np.arange(index.nz)[:, None, None] < index.KMT
+
+    packed = index.pack(arr, vertical=True)
+    assert packed.shape == (2, index.size)
+    assert index.size == ocean.sum()
+    np.testing.assert_array_equal(packed[1], arr[1][ocean])
+    np.testing.assert_array_equal(index.unpack(packed), np.where(ocean, arr, np.nan))
+
+    packed_2d = index.pack(arr[:, 0])
+    np.testing.assert_array_equal(packed_2d[0], arr[0, 0][index.KMT > 0])
+    np.testing.assert_array_equal(index.unpack(packed_2d, fill_value=0.0)[0, index.KMT == 0], 0.0)
+
+    out = np.zeros_like(arr)
+    assert index.unpack(packed, fill_value=None, out=out) is out
+    with pytest.raises(ValueError):
+        index.pack(arr[..., 1:], vertical=True)
+    with pytest.raises(ValueError):
+        index.pack(arr)
+
+
+def test_pack_no_land_is_view():
+    index = pop_tools.OceanIndex(np.full((4, 5), 3))
+    arr = np.ones((3, 4, 5))
+    assert np.shares_memory(index.pack(arr, vertical=True), arr)
+    assert np.shares_memory(index.unpack(index.pack(arr, vertical=True)), arr)
+
+
+def test_pack_unpack_dask_xarray(index):
+    arr = np.random.default_rng(1).random((3, index.nz, index.nlat, index.nlon))
+    expected = index.pack(arr, vertical=True)
+
+    darr = dask.array.from_array(arr, chunks=(1, 20, 50, 50))
+    packed = index.pack(darr, vertical=True)
+    assert isinstance(packed, dask.array.Array)
+    np.testing.assert_array_equal(packed.compute(), expected)
+    np.testing.assert_array_equal(index.unpack(packed).compute(), index.unpack(expected))
+
+    da = xr.DataArray(
+        darr, dims=('time', 'z_t', 'nlat', 'nlon'), coords={'time': [1, 2, 3]}, name='TEMP'
+    )
+    packed = index.pack(da)
+    assert packed.dims == ('time', 'ocean_point')
+    unpacked = index.unpack(packed)
+    assert unpacked.dims == da.dims
+    KMT = xr.DataArray(index.KMT, dims=('nlat', 'nlon'))
+    xr.testing.assert_identical(unpacked.compute(), da.where(da.z_t < KMT).compute())
+
+
+def test_pack_time_length_nz(index):
+    # a 2D field with as many records as levels is not packed as a 3D field
+    arr = np.random.default_rng(2).random((index.nz, index.nlat, index.nlon))
+    da = xr.DataArray(arr, dims=('time', 'nlat', 'nlon'))
+    packed = index.pack(da)
+    assert packed.dims == ('time', 'ocean_point')
+    np.testing.assert_array_equal(packed, index.pack(arr, vertical=False))
+    np.testing.assert_array_equal(packed[5], arr[5][index.KMT > 0])
+    assert index.unpack(packed).dims == da.dims
+
+    packed = index.pack(da.rename({'time': 'z_t'}))
+    assert packed.dims == ('ocean_point',)
+    with pytest.raises(ValueError):
+        index.pack(arr)
+    with pytest.raises(ValueError):
+        index.pack(da.transpose('nlat', 'time', 'nlon').rename({'time': 'z_t'}))
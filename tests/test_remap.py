@@ -0,0 +1,76 @@
+import os
+
+import dask.array
+import numpy as np
+import pytest
+import xarray as xr
+
+import pop_tools
+
+pytest.importorskip('scipy')
+
+
+def analytic_field(ds):
+    lat, lon = np.deg2rad(ds.TLAT.values), np.deg2rad(ds.TLONG.values)
+    return np.cos(lat) * np.sin(lon) ** 2 + np.sin(lat)
+
+
+@pytest.fixture(scope='module')
+def grids():
+    return pop_tools.get_grid('POP_gx3v7'), pop_tools.get_grid('POP_gx1v7')
+
+
+@pytest.mark.parametrize('method', ['nearest', 'bilinear'])
+def test_remap_weights(grids, method):
+    src, dst = grids
+    weights = pop_tools.get_remap_weights('POP_gx3v7', 'POP_gx1v7', method=method)
+    assert weights.matrix.shape == (dst.KMT.size, src.KMT.size)
+
+    row_sums = np.asarray(weights.matrix.sum(axis=1)).reshape(dst.KMT.shape)
+    ocean = dst.KMT.values > 0
+    np.testing.assert_allclose(row_sums[ocean], 1.0)
+    assert (row_sums[~ocean] == 0.0).all()
+    # only ocean source points are used
+    src_used = np.asarray(weights.matrix.sum(axis=0)).reshape(src.KMT.shape) > 0
+    assert (src.KMT.values[src_used] > 0).all()
+
+    remapped = pop_tools.apply_weights(weights, analytic_field(src))
+    error = np.abs(remapped - analytic_field(dst))[ocean]
+    assert np.isnan(remapped[~ocean]).all()
+    assert error.mean() < (2e-3 if method == 'bilinear' else 2e-2)
+
+
+def test_apply_weights_nan_dask_xarray(grids):
+    src, _ = grids
+    weights = pop_tools.get_remap_weights('POP_gx3v7', 'POP_gx1v7', method='bilinear')
+    field = np.stack([analytic_field(src)] * 4)
+    field[1, :, :50] = np.nan
+    expected = pop_tools.apply_weights(weights, field)
+    assert expected.shape == (4,) + weights.dst_shape
+    np.testing.assert_array_equal(expected[0], expected[2])
+    assert np.isnan(expected[1]).sum() > np.isnan(expected[0]).sum()
+
+    remapped = pop_tools.apply_weights(weights, dask.array.from_array(field, chunks=(1, 50, 50)))
+    assert isinstance(remapped, dask.array.Array)
+    np.testing.assert_array_equal(remapped.compute(), expected)
+
+    da = xr.DataArray(field, dims=('time', 'nlat', 'nlon'), coords={'time': np.arange(4)})
+    remapped = pop_tools.apply_weights(weights, da)
+    assert remapped.dims == da.dims
+    np.testing.assert_array_equal(remapped.time, da.time)
+    np.testing.assert_array_equal(remapped.values, expected)
+
+    with pytest.raises(ValueError):
+        pop_tools.apply_weights(weights, field[..., 1:])
+
+
+def test_remap_weights_cache(tmp_path):
+    weights = pop_tools.get_remap_weights(
+        'POP_gx3v7', 'POP_gx1v7', method='nearest', cache=str(tmp_path)
+    )
+    assert len(os.listdir(tmp_path / 'POP_gx3v7')) == 1
+    cached = pop_tools.get_remap_weights(
+        'POP_gx3v7', 'POP_gx1v7', method='nearest', cache=str(tmp_path)
+    )
+    assert (weights.matrix != cached.matrix).nnz == 0
+    assert cached.dst_shape == weights.dst_shape
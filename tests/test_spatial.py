@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+
+import pop_tools
+
+pytest.importorskip('scipy')
+
+
+@pytest.fixture(scope='module')
+def grid():
+    return pop_tools.get_grid('POP_gx3v7')
+
+
+def test_spatial_index_query(grid):
+    index = pop_tools.SpatialIndex.from_grid('POP_gx3v7', cells=False)
+    rng = np.random.default_rng(0)
+    lat, lon = rng.uniform(-75, 89, 500), rng.uniform(0, 360, 500)
+    j, i, distance = index.query(lat, lon)
+
+    # brute force
+    TLAT, TLONG = np.deg2rad(grid.TLAT.values).ravel(), np.deg2rad(grid.TLONG.values).ravel()
+    lat, lon = np.deg2rad(lat)[:, None], np.deg2rad(lon)[:, None]
+    cos_distance = np.sin(lat) * np.sin(TLAT) + np.cos(lat) * np.cos(TLAT) * np.cos(lon - TLONG)
+    np.testing.assert_array_equal(
+        np.ravel_multi_index((j, i), grid.TLAT.shape), cos_distance.argmax(axis=1)
+    )
+    np.testing.assert_allclose(distance, np.arccos(cos_distance.max(axis=1)), atol=1e-6)
+
+    j, i, _ = index.query(lat[:2], lon[:2], k=3)
+    assert j.shape == (2, 1, 3)
+
+
+def test_spatial_index_query_k_too_large():
+    TLAT, TLONG = np.meshgrid(np.linspace(-60, 60, 4), np.linspace(0, 300, 6), indexing='ij')
+    mask = np.zeros(TLAT.shape, dtype=bool)
+    mask[1:3, 2:4] = True
+    index = pop_tools.SpatialIndex(TLAT, TLONG, mask=mask)
+
+    j, i, _ = index.query(0.0, 150.0, k=4)
+    assert mask[j, i].all()
+    with pytest.raises(ValueError):
+        index.query(0.0, 150.0, k=5)
+
+
+def test_spatial_index_locate(grid):
+    index = pop_tools.SpatialIndex.from_grid('POP_gx3v7')
+    TLAT, TLONG = grid.TLAT.values[1:-1], grid.TLONG.values[1:-1]
+    j, i = index.locate(TLAT, TLONG)
+    np.testing.assert_array_equal(j, np.arange(1, grid.sizes['nlat'] - 1)[:, None] + 0 * i)
+    np.testing.assert_array_equal(i, np.arange(grid.sizes['nlon']) + 0 * j)
+
+    # south of the grid
+    assert index.locate(-89.9, 0.0) == (-1, -1)
+
+    with pytest.raises(ValueError):
+        pop_tools.SpatialIndex(grid.TLAT.values, grid.TLONG.values).locate(0.0, 0.0)
+
+
+def test_spatial_index_ocean_only_cache(grid, tmp_path):
+    index = pop_tools.SpatialIndex.from_grid('POP_gx3v7', ocean_only=True, cache=str(tmp_path))
+    assert len(os.listdir(tmp_path / 'POP_gx3v7')) == 1
+    cached = pop_tools.SpatialIndex.from_grid('POP_gx3v7', ocean_only=True, cache=str(tmp_path))
+
+    lat, lon = np.linspace(-70, 80, 50), np.linspace(0, 360, 50)
+    j, i, _ = cached.query(lat, lon)
+    assert (grid.KMT.values[j, i] > 0).all()
+    for a, b in zip(index.locate(lat, lon), cached.locate(lat, lon)):
+        np.testing.assert_array_equal(a, b)
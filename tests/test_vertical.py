@@ -0,0 +1,54 @@
+import dask.array
+import numpy as np
+import xarray as xr
+
+import pop_tools
+
+
+def test_depth_to_level():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    z_w_bot = ds.z_w_bot.values
+    level = pop_tools.depth_to_level([-1.0, 0.0, z_w_bot[0], ds.z_t[5], 1e9], z_w_bot)
+    np.testing.assert_array_equal(level, [-1, 0, 1, 5, len(z_w_bot)])
+
+
+def test_vertical_interpolator():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    z_t, KMT = ds.z_t.values, ds.KMT.values
+    depths = np.array([0.0, 500.0, 12345.0, 100000.0, 400000.0, 1e7])
+    interp = pop_tools.VerticalInterpolator.from_grid('POP_gx3v7', depths)
+
+    field = np.random.default_rng(0).random((2, len(z_t)) + KMT.shape)
+    out = interp(field)
+    assert out.shape == (2, len(depths)) + KMT.shape
+
+    expected = np.apply_along_axis(lambda column: np.interp(depths, z_t, column), 1, field)
+    level = pop_tools.depth_to_level(depths, ds.z_w_bot.values)[:, np.newaxis, np.newaxis]
+    below_floor = level >= KMT
+    # columns where both bracketing levels are ocean
+    bracketed = np.searchsorted(z_t, depths)[:, np.newaxis, np.newaxis] < KMT
+    assert np.isnan(out[:, below_floor]).all()
+    np.testing.assert_allclose(out[:, bracketed], expected[:, bracketed])
+    assert not np.isnan(out[:, ~below_floor]).any()
+
+    darr = dask.array.from_array(field, chunks=(1, 20, 50, 50))
+    np.testing.assert_array_equal(interp(darr).compute(), out)
+
+    da = xr.DataArray(field, dims=('time', 'z_t', 'nlat', 'nlon'), coords={'z_t': z_t})
+    out_da = interp(da.transpose('z_t', 'time', 'nlat', 'nlon'))
+    assert out_da.dims == ('time', 'depth', 'nlat', 'nlon')
+    np.testing.assert_array_equal(out_da.depth, depths)
+    np.testing.assert_array_equal(out_da.values, out)
+
+
+def test_vertical_interpolator_integer_field():
+    ds = pop_tools.get_grid('POP_gx3v7')
+    z_t, KMT = ds.z_t.values, ds.KMT.values
+    depths = np.array([0.0, 12345.0, 1e7])
+    interp = pop_tools.VerticalInterpolator.from_grid('POP_gx3v7', depths)
+
+    field = np.arange(len(z_t))[:, np.newaxis, np.newaxis] * np.ones(KMT.shape, dtype=np.int64)
+    out = interp(field)
+    assert out.dtype == np.float64
+    np.testing.assert_array_equal(out, interp(field.astype(np.float64)))
+    assert np.isnan(out[-1]).all()